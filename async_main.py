@@ -0,0 +1,68 @@
+"""
+Асинхронный режим бота на telebot.async_telebot.
+Обработчики те же, что и в main.py (start -> choice_devices_or_complexes -> choose_device -> choose_time_delay ->
+choose_columns -> make_graph): здесь только прием обновлений и отправка запросов к Telegram.
+- Обновления принимает AsyncTeleBot, а обрабатывают их обработчики main.bot в его потоках
+  (ожидание ввода даты и времени подписки тоже общее). Загрузка данных и отрисовка графиков идут в пуле процессов
+  main.graph_jobs
+- Ответы идут через AsyncOutbox: та же очередь с ограничением частоты, склейкой и повторами, что и main.outbox,
+  но запросы выполняет AsyncTeleBot в цикле событий, поэтому сетевые запросы идут параллельно
+Запуск: python async_main.py
+"""
+import asyncio
+import logging
+import signal
+from functools import partial
+
+from telebot.async_telebot import AsyncTeleBot
+
+import config
+import main
+from outbox import AsyncOutbox
+
+bot = AsyncTeleBot(config.token)
+
+
+@bot.message_handler(content_types=["text"])
+async def on_message(message):
+    """
+    Передача сообщения обработчикам main.bot (команды, ожидание ввода, кнопки)
+    """
+    await asyncio.to_thread(main.bot.process_new_messages, [message])
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def on_callback_query(call):
+    """
+    Передача нажатия inline-кнопки обработчикам main.bot (выбор столбцов)
+    """
+    await asyncio.to_thread(main.bot.process_new_callback_query, [call])
+
+
+async def run():
+    """
+    Запуск асинхронного бота
+    """
+    loop = asyncio.get_running_loop()
+    main.setup(partial(AsyncOutbox, bot, loop))
+    main.start_background()
+    # SIGTERM (остановка службы) и Ctrl+C прерывают прием сообщений, дальше shutdown
+    polling = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, polling.cancel)
+    try:
+        if config.id_alarm_ch != 0:
+            startup = main.startup.summary()
+            main.outbox.send_message(config.id_alarm_ch, f"Bot started (asyncio): {startup}", notify=False)
+        # infinity_polling сам повторяет запросы после ошибок и возвращается только после остановки
+        await bot.infinity_polling(timeout=10, request_timeout=15)
+    except asyncio.CancelledError:
+        logging.info("Bot stopped")
+    finally:
+        # Очередь отправки дожидается своих запросов в цикле событий, поэтому закрывается из отдельного потока
+        await asyncio.to_thread(main.shutdown)
+        await bot.close_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,519 @@
+"""
+Бенчмарк бота на синтетических данных.
+
+Создает рядом с временной рабочей папкой бота синтетический сайт (msu_aerosol/database.db и
+proc_data/{device}/YYYY_MM.csv с данными до текущего момента), поднимает локальную заглушку
+Telegram Bot API и прогоняет настоящие обработчики main.py через bot.process_new_updates.
+Для каждого сценария печатаются перцентили задержки и разбивка графиков на этапы
+load/process/render/send. Результат можно сохранить в json и сравнить со следующим запуском:
+
+    python benchmark.py --repeat 20 --json before.json
+    python benchmark.py --repeat 20 --json after.json --compare before.json
+
+С --memory для отрезков разной длины замеряется пик памяти загрузки сырых данных одного прибора:
+потоковой (как в боте) и со склейкой всех строк в памяти:
+
+    python benchmark.py --devices 1 --months 60 --flows device --repeat 1 --memory 1 6 12 60
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+# Имена приборов и префиксы их столбцов (по мотивам приборов сайта)
+DEVICE_NAMES = ["AE33", "TCA08", "Aurora", "LOAC", "Grimm", "Ceilometer", "Nephelometer", "SMPS"]
+COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f"]
+BENCH_USER = 100500
+
+
+def make_site(path_site, devices=6, columns=8, months=6, step=60, seed=0):
+    """
+    Синтетический сайт: база приборов/комплексов/графиков/столбцов и месячные csv
+    с десятичной запятой, как их пишет сайт
+
+    :param path_site: папка сайта (внутри создается msu_aerosol)
+    :param devices: число приборов (последний из них скрыт на сайте)
+    :param columns: число столбцов у самого широкого прибора
+    :param months: за сколько последних месяцев есть данные
+    :param step: шаг записей в секундах
+    :param seed: зерно генератора, чтобы запуски были сравнимы
+    :return: список отображаемых приборов
+    """
+    rng = np.random.default_rng(seed)
+    path_db = f"{path_site}/msu_aerosol/database.db"
+    os.makedirs(os.path.dirname(path_db), exist_ok=True)
+    if os.path.exists(path_db):
+        os.remove(path_db)
+    connection = sqlite3.connect(path_db)
+    connection.executescript(
+        """
+        CREATE TABLE complexes (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE devices (id INTEGER PRIMARY KEY, name TEXT, show BOOLEAN, complex_id INTEGER);
+        CREATE TABLE graphs (id INTEGER PRIMARY KEY, device_id INTEGER);
+        CREATE TABLE columns (id INTEGER PRIMARY KEY, name TEXT, graph_id INTEGER, use BOOLEAN, color TEXT);
+        """
+    )
+    connection.executemany("INSERT INTO complexes VALUES (?, ?)", [(1, "Комплекс 1"), (2, "Комплекс 2")])
+    end = pd.Timestamp.now().floor(f"{step}s")
+    index = pd.date_range(end - pd.DateOffset(months=months), end, freq=f"{step}s")
+    timestamps = index.strftime("%Y-%m-%d %H:%M:%S")
+    month_keys = index.strftime("%Y_%m")
+    # Суточный ход + шум + редкие пропуски
+    day_phase = 2 * np.pi * (index.hour * 3600 + index.minute * 60).to_numpy() / 86400
+    shown, graph_id = [], 0
+    for i in range(devices):
+        name = DEVICE_NAMES[i % len(DEVICE_NAMES)] + ("" if i < len(DEVICE_NAMES) else str(i))
+        show = i < devices - 1 or devices == 1
+        connection.execute("INSERT INTO devices VALUES (?, ?, ?, ?)", (i + 1, name, show, 1 + i % 2))
+        if show:
+            shown.append(name)
+        width = max(2, columns - i % 3 * (columns // 4))
+        names = [f"{name[:2]}{j + 1}" for j in range(width)]
+        for part in (names[: width // 2 + 1], names[width // 2 + 1:]):
+            if not part:
+                continue
+            graph_id += 1
+            connection.execute("INSERT INTO graphs VALUES (?, ?)", (graph_id, i + 1))
+            for col in part:
+                j = names.index(col)
+                connection.execute(
+                    "INSERT INTO columns (name, graph_id, use, color) VALUES (?, ?, ?, ?)",
+                    (col, graph_id, j != width - 1, COLORS[j % len(COLORS)]),
+                )
+        data = pd.DataFrame({"timestamp": timestamps})
+        for j, col in enumerate(names):
+            values = (j + 1) * 10 * (1.5 + np.sin(day_phase + j)) + rng.normal(0, j + 1, len(index))
+            values[rng.random(len(index)) < 0.002] = np.nan
+            data[col] = values
+        path_device = f"{path_site}/msu_aerosol/proc_data/{name}"
+        os.makedirs(path_device, exist_ok=True)
+        for month, part in data.groupby(month_keys):
+            part.to_csv(f"{path_device}/{month}.csv", index=False, decimal=",", float_format="%.3f")
+    connection.commit()
+    connection.close()
+    return shown
+
+
+class FakeTelegram:
+    """
+    Локальная заглушка Telegram Bot API: отвечает на любые методы правдоподобными объектами
+    и запоминает вызовы, чтобы бенчмарк мог дождаться нужного ответа бота
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: искусственная задержка каждого ответа в секундах
+        """
+        self.latency = latency
+        self.calls = []
+        self._condition = threading.Condition()
+        self._message_id = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake._handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def _handle(self, request):
+        url = urlparse(request.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            request.rfile.read(length)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._condition:
+            self._message_id += 1
+            message_id = self._message_id
+        result = True
+        if method.startswith("send") or method.startswith("edit"):
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", BENCH_USER)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if method == "sendPhoto":
+                result["photo"] = [
+                    {"file_id": f"photo{message_id}", "file_unique_id": f"u{message_id}", "width": 700, "height": 500}
+                ]
+        body = json.dumps({"ok": True, "result": result}).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        with self._condition:
+            self.calls.append((method, params))
+            self._condition.notify_all()
+
+    def wait_for(self, start, predicate, timeout=120.0):
+        """
+        Ожидание вызова API, удовлетворяющего условию
+
+        :param start: с какого номера вызова искать
+        :param predicate: функция (метод, параметры) -> bool
+        :param timeout: сколько ждать в секундах
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if any(predicate(*call) for call in self.calls[start:]):
+                    return
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError("бот не ответил")
+                self._condition.wait(left)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Driver:
+    """
+    Подача обновлений Telegram в настоящие обработчики бота
+    """
+
+    def __init__(self, main, fake, user_id=BENCH_USER):
+        self.main = main
+        self.fake = fake
+        self.user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+        self.chat = {"id": user_id, "type": "private"}
+        self._update_id = 0
+
+    def _process(self, update):
+        from telebot import types as telebot_types
+
+        self._update_id += 1
+        update["update_id"] = self._update_id
+        self.main.bot.process_new_updates([telebot_types.Update.de_json(update)])
+
+    def message(self, text):
+        self._process(
+            {"message": {"message_id": 1, "date": int(time.time()), "chat": self.chat, "from": self.user, "text": text}}
+        )
+
+    def callback(self, data):
+        self._process(
+            {
+                "callback_query": {
+                    "id": "1",
+                    "from": self.user,
+                    "chat_instance": "1",
+                    "data": data,
+                    "message": {"message_id": 5, "date": int(time.time()), "chat": self.chat, "text": "Нажми"},
+                }
+            }
+        )
+
+    def graph(self):
+        """
+        Нажатие "Построить график" и ожидание отправленной картинки
+        (после нее бот спрашивает, построить ли график еще раз)
+        """
+        start = len(self.fake.calls)
+        self.callback("next")
+        self.fake.wait_for(
+            start, lambda method, params: method == "sendMessage" and params.get("text", "").startswith("Построить")
+        )
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "n": int(len(samples)),
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p90": float(np.percentile(samples, 90)),
+        "p99": float(np.percentile(samples, 99)),
+    }
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix="meteo_bench_")
+    path_site, path_bot = f"{root}/MSU_aerosol_site", f"{root}/bot"
+    os.makedirs(path_bot)
+    generate_start = time.perf_counter()
+    devices = make_site(path_site, args.devices, args.columns, args.months, args.step)
+    print(f"Синтетический сайт {path_site}, приборов: {len(devices)}, {time.perf_counter() - generate_start:.1f} s")
+
+    fake = FakeTelegram(args.api_latency / 1000)
+    # Бот не должен увидеть настоящий config.py с токеном: подменяю модуль до импорта main
+    config = types.ModuleType("config")
+    config.token = "0:bench"
+    config.id_alarm_ch = 0
+    config.render_workers = args.workers
+    config.graph_renderer = args.renderer
+    # У заглушки нет ограничений Telegram: сценарии идут подряд в один чат, замеряется сам бот
+    config.outbox_chat_rate = 1000.0
+    config.outbox_chat_burst = 1000
+    sys.modules["config"] = config
+    import telebot
+
+    telebot.apihelper.API_URL = fake.api_url
+    os.chdir(path_bot)
+    import main
+
+    main.setup()
+    main.bot.threaded = False
+    main.graph_jobs.warm_up()
+    main.hot_window.poll(main.catalog.list_devices())
+
+    phases = {}
+    original_log, original_upload = main.log_graph_stats, main.upload_graph
+
+    def log_graph_stats(device, stats):
+        phases.update(stats)
+        original_log(device, stats)
+
+    def upload_graph(chat_id, key, version, png, on_sent=None):
+        upload_start = time.perf_counter()
+
+        def sent():
+            # Конец загрузки фиксируется до on_sent: его сообщение завершает замер сценария
+            phases["send"] = time.perf_counter() - upload_start
+            if on_sent is not None:
+                on_sent()
+
+        original_upload(chat_id, key, version, png, sent)
+
+    main.log_graph_stats, main.upload_graph = log_graph_stats, upload_graph
+
+    driver = Driver(main, fake)
+    device = devices[0]
+    meta = main.catalog.device_meta(device)
+    columns = meta.columns
+    driver.message("/start")
+    driver.message(device)
+    driver.message("2 дня")
+    for col in columns[:3]:
+        driver.callback(main.column_callback(meta, meta.buttons.index(col)))
+    last = main.time_ranges.device_range(device)[1]
+    range_begin = (last - pd.DateOffset(months=max(1, args.months - 1))).strftime("%d.%m.%Y")
+    range_end = (last - pd.Timedelta(days=1)).strftime("%d.%m.%Y")
+
+    def select_delay(text):
+        with main.sessions.edit(BENCH_USER) as user_info:
+            user_info["selected_columns"][device] = list(columns[:3])
+        driver.message(device)
+        if text is None:
+            driver.message("Свой временной промежуток")
+            driver.message(range_begin)
+            driver.message(range_end)
+        else:
+            driver.message(text)
+
+    # Сценарий: (подготовка, замеряемое действие, холодный ли график, graph_point_budget или None - как у бота).
+    # *_raw рисуют все точки без прореживания: с ними сравнивается выигрыш от прореживания
+    flows = {
+        "device": (lambda: None, lambda: driver.message(device), False, None),
+        "toggle": (
+            lambda: None,
+            lambda: driver.callback(main.column_callback(meta, meta.buttons.index(columns[-1]))),
+            False,
+            None,
+        ),
+        "graph_2d": (lambda: select_delay("2 дня"), driver.graph, True, None),
+        "graph_31d": (lambda: select_delay("31 день"), driver.graph, True, None),
+        "graph_31d_raw": (lambda: select_delay("31 день"), driver.graph, True, 0),
+        "graph_range": (lambda: select_delay(None), driver.graph, True, None),
+        "graph_range_raw": (lambda: select_delay(None), driver.graph, True, 0),
+        "graph_31d_cached": (lambda: select_delay("31 день"), driver.graph, False, None),
+    }
+    point_budget = main.graph_point_budget
+    results = {}
+    for name, (prepare, action, cold, budget) in flows.items():
+        if args.flows and name not in args.flows:
+            continue
+        main.graph_point_budget = point_budget if budget is None else budget
+        samples = {"total": []}
+        for _ in range(args.warmup + args.repeat):
+            prepare()
+            if cold:
+                # Холодный график: без кеша картинок
+                main.graph_cache = main.GraphCache()
+            phases.clear()
+            action_start = time.perf_counter()
+            action()
+            elapsed = time.perf_counter() - action_start
+            if _ < args.warmup:
+                continue
+            samples["total"].append(elapsed)
+            for phase in ("load", "process", "render", "send"):
+                if phase in phases:
+                    samples.setdefault(phase, []).append(phases[phase])
+        results[name] = {phase: percentiles(values) for phase, values in samples.items()}
+    main.graph_point_budget = point_budget
+    memory = None
+    if args.memory:
+        memory = memory_profile(main.proc_data, device, columns, last, args.memory, main.graph_point_budget)
+    # Процессы пула и их kaleido завершаются вместе с бенчмарком, а не остаются сиротами
+    main.shutdown()
+    fake.close()
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "time": pd.Timestamp.now().isoformat(timespec="seconds"),
+            "params": {
+                key: getattr(args, key)
+                for key in ("devices", "columns", "months", "step", "repeat", "workers", "renderer", "api_latency")
+            },
+        },
+        "flows": results,
+        "memory": memory,
+    }
+
+
+def memory_profile(proc_data, device, columns, last, months_list, point_budget):
+    """
+    Пик памяти (tracemalloc) и время загрузки сырых данных прибора за последние N месяцев:
+    потоково в огибающую (workers.stream_range) и со склейкой всех строк (load_range + downsample_minmax).
+    Страницы mmap кеша данных в пик не входят: это файловый кеш ОС, а не память процесса
+
+    :param proc_data: ProcDataCache бота
+    :param device: прибор
+    :param columns: столбцы
+    :param last: последняя метка данных прибора
+    :param months_list: длины отрезков в месяцах
+    :param point_budget: graph_point_budget бота
+    :return: список результатов по отрезкам
+    """
+    from render import downsample_minmax
+    from workers import stream_range
+
+    def measure(load):
+        tracemalloc.start()
+        start = time.perf_counter()
+        rows = load()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return rows, peak / 2 ** 20, elapsed
+
+    def full(begin):
+        timestamps, values = proc_data.load_range(device, begin, last, columns)
+        downsample_minmax(timestamps, values, point_budget)
+        return len(timestamps)
+
+    results = []
+    for months in months_list:
+        begin = last - pd.DateOffset(months=months)
+        # Первый проход строит кеш данных из csv, его память к загрузке не относится
+        for _ in proc_data.iter_range(device, begin, last, columns):
+            pass
+        rows, stream_mib, stream_s = measure(
+            lambda: stream_range(proc_data, device, begin, last, columns, point_budget)[3]
+        )
+        _, full_mib, full_s = measure(lambda: full(begin))
+        results.append({
+            "months": months, "rows": rows,
+            "stream_mib": stream_mib, "stream_s": stream_s, "full_mib": full_mib, "full_s": full_s,
+        })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result, baseline=None):
+    """
+    Таблица перцентилей в мс; при наличии baseline - изменение p50 в процентах
+    """
+    print(f"\ncommit {result['meta']['commit']}, {result['meta']['params']}")
+    if baseline is not None and baseline["meta"]["params"] != result["meta"]["params"]:
+        print(f"Внимание: параметры сравниваемого запуска {baseline['meta']['commit']} другие: {baseline['meta']['params']}")
+    print(f"{'flow':<18}{'phase':<9}{'n':>4}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'Δp50':>9}")
+    for flow, flow_phases in result["flows"].items():
+        for phase, stats in flow_phases.items():
+            line = (
+                f"{flow if phase == 'total' else '':<18}{phase:<9}{stats['n']:>4}"
+                f"{stats['mean']:>10.1f}{stats['p50']:>10.1f}{stats['p90']:>10.1f}{stats['p99']:>10.1f}"
+            )
+            old = ((baseline or {}).get("flows", {}).get(flow) or {}).get(phase)
+            if old and old["p50"]:
+                line += f"{(stats['p50'] / old['p50'] - 1) * 100:>+8.0f}%"
+            print(line)
+    if result.get("memory"):
+        print(f"\n{'months':<8}{'rows':>10}{'stream MiB':>12}{'stream s':>10}{'full MiB':>10}{'full s':>9}")
+        for row in result["memory"]:
+            print(
+                f"{row['months']:<8}{row['rows']:>10}{row['stream_mib']:>12.1f}{row['stream_s']:>10.3f}"
+                f"{row['full_mib']:>10.1f}{row['full_s']:>9.3f}"
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк бота на синтетических данных")
+    parser.add_argument("--devices", type=int, default=6, help="число приборов")
+    parser.add_argument("--columns", type=int, default=8, help="столбцов у самого широкого прибора")
+    parser.add_argument("--months", type=int, default=6, help="за сколько месяцев генерировать данные")
+    parser.add_argument("--step", type=int, default=60, help="шаг записей в секундах")
+    parser.add_argument("--repeat", type=int, default=10, help="измерений на сценарий")
+    parser.add_argument("--warmup", type=int, default=1, help="неучитываемых прогонов на сценарий")
+    parser.add_argument("--workers", type=int, default=2, help="render_workers бота")
+    parser.add_argument("--renderer", default="plotly", help="graph_renderer бота")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Telegram в мс")
+    parser.add_argument("--flows", nargs="*", help="только эти сценарии")
+    parser.add_argument("--json", help="куда сохранить результат")
+    parser.add_argument("--compare", help="json предыдущего запуска для сравнения")
+    parser.add_argument(
+        "--memory", nargs="*", type=int, help="замерить память загрузки за столько последних месяцев"
+    )
+    parser.add_argument("--keep", action="store_true", help="не удалять синтетический сайт после запуска")
+    args = parser.parse_args()
+    # Бенчмарк переходит в рабочую папку бота -> пути до json делаются абсолютными заранее
+    args.json = args.json and os.path.abspath(args.json)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare, "r") as file:
+            baseline = json.load(file)
+    bench_result = run(arguments)
+    report(bench_result, baseline)
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump(bench_result, file, indent=2, ensure_ascii=False)
+    sys.exit(0)
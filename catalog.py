@@ -0,0 +1,228 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import registry
+
+
+class DeviceMeta:
+    """
+    Метаданные одного прибора: используемые столбцы, их цвета и разбиение столбцов по графикам сайта
+    """
+
+    __slots__ = ("name", "columns", "use", "colors", "graphs", "buttons", "digest")
+
+    def __init__(self, name, rows):
+        """
+        :param name: имя прибора
+        :param rows: строки (graph_id, имя столбца, use, цвет) из JOIN запроса
+        """
+        self.name = name
+        # Все столбцы прибора с флагом use (столбец может встречаться в нескольких графиках)
+        self.use = {}
+        # Как и раньше, берется цвет первого найденного столбца с таким именем
+        self.colors = {}
+        self.graphs = {}
+        for graph_id, col, use, color in rows:
+            self.graphs.setdefault(graph_id, []).append(col)
+            self.use[col] = bool(use) or self.use.get(col, False)
+            self.colors.setdefault(col, color)
+        # Используемые столбцы в порядке их появления на сайте
+        self.columns = [col for col, use in self.use.items() if use]
+        # Столбцы в порядке кнопок выбора; в callback_data кнопки лежит номер столбца в этом списке
+        self.buttons = sorted(self.columns)
+        # Отпечаток списка кнопок: по нему видно, что нажата кнопка старой клавиатуры
+        self.digest = f"{zlib.crc32(chr(0).join(self.buttons).encode()):08x}"
+
+    def color(self, col):
+        """
+        :param col: столбец
+        :return: цвет столбца в данном приборе
+        """
+        return self.colors[col]
+
+
+class Catalog:
+    """
+    Кеш справочника сайта: приборы, комплексы, графики и столбцы.
+    Держит одно долгоживущее read-only соединение с database.db, загружает таблицы в память
+    и перечитывает их только если база изменилась (PRAGMA data_version, inode, mtime и размер файла).
+    Проверка изменений делается не чаще, чем раз в refresh_interval секунд,
+    поэтому обращения к каталогу из фильтров обработчиков не трогают базу данных.
+    """
+
+    def __init__(self, path_db, refresh_interval=5.0):
+        """
+        :param path_db: путь до database.db сайта
+        :param refresh_interval: минимальный интервал (в секундах) между проверками изменения базы
+        """
+        self.path_db = path_db
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._conn = None
+        self._file_state = None
+        self._data_version = None
+        self._checked_at = 0.0
+        self._loaded = False
+        # Номер загрузки справочника: меняется каждый раз, когда база перечитана
+        self.generation = 0
+        self.devices = []
+        self.devices_set = frozenset()
+        self.device_ids = {}
+        self.complexes = []
+        self.complexes_set = frozenset()
+        self.complex_devices = {}
+        self._device_meta = {}
+
+    def _file_stat(self):
+        """
+        :return: (inode, mtime, размер) файла базы данных
+        """
+        st = os.stat(self.path_db)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _connect(self):
+        """
+        Открытие (или переоткрытие) read-only соединения с базой данных
+        """
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = sqlite3.connect(
+            f"file:{self.path_db}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    def execute(self, query, params=(), method="fetchall"):
+        """
+        Выполнение запроса через общее соединение
+
+        :param query: запрос
+        :param params: параметры запроса
+        :param method: тип метода fetchall или fetchone
+        :return: значение по запросу
+        """
+        with self._lock, registry.timer("bot_sqlite_seconds", db="catalog"):
+            if self._conn is None:
+                self._connect()
+            cursor = self._conn.execute(query, params)
+            if method == "fetchall":
+                return cursor.fetchall()
+            return cursor.fetchone()
+
+    def _load(self):
+        """
+        Полная загрузка справочника в память
+        """
+        devices = self.execute("SELECT id, name, show, complex_id FROM devices")
+        complexes = self.execute("SELECT id, name FROM complexes")
+
+        shown_devices = []
+        device_ids = {}
+        for device_id, name, show, _ in devices:
+            device_ids[name] = device_id
+            if show:
+                shown_devices.append(name)
+        complex_names = {complex_id: name for complex_id, name in complexes}
+        complex_devices = {name: [] for name in complex_names.values()}
+        for _, name, show, complex_id in devices:
+            if show and complex_id in complex_names:
+                complex_devices[complex_names[complex_id]].append(name)
+
+        self.devices = shown_devices
+        self.devices_set = frozenset(shown_devices)
+        self.device_ids = device_ids
+        self.complexes = [name for _, name in complexes]
+        self.complexes_set = frozenset(self.complexes)
+        self.complex_devices = complex_devices
+        # Метаданные приборов строятся заново по требованию
+        self._device_meta = {}
+        self._loaded = True
+        self.generation += 1
+
+    def refresh(self, force=False):
+        """
+        Перечитывание справочника, если база изменилась
+
+        :param force: перечитать без учета интервала проверки
+        """
+        now = time.monotonic()
+        if not force and self._loaded and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            file_state = self._file_stat()
+            # Файл базы заменили целиком -> старое соединение смотрит на удаленный файл
+            if self._conn is None or self._file_state is None or file_state[0] != self._file_state[0]:
+                self._connect()
+            data_version = self.execute("PRAGMA data_version", method="fetchone")[0]
+            if (
+                force
+                or not self._loaded
+                or file_state != self._file_state
+                or data_version != self._data_version
+            ):
+                self._load()
+            self._file_state = file_state
+            self._data_version = data_version
+
+    def list_devices(self):
+        """
+        :return: список имен приборов, которые отображаются на сайте
+        """
+        self.refresh()
+        return self.devices
+
+    def is_device(self, name):
+        """
+        :param name: имя прибора
+        :return: отображается ли прибор на сайте
+        """
+        self.refresh()
+        return name in self.devices_set
+
+    def list_complexes(self):
+        """
+        :return: список всех комплексов
+        """
+        self.refresh()
+        return self.complexes
+
+    def is_complex(self, name):
+        """
+        :param name: имя комплекса
+        :return: есть ли такой комплекс
+        """
+        self.refresh()
+        return name in self.complexes_set
+
+    def devices_of_complex(self, complex_name):
+        """
+        :param complex_name: имя комплекса
+        :return: список используемых приборов в комплексе
+        """
+        self.refresh()
+        return list(self.complex_devices[complex_name])
+
+    def device_meta(self, device_name):
+        """
+        Метаданные прибора, собранные одним JOIN запросом и закешированные до изменения базы
+
+        :param device_name: имя прибора
+        :return: DeviceMeta прибора
+        """
+        self.refresh()
+        meta = self._device_meta.get(device_name)
+        if meta is None:
+            rows = self.execute(
+                "SELECT graphs.id, columns.name, columns.use, columns.color "
+                "FROM devices "
+                "JOIN graphs ON graphs.device_id = devices.id "
+                "JOIN columns ON columns.graph_id = graphs.id "
+                "WHERE devices.name = ? "
+                "ORDER BY graphs.id, columns.rowid",
+                (device_name,),
+            )
+            meta = DeviceMeta(device_name, rows)
+            self._device_meta[device_name] = meta
+        return meta
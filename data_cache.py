@@ -0,0 +1,503 @@
+import csv
+import io
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class StaleCacheError(Exception):
+    """
+    Исходный csv перезаписан короче, чем было строк в версии кеша: версия больше не соответствует файлу
+    """
+
+
+class NoDataError(Exception):
+    """
+    У прибора нет ни одного месячного файла с данными
+    """
+
+
+class ProcDataCache:
+    """
+    Колоночный бинарный кеш месячных файлов proc_data/{device}/YYYY_MM.csv.
+    Каждый csv переводится в набор .npy файлов: timestamp (int64, наносекунды epoch)
+    и по файлу на каждый столбец (float32, по желанию float64). Столбец разбирается из csv
+    при первом запросе, формат чисел (десятичная запятая или точка) определяется один раз на файл.
+    Файлы читаются через mmap и только для нужных столбцов.
+    Кеш месяца хранится в папке версии {mtime}_{размер}_{тип} исходного csv. Кешем пользуются
+    несколько процессов сразу, поэтому версия собирается во временной папке и переименовывается
+    целиком (rename атомарен): читатели видят либо готовую версию, либо никакую
+    """
+
+    time_col = "timestamp"
+    # Сколько байт начала файла смотреть при определении формата чисел
+    sniff_bytes = 64 * 1024
+    # Сколько секунд хранятся устаревшие версии и временные папки: ими могут еще пользоваться другие процессы
+    stale_seconds = 60
+
+    def __init__(self, path_proc_data, path_cache, dtype="float32"):
+        """
+        :param path_proc_data: путь до папки proc_data сайта
+        :param path_cache: путь до папки с кешем
+        :param dtype: тип значений столбцов: "float32" или "float64"
+        """
+        self.path_proc_data = path_proc_data
+        self.path_cache = path_cache
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def source_path(self, device, month):
+        """
+        :param device: прибор
+        :param month: месяц в формате YYYY_MM
+        :return: путь до исходного csv
+        """
+        return f"{self.path_proc_data}/{device}/{month}.csv"
+
+    def _cache_path(self, device, month):
+        return f"{self.path_cache}/{device}/{month}"
+
+    def _version_path(self, device, month, mtime_ns, size):
+        return f"{self._cache_path(device, month)}/{mtime_ns}_{size}_{self.dtype}"
+
+    @staticmethod
+    def _tmp_suffix():
+        # Уникально для процесса и потока: сборщики в разных процессах не пишут в одни и те же файлы
+        return f"tmp-{os.getpid()}-{threading.get_ident()}"
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _read_meta(path):
+        try:
+            with open(f"{path}/meta.json", "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def sniff_decimal(head):
+        """
+        Определение десятичного разделителя каждого столбца по началу файла.
+        Сайт пишет числа с десятичной запятой в кавычках ("1,5"), но часть столбцов может быть с точкой
+
+        :param head: первые байты csv вместе с заголовком (последняя строка может быть неполной)
+        :return: (список столбцов, словарь столбец -> "," или ".")
+        """
+        lines = head.decode("utf-8", errors="replace").splitlines()
+        if head and not head.endswith(b"\n") and len(lines) > 1:
+            lines = lines[:-1]
+        rows = list(csv.reader(lines))
+        if not rows:
+            return [], {}
+        header = rows[0]
+        comma = set()
+        for row in rows[1:]:
+            for col, value in zip(header, row):
+                if "," in value:
+                    comma.add(col)
+        return header, {col: "," if col in comma else "." for col in header}
+
+    @staticmethod
+    def read_timestamps(source, **kwargs):
+        """
+        :param source: путь до csv или файловый объект
+        :param kwargs: дополнительные параметры pd.read_csv
+        :return: timestamp в int64 наносекундах
+        """
+        data = pd.read_csv(source, usecols=[ProcDataCache.time_col], **kwargs)
+        return pd.to_datetime(
+            data[ProcDataCache.time_col], format="%Y-%m-%d %H:%M:%S"
+        ).values.astype("int64")
+
+    @staticmethod
+    def read_columns(source, columns, decimal, dtype, **kwargs):
+        """
+        Разбор только нужных столбцов csv сразу в числа нужного типа (без промежуточных строк)
+
+        :param source: путь до csv или файловый объект
+        :param columns: нужные столбцы
+        :param decimal: словарь столбец -> десятичный разделитель из sniff_decimal
+        :param dtype: "float32" или "float64"
+        :param kwargs: дополнительные параметры pd.read_csv
+        :return: словарь столбец -> массив
+        """
+        values = {}
+        for separator in sorted({decimal.get(col, ".") for col in columns}):
+            group = [col for col in columns if decimal.get(col, ".") == separator]
+            if hasattr(source, "seek"):
+                source.seek(0)
+            try:
+                data = pd.read_csv(
+                    source, usecols=group, decimal=separator, dtype={col: dtype for col in group}, **kwargs
+                )
+            except ValueError:
+                # Дальше по файлу встретился другой разделитель или не число -> медленный разбор через строки
+                if hasattr(source, "seek"):
+                    source.seek(0)
+                data = pd.read_csv(source, usecols=group, dtype=str, **kwargs)
+                data = data.apply(
+                    lambda column: pd.to_numeric(column.str.replace(",", ".", regex=False), errors="coerce")
+                )
+            for col in group:
+                values[col] = data[col].to_numpy(dtype=dtype)
+        return values
+
+    @classmethod
+    def read_tail(cls, path, offset, size, header=None, decimal=None, dtype="float32"):
+        """
+        Разбор полных строк csv между offset и size байт. Сайт только дописывает месячные файлы,
+        поэтому прочитанное раньше начало файла повторно не разбирается.
+        Последняя строка может быть еще не дописана -> берутся только строки до последнего перевода строки
+
+        :param path: путь до csv
+        :param offset: смещение в байтах до конца уже прочитанных строк (0 - с начала файла)
+        :param size: размер файла в байтах
+        :param header: заголовок файла или None при чтении с начала
+        :param decimal: словарь столбец -> десятичный разделитель или None при чтении с начала
+        :param dtype: тип значений
+        :return: (новое смещение, заголовок, формат чисел, timestamp, словарь столбец -> значения)
+            или None, если полных новых строк нет
+        """
+        with open(path, "rb") as file:
+            file.seek(offset)
+            chunk = file.read(size - offset)
+        end = chunk.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        chunk = chunk[:end]
+        if header is None:
+            # Начало файла: заголовок и формат чисел определяются один раз и запоминаются
+            header, decimal = cls.sniff_decimal(chunk[:cls.sniff_bytes])
+            options = {}
+        else:
+            options = {"header": None, "names": header}
+        source = io.BytesIO(chunk)
+        timestamps = cls.read_timestamps(source, **options)
+        columns = [col for col in header if col != cls.time_col]
+        if len(timestamps):
+            values = cls.read_columns(source, columns, decimal, dtype, **options)
+        else:
+            values = {col: np.empty(0, dtype=dtype) for col in columns}
+        return offset + end, header, decimal, timestamps, values
+
+    def _build(self, device, month, source, stat):
+        """
+        Создание версии кеша месяца: метки времени и формат чисел каждого столбца.
+        Сами столбцы разбираются позже и только те, которые запросили.
+        Версия собирается во временной папке и появляется под своим именем уже готовой,
+        после этого старые версии месяца удаляются
+        """
+        path = self._version_path(device, month, stat.st_mtime_ns, stat.st_size)
+        tmp = f"{path}.{self._tmp_suffix()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        with open(source, "rb") as file:
+            columns, decimal = self.sniff_decimal(file.read(self.sniff_bytes))
+        timestamps = self.read_timestamps(source)
+        np.save(f"{tmp}/timestamp.npy", timestamps)
+        columns = [col for col in columns if col != self.time_col]
+        meta = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "rows": len(timestamps),
+            "columns": columns,
+            "decimal": {col: decimal[col] for col in columns},
+            "dtype": self.dtype,
+        }
+        with open(f"{tmp}/meta.json", "w") as file:
+            json.dump(meta, file)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Ту же версию уже собрал другой процесс -> используем ее
+            shutil.rmtree(tmp, ignore_errors=True)
+            meta = self._read_meta(path) or meta
+        self._drop_old_versions(device, month, os.path.basename(path))
+        return meta
+
+    def _drop_old_versions(self, device, month, current):
+        """
+        Удаление устаревших версий месяца (и файлов кеша старого формата без папок версий).
+        Версии, которые менялись последние stale_seconds секунд, остаются: их может читать или
+        дописывать столбцами другой процесс. Уже открытые через mmap файлы доступны и после удаления,
+        а читатель, не успевший открыть файлы удаленной версии, перечитывает метаданные (см. load_arrays)
+        """
+        path = self._cache_path(device, month)
+        deadline = time.time() - self.stale_seconds
+        for name in os.listdir(path):
+            if name == current:
+                continue
+            try:
+                if os.stat(f"{path}/{name}").st_mtime > deadline:
+                    continue
+                if os.path.isdir(f"{path}/{name}"):
+                    shutil.rmtree(f"{path}/{name}", ignore_errors=True)
+                else:
+                    os.remove(f"{path}/{name}")
+            except FileNotFoundError:
+                # Удалил другой процесс
+                continue
+
+    def _build_columns(self, path, device, month, meta, columns):
+        """
+        Разбор еще не закешированных столбцов месяца одним чтением csv.
+        Читаются только первые meta["rows"] строк: csv могли дописать после создания версии,
+        а столбцы версии должны совпадать по длине с ее метками времени
+        """
+        index = {col: i for i, col in enumerate(meta["columns"])}
+        with self._key_lock((device, month)):
+            missing = [col for col in columns if not os.path.exists(f"{path}/col_{index[col]}.npy")]
+            if not missing:
+                return
+            values = self.read_columns(
+                self.source_path(device, month), missing, meta["decimal"], self.dtype, nrows=meta["rows"]
+            )
+            # Имена столбцов могут содержать недопустимые для файлов символы -> храним по индексу
+            for col in missing:
+                if len(values[col]) != meta["rows"]:
+                    raise StaleCacheError(f"{device}/{month}")
+                tmp = f"{path}/col_{index[col]}.npy.{self._tmp_suffix()}"
+                with open(tmp, "wb") as file:
+                    np.save(file, values[col])
+                os.replace(tmp, f"{path}/col_{index[col]}.npy")
+
+    def meta(self, device, month):
+        """
+        Метаданные кеша месяца (если исходный csv изменился, собирается новая версия)
+
+        :param device: прибор
+        :param month: месяц в формате YYYY_MM
+        :return: словарь метаданных или None, если файла за этот месяц нет
+        """
+        source = self.source_path(device, month)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return None
+        path = self._version_path(device, month, stat.st_mtime_ns, stat.st_size)
+        meta = self._read_meta(path)
+        if meta is not None:
+            return meta
+        with self._key_lock((device, month)):
+            meta = self._read_meta(path)
+            if meta is not None:
+                return meta
+            return self._build(device, month, source, stat)
+
+    def load_arrays(self, device, month, columns, attempts=3):
+        """
+        Загрузка нужных столбцов месяца из кеша
+
+        :param device: прибор
+        :param month: месяц в формате YYYY_MM
+        :param columns: нужные столбцы
+        :param attempts: сколько раз перечитать метаданные, если версию кеша успели заменить
+        :return: (timestamp int64, словарь столбец -> массив) или None, если файла нет.
+        Отсутствующие в файле столбцы заполняются NaN
+        """
+        for attempt in range(attempts):
+            meta = self.meta(device, month)
+            if meta is None:
+                return None
+            path = self._version_path(device, month, meta["mtime_ns"], meta["size"])
+            try:
+                timestamps = np.load(f"{path}/timestamp.npy", mmap_mode="r")
+                index = {col: i for i, col in enumerate(meta["columns"])}
+                self._build_columns(path, device, month, meta, [col for col in columns if col in index])
+                values = {}
+                for col in columns:
+                    if col in index:
+                        values[col] = np.load(f"{path}/col_{index[col]}.npy", mmap_mode="r")
+                    else:
+                        values[col] = np.full(len(timestamps), np.nan, dtype=self.dtype)
+                return timestamps, values
+            except (FileNotFoundError, StaleCacheError):
+                # Другой процесс собрал новую версию и удалил эту, или csv перезаписан -> берем новую версию
+                if attempt == attempts - 1:
+                    raise
+
+    @staticmethod
+    def months_between(begin, end):
+        """
+        Точный список месяцев, пересекающихся с отрезком
+
+        :param begin: начало отрезка
+        :param end: конец отрезка
+        :return: список месяцев в формате YYYY_MM
+        """
+        return [
+            period.strftime("%Y_%m")
+            for period in pd.period_range(pd.Timestamp(begin).to_period("M"), pd.Timestamp(end).to_period("M"))
+        ]
+
+    def data_version(self, device, begin, end):
+        """
+        Версия данных прибора за отрезок: mtime и размер всех месячных файлов, пересекающихся с ним
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :param end: конец отрезка
+        :return: кортеж (месяц, mtime, размер) существующих файлов
+        """
+        version = []
+        for month in self.months_between(begin, end):
+            try:
+                stat = os.stat(self.source_path(device, month))
+            except FileNotFoundError:
+                continue
+            version.append((month, stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+
+    def iter_range(self, device, begin, end, columns, chunk_rows=1 << 20):
+        """
+        Выбранные столбцы прибора за отрезок [begin, end] кусками по порядку времени.
+        Месячные файлы открываются через mmap и режутся на куски не длиннее chunk_rows строк,
+        поэтому в памяти одновременно находится только один кусок, какой бы длинный ни был отрезок
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :param end: конец отрезка (включительно)
+        :param columns: нужные столбцы
+        :param chunk_rows: максимальное число строк в куске (None - месяц целиком)
+        :return: генератор (timestamp int64, словарь столбец -> массив)
+        """
+        begin_ns, end_ns = pd.Timestamp(begin).value, pd.Timestamp(end).value
+        for month in self.months_between(begin, end):
+            arrays = self.load_arrays(device, month, columns)
+            if arrays is None:
+                continue
+            timestamps, values = arrays
+            if len(timestamps) > 1 and (np.diff(timestamps) < 0).any():
+                order = np.argsort(timestamps, kind="stable")
+                timestamps = timestamps[order]
+                values = {col: values[col][order] for col in columns}
+            left = np.searchsorted(timestamps, begin_ns, side="left")
+            right = np.searchsorted(timestamps, end_ns, side="right")
+            step = chunk_rows or max(right - left, 1)
+            for start in range(left, right, step):
+                stop = min(start + step, right)
+                yield timestamps[start:stop], {col: values[col][start:stop] for col in columns}
+
+    def load_range(self, device, begin, end, columns):
+        """
+        Загрузка выбранных столбцов прибора за отрезок [begin, end].
+        Каждый месячный файл читается один раз, обрезается через searchsorted по отсортированным меткам,
+        а куски склеиваются одним np.concatenate
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :param end: конец отрезка (включительно)
+        :param columns: нужные столбцы
+        :return: (timestamp int64, словарь столбец -> массив)
+        """
+        parts_time, parts_values = [], {col: [] for col in columns}
+        for timestamps, values in self.iter_range(device, begin, end, columns, chunk_rows=None):
+            parts_time.append(timestamps)
+            for col in columns:
+                parts_values[col].append(values[col])
+        if not parts_time:
+            return np.empty(0, dtype="int64"), {col: np.empty(0, dtype=self.dtype) for col in columns}
+        return np.concatenate(parts_time), {col: np.concatenate(parts) for col, parts in parts_values.items()}
+
+
+class TimeRangeIndex:
+    """
+    Индекс временных границ данных приборов.
+    Для каждого месячного файла хранятся первая и последняя временные метки, прочитанные
+    только из начала и конца файла (без разбора всего csv). При изменении mtime или размера
+    перечитывается только изменившийся файл. Проверка папки делается не чаще, чем раз в refresh_interval секунд.
+    """
+
+    tail_bytes = 4096
+
+    def __init__(self, path_proc_data, refresh_interval=5.0):
+        """
+        :param path_proc_data: путь до папки proc_data сайта
+        :param refresh_interval: минимальный интервал (в секундах) между проверками файлов прибора
+        """
+        self.path_proc_data = path_proc_data
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # device -> {month: (mtime_ns, size, первая метка, последняя метка)}
+        self._files = {}
+        # device -> (время проверки, (первая метка, последняя метка))
+        self._ranges = {}
+
+    @staticmethod
+    def _parse_line(line, time_index):
+        return pd.Timestamp(next(csv.reader([line]))[time_index])
+
+    def _read_bounds(self, path):
+        """
+        :param path: путь до месячного csv
+        :return: (первая метка, последняя метка) или None, если в файле нет данных
+        """
+        with open(path, "rb") as file:
+            header = file.readline().decode()
+            first = file.readline().decode()
+            if not first.strip():
+                return None
+            time_index = next(csv.reader([header])).index(ProcDataCache.time_col)
+            size = file.seek(0, os.SEEK_END)
+            file.seek(max(0, size - self.tail_bytes))
+            tail = file.read().decode(errors="ignore").splitlines()
+        # Последняя строка может быть дописана не до конца -> берем последнюю разбираемую
+        for line in reversed(tail):
+            try:
+                return self._parse_line(first, time_index), self._parse_line(line, time_index)
+            except (ValueError, IndexError):
+                continue
+        return None
+
+    def _refresh(self, device):
+        """
+        Обновление индекса прибора: перечитываются только новые и изменившиеся файлы
+        """
+        path = f"{self.path_proc_data}/{device}"
+        old_files = self._files.get(device, {})
+        files = {}
+        for name in os.listdir(path):
+            if not name.endswith(".csv"):
+                continue
+            month = name.removesuffix(".csv")
+            stat = os.stat(f"{path}/{name}")
+            entry = old_files.get(month)
+            if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                bounds = self._read_bounds(f"{path}/{name}")
+                if bounds is None:
+                    continue
+                entry = (stat.st_mtime_ns, stat.st_size, *bounds)
+            files[month] = entry
+        self._files[device] = files
+        months = sorted(files)
+        bounds = (files[months[0]][2], files[months[-1]][3]) if months else None
+        self._ranges[device] = (time.monotonic(), bounds)
+        return bounds
+
+    def device_range(self, device):
+        """
+        :param device: прибор
+        :return: (первая метка, последняя метка) данных прибора или None, если данных нет
+        """
+        checked = self._ranges.get(device)
+        if checked is not None and time.monotonic() - checked[0] < self.refresh_interval:
+            return checked[1]
+        with self._lock:
+            return self._refresh(device)
+
+    def file_ranges(self, device):
+        """
+        :param device: прибор
+        :return: словарь месяц -> (первая метка, последняя метка) месячных файлов прибора
+        """
+        self.device_range(device)
+        return {month: entry[2:] for month, entry in self._files.get(device, {}).items()}
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+
+class CachedGraph:
+    """
+    Отрисованный график: png картинка и file_id фотографии, уже загруженной в Telegram
+    """
+
+    __slots__ = ("version", "png", "file_id")
+
+    def __init__(self, version, png, file_id=None):
+        self.version = version
+        self.png = png
+        self.file_id = file_id
+
+
+class GraphCache:
+    """
+    LRU кеш отрисованных графиков.
+    Ключ - (прибор, отсортированные столбцы, временной диапазон), к каждой записи привязана версия
+    данных (mtime и размер месячных файлов). Если версия изменилась, запись удаляется при обращении.
+    Размер кеша ограничен и по числу записей, и по суммарному объему картинок
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_entries: максимальное число графиков в кеше
+        :param max_bytes: максимальный суммарный объем картинок в байтах
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version, touch=True):
+        """
+        :param key: ключ графика
+        :param version: текущая версия данных
+        :param touch: учитывать обращение (LRU порядок и счетчики попаданий); False для фоновых проверок
+        :return: CachedGraph или None, если графика нет или данные изменились
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                self._drop(key)
+                entry = None
+            if not touch:
+                return entry
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, png, file_id=None):
+        """
+        Сохранение графика с вытеснением самых старых записей
+
+        :param key: ключ графика
+        :param version: версия данных, по которым нарисован график
+        :param png: байты картинки
+        :param file_id: file_id фотографии в Telegram
+        :return: CachedGraph
+        """
+        entry = CachedGraph(version, png, file_id)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += len(png)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))
+        return entry
+
+    def _drop(self, key):
+        self._bytes -= len(self._entries.pop(key).png)
@@ -0,0 +1,295 @@
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from data_cache import ProcDataCache
+from metrics import registry
+
+
+class DeviceWindow:
+    """
+    Последние дни данных одного прибора в заранее выделенных массивах.
+    Строки лежат подряд в [0, rows): новые дописываются в конец, а устаревшие сдвигаются
+    к началу только когда место кончилось, поэтому срез по времени - это два searchsorted
+    """
+
+    def __init__(self, capacity, coverage_start, dtype):
+        """
+        :param capacity: начальная вместимость в строках
+        :param coverage_start: с какого момента (нс) окно содержит все данные прибора
+        :param dtype: тип значений
+        """
+        self.lock = threading.Lock()
+        self.columns = {}
+        self.timestamps = np.empty(capacity, dtype="int64")
+        self.values = np.empty((0, capacity), dtype=dtype)
+        self.rows = 0
+        self.coverage_start = coverage_start
+        # месяц -> (inode, смещение в байтах до конца последней прочитанной строки, заголовок, формат чисел)
+        self.files = {}
+
+    @property
+    def capacity(self):
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+    def add_columns(self, columns):
+        new = [col for col in columns if col not in self.columns]
+        if not new:
+            return
+        for col in new:
+            self.columns[col] = len(self.columns)
+        # Для уже прочитанных строк новых столбцов не было -> NaN
+        extra = np.full((len(new), self.capacity), np.nan, dtype=self.values.dtype)
+        self.values = np.vstack([self.values, extra])
+
+    def resize(self, capacity):
+        timestamps = np.empty(capacity, dtype="int64")
+        values = np.full((len(self.columns), capacity), np.nan, dtype=self.values.dtype)
+        timestamps[:self.rows] = self.timestamps[:self.rows]
+        values[:, :self.rows] = self.values[:, :self.rows]
+        self.timestamps, self.values = timestamps, values
+
+    def version(self):
+        """
+        :return: версия прочитанных данных: месячные файлы и смещения, до которых они дочитаны
+        """
+        return ("hot",) + tuple(sorted((month, entry[0], entry[1]) for month, entry in self.files.items()))
+
+    def drop_before(self, index):
+        """
+        Сдвиг строк [index, rows) в начало массивов
+        """
+        if index <= 0:
+            return
+        left = self.rows - index
+        self.timestamps[:left] = self.timestamps[index:self.rows]
+        self.values[:, :left] = self.values[:, index:self.rows]
+        self.rows = left
+
+
+class HotWindow:
+    """
+    Горячее окно: последние window_days дней каждого прибора в памяти.
+    Фоновый поток дочитывает месячные csv сайта с сохраненного смещения в байтах и разбирает
+    только новые строки, поэтому графики за стандартные промежутки строятся без чтения файлов.
+    Объем ограничен max_bytes на все приборы: если окно не помещается, отбрасываются
+    самые старые строки, и графики за более ранние даты идут через обычный кеш данных
+    """
+
+    def __init__(
+        self, path_proc_data, window_days=32, max_bytes=256 * 1024 * 1024, poll_interval=30.0, dtype="float32"
+    ):
+        """
+        :param path_proc_data: путь до папки proc_data сайта
+        :param window_days: сколько последних дней держать в памяти
+        :param max_bytes: ограничение суммарного объема массивов всех приборов
+        :param poll_interval: период дочитывания файлов в секундах
+        :param dtype: тип значений: "float32" или "float64"
+        """
+        self.path_proc_data = path_proc_data
+        self.window_ns = pd.Timedelta(days=window_days).value
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, list_devices):
+        """
+        Запуск фонового потока дочитывания
+
+        :param list_devices: функция без аргументов, возвращающая текущий список приборов
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(list_devices,), name="hot-window", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, list_devices):
+        while True:
+            self.poll(list_devices())
+            logging.info(f"Hot window: {self.memory_usage() / 2 ** 20:.1f} MiB for {len(self._devices)} devices")
+            if self._stop.wait(self.poll_interval):
+                return
+
+    def poll(self, devices):
+        """
+        Одно дочитывание новых строк всех приборов
+
+        :param devices: список приборов
+        """
+        for device in devices:
+            try:
+                with registry.timer("bot_hot_window_ingest_seconds"):
+                    self.ingest(device)
+            except Exception as e:
+                logging.warning(f"Hot window: ошибка чтения {device}: {e.__class__.__name__}: {e}")
+        with self._lock:
+            for device in set(self._devices) - set(devices):
+                del self._devices[device]
+
+    def memory_usage(self):
+        """
+        :return: суммарный объем массивов окна в байтах
+        """
+        with self._lock:
+            windows = list(self._devices.values())
+        return sum(window.nbytes for window in windows)
+
+    def _months(self, now_ns):
+        """
+        Месяцы, пересекающиеся с окном, от старого к новому
+        """
+        return ProcDataCache.months_between(
+            pd.Timestamp(now_ns - self.window_ns), pd.Timestamp(now_ns)
+        )
+
+    def ingest(self, device):
+        """
+        Дочитывание новых строк месячных файлов прибора
+
+        :param device: прибор
+        """
+        now_ns = pd.Timestamp.now().value
+        months = self._months(now_ns)
+        with self._lock:
+            window = self._devices.get(device)
+            if window is None:
+                window = DeviceWindow(
+                    1024, pd.Period(months[0].replace("_", "-"), "M").start_time.value, self.dtype
+                )
+                self._devices[device] = window
+        with window.lock:
+            if not all([self._ingest_file(window, device, month) for month in months]):
+                # Файл перезаписан целиком -> прочитанные строки могли измениться, читаю окно заново
+                window.rows = 0
+                window.files.clear()
+                window.coverage_start = pd.Period(months[0].replace("_", "-"), "M").start_time.value
+                for month in months:
+                    self._ingest_file(window, device, month)
+            for month in set(window.files) - set(months):
+                del window.files[month]
+            # Выселение по времени считаем от текущего момента: окно нужно для промежутков от "сейчас"
+            cutoff = now_ns - self.window_ns
+            if window.coverage_start < cutoff:
+                window.drop_before(int(np.searchsorted(window.timestamps[:window.rows], cutoff, side="left")))
+                window.coverage_start = cutoff
+
+    def _ingest_file(self, window, device, month):
+        """
+        Дочитывание одного месячного файла с сохраненного смещения
+
+        :return: False, если файл был перезаписан и окно нужно прочитать заново
+        """
+        path = f"{self.path_proc_data}/{device}/{month}.csv"
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        inode, offset, header, decimal = window.files.get(month, (None, 0, None, None))
+        if inode is not None and (inode != stat.st_ino or stat.st_size < offset):
+            return False
+        if stat.st_size == offset:
+            return True
+        tail = ProcDataCache.read_tail(path, offset, stat.st_size, header, decimal, self.dtype)
+        if tail is None:
+            return True
+        offset, header, decimal, timestamps, values = tail
+        window.files[month] = (stat.st_ino, offset, header, decimal)
+        if len(timestamps):
+            self._append(window, timestamps, values)
+        return True
+
+    def _append(self, window, timestamps, values):
+        window.add_columns(list(values))
+        count = len(timestamps)
+        if window.rows + count > window.capacity:
+            cutoff = max(window.coverage_start, pd.Timestamp.now().value - self.window_ns)
+            window.drop_before(int(np.searchsorted(window.timestamps[:window.rows], cutoff, side="left")))
+        if window.rows + count > window.capacity:
+            needed = window.rows + count
+            capacity = max(window.capacity * 2, needed)
+            row_bytes = 8 + window.values.itemsize * len(window.columns)
+            others = self.memory_usage() - window.nbytes
+            capacity = min(capacity, max((self.max_bytes - others) // row_bytes, window.capacity))
+            if capacity > window.capacity:
+                window.resize(capacity)
+            if needed > window.capacity:
+                # Лимит памяти: отбрасываю самые старые строки, окно начинается позже
+                drop = min(needed - window.capacity, window.rows)
+                window.drop_before(drop)
+                if window.rows:
+                    window.coverage_start = int(window.timestamps[0])
+                if count > window.capacity:
+                    timestamps = timestamps[-window.capacity:]
+                    values = {col: series[-window.capacity:] for col, series in values.items()}
+                    count = window.capacity
+                    window.coverage_start = int(timestamps[0])
+        start = window.rows
+        window.timestamps[start:start + count] = timestamps
+        window.values[:, start:start + count] = np.nan
+        for col, series in values.items():
+            window.values[window.columns[col], start:start + count] = series
+        window.rows += count
+
+    def version(self, device, begin):
+        """
+        Версия данных окна прибора без чтения файлов: окно дочитывает только фоновый поток,
+        поэтому картинку по данным окна можно кешировать под этой версией
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :return: версия (см. DeviceWindow.version) или None, если отрезок не помещается в окно
+        """
+        with self._lock:
+            window = self._devices.get(device)
+        if window is None:
+            return None
+        with window.lock:
+            if not window.files or window.coverage_start > pd.Timestamp(begin).value:
+                return None
+            return window.version()
+
+    def load_range(self, device, begin, end, columns):
+        """
+        Срез окна прибора по времени
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :param end: конец отрезка (включительно)
+        :param columns: нужные столбцы
+        :return: (timestamp, словарь столбец -> значения, версия окна на момент среза)
+            или None, если отрезок не помещается в окно
+        """
+        with self._lock:
+            window = self._devices.get(device)
+        if window is None:
+            return None
+        begin_ns, end_ns = pd.Timestamp(begin).value, pd.Timestamp(end).value
+        with window.lock:
+            if not window.files or window.coverage_start > begin_ns:
+                return None
+            timestamps = window.timestamps[:window.rows]
+            left = np.searchsorted(timestamps, begin_ns, side="left")
+            right = np.searchsorted(timestamps, end_ns, side="right")
+            values = {}
+            for col in columns:
+                if col in window.columns:
+                    values[col] = window.values[window.columns[col], left:right].copy()
+                else:
+                    values[col] = np.full(right - left, np.nan, dtype=self.dtype)
+            return timestamps[left:right].copy(), values, window.version()
@@ -1,76 +1,88 @@
+import time
+
+# Замер запуска начинается до импорта остальных модулей
+startup_start = time.perf_counter()
 import config
 import telebot
 from telebot import types
-from yadisk import YaDisk
-from dotenv import load_dotenv
 import logging
-import os
-import json
-import sqlite3
+import signal
+import threading
+import io
 import pandas as pd
+from functools import partial
 from datetime import timedelta, datetime
 from telebot.types import CallbackQuery
-import plotly.express as px
-from matplotlib import pyplot as plt
-
+from catalog import Catalog
+from sessions import SessionStore
+from data_cache import NoDataError, ProcDataCache, TimeRangeIndex
+from render import make_renderer
+from graph_cache import GraphCache
+from workers import GraphJobs, memory_data, render_complex_job, render_job, summary_job
+from hot_window import HotWindow
+from rollups import RollupStore
+from metrics import StartupPhases, registry as metrics
+from routing import Router
+from subscriptions import SubscriptionScheduler
+from outbox import Outbox
+from prerender import QuickAccessPrerenderer
+from summary import format_summary, summarize
+
+# Этапы запуска: время каждого уходит в сообщение "Bot started"
+startup = StartupPhases(startup_start)
+startup.mark("imports")
 # Основные константы
-bot = telebot.TeleBot(config.token)
 path_to_site = "../MSU_aerosol_site"
 path_db = f"{path_to_site}/msu_aerosol/database.db"
-load_dotenv(f"{path_to_site}/.env")
-yadisk_token = os.getenv("YADISK_TOKEN", default="FAKE_TOKEN")
-disk = YaDisk(token=yadisk_token)
-logging.basicConfig(filename="info.log")
-
-
-def upload_json(path, to_save):
-    """
-    Функция для выгрузки данных в json
-
-    :param path: Путь для выгрузки
-    :param to_save: Данные для выгрузки
-    :return: None
-    """
-    with open(path, "w") as outfile:
-        json.dump(to_save, outfile)
-
-
-def load_json(path):
-    """
-    Функция для загрузки данных в json
-
-    :param path: Путь для загрузки
-    :return: json файл
-    """
-    with open(path, "r") as file:
-        return json.load(file)
+catalog = Catalog(path_db)
+# Текст кнопки -> обработчик (один обработчик telebot route вместо фильтров на каждую кнопку)
+router = Router(catalog)
+# Тип значений в памяти: float32 вдвое экономнее, float64 - по желанию
+data_dtype = getattr(config, "data_dtype", "float32")
+proc_data = ProcDataCache(f"{path_to_site}/msu_aerosol/proc_data", "data_cache", data_dtype)
+time_ranges = TimeRangeIndex(f"{path_to_site}/msu_aerosol/proc_data")
+# Примерное число точек на столбец после прореживания (0 - рисовать все точки)
+graph_point_budget = getattr(config, "graph_point_budget", 4000)
+# Бэкенд отрисовки графиков: plotly (kaleido) или matplotlib (быстрее, без внешнего процесса)
+graph_renderer = getattr(config, "graph_renderer", "plotly")
+make_renderer(graph_renderer)  # проверка имени бэкенда до запуска
+# Кеш отрисованных графиков
+graph_cache = GraphCache()
+# Сколько секунд собираются нажатия на кнопки столбцов перед обновлением клавиатуры
+keyboard_debounce = getattr(config, "keyboard_debounce", 0.3)
+# Метрики обработчиков и этапов построения графиков (команда /metrics для администраторов)
+metrics.enabled = getattr(config, "metrics_enabled", True)
+admin_ids = set(getattr(config, "admin_ids", []))
+# Бот, очередь отправки, сессии, пул построения, горячее окно и фоновые планировщики создает setup().
+# При импорте их создавать нельзя: процессы пула (spawn) заново импортируют главный модуль,
+# и в каждом из них появились бы свои потоки, бот и соединение с базой сессий
+bot = None
+outbox = None
+sessions = None
+graph_jobs = None
+hot_window = None
+rollups = None
+subscription_scheduler = None
+quick_access_prerenderer = None
 
 
 def execute_query(query: str, method="fetchall"):
     """
-    Функция для упрощения обращения к базе данных приборов и графиков
+    Функция для упрощения обращения к базе данных приборов и графиков.
+    Запрос выполняется через общее долгоживущее соединение каталога
 
     :param query: запрос
     :param method: тип метода fetchall или fetchone
     :return: значение по запросу
     """
-    conn = sqlite3.connect(path_db)
-    cursor = conn.cursor()
-    if method == "fetchall":
-        value = cursor.execute(query).fetchall()
-    else:
-        value = cursor.execute(query).fetchone()
-    conn.close()
-    return value
+    return catalog.execute(query, method=method)
 
 
 def make_list_short_name_devices():
     """
     :return: список имен приборов, которые отображаются на сайте
     """
-    return list(
-        map(lambda x: x[0], execute_query("SELECT name FROM devices WHERE show=TRUE"))
-    )
+    return catalog.list_devices()
 
 
 def short_name_to_full_name_device(short_name):
@@ -78,17 +90,17 @@ def short_name_to_full_name_device(short_name):
     :param short_name: короткое имя прибора
     :return: имя прибора по короткому имени прибора
     """
-    return execute_query(
-        f'SELECT name FROM devices WHERE name="{short_name}"',
-        method="fetchone",
-    )[0]
+    catalog.refresh()
+    if short_name not in catalog.device_ids:
+        raise KeyError(short_name)
+    return short_name
 
 
 def make_list_complexes():
     """
     :return: список всех комплексов
     """
-    return list(map(lambda x: x[0], execute_query("SELECT name FROM complexes")))
+    return catalog.list_complexes()
 
 
 def get_devices_from_complex(complex_name):
@@ -96,69 +108,7 @@ def get_devices_from_complex(complex_name):
     :param complex_name: имя комплекса
     :return: список используемых приборов в комплексе
     """
-    complex_id = execute_query(
-        f'SELECT id FROM complexes WHERE name = "{complex_name}"',
-        method="fetchone",
-    )[0]
-    return list(
-        map(
-            lambda x: x[0],
-            execute_query(
-                f'SELECT name FROM devices WHERE show=1 AND complex_id="{complex_id}"'
-            ),
-        )
-    )
-
-
-def make_list_cols(device_name):
-    """
-    :param device_name: имя прибора
-    :return: список столбцов используемых в приборе
-    """
-    device_id = execute_query(
-        f'SELECT id FROM devices WHERE name = "{device_name}"', method="fetchone"
-    )[0]
-    graph_ids = list(
-        map(
-            lambda x: x[0],
-            execute_query(f'SELECT id FROM graphs WHERE device_id = "{device_id}"'),
-        )
-    )
-    graph_ids_str = ", ".join(f'"{graph_id}"' for graph_id in graph_ids)
-    return list(
-        set(
-            list(
-                map(
-                    lambda x: x[0],
-                    execute_query(
-                        f"SELECT name FROM columns WHERE graph_id IN ({graph_ids_str}) AND use=1"
-                    ),
-                )
-            )
-        )
-    )
-
-
-def get_color(col, device_name):
-    """
-    :param col: столбец
-    :param device_name: прибор
-    :return: цвет столбца в данном приборе
-    """
-    device_id = execute_query(
-        f'SELECT id FROM devices WHERE name = "{device_name}"', method="fetchone"
-    )[0]
-    graph_ids = list(
-        map(
-            lambda x: x[0],
-            execute_query(f'SELECT id FROM graphs WHERE device_id = "{device_id}"'),
-        )
-    )
-    graph_ids_str = ", ".join(f'"{graph_id}"' for graph_id in graph_ids)
-    return execute_query(
-        f'SELECT color FROM columns WHERE name = "{col}" AND graph_id IN ({graph_ids_str})',
-        method="fetchone",
-    )[0]
+    return catalog.devices_of_complex(complex_name)
 
 
 def exception_decorator(func):
@@ -168,20 +118,21 @@ def exception_decorator(func):
 
     def wrapper(message):
         try:
-            return func(message)
+            with metrics.timer("bot_handler_seconds", handler=func.__name__):
+                return func(message)
         except Exception as e:
             user_id = message if isinstance(message, int) else message.from_user.id
             name_func = func.__name__
+            metrics.inc("bot_handler_errors_total", handler=name_func)
             logging.warning(
                 f"Непредвиденная ошибка: {e.__class__.__name__} в {name_func}"
             )
-            bot.send_message(user_id, f"Непредвиденная ошибка в {name_func}")
+            outbox.send_message(user_id, f"Непредвиденная ошибка в {name_func}")
             start(user_id, error_f=True)
 
     return wrapper
 
 
-@bot.message_handler(commands=["start"])
 def start(message, error_f=False):
     """
     После запуска бота появляется вывод этой функции (далее экран).
@@ -192,24 +143,34 @@ def start(message, error_f=False):
     :param error_f: флаг откуда была вызвана функция (стандартно (через ТГ) или при ошибке (через exception_decorator))
     """
     user_id = message if error_f else str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
     # Обнуление параметров пользователя при крупной ошибке
-    if user_id not in user_info_open.keys() or error_f:
-        user_info_open[user_id] = {}
+    if user_id not in sessions or error_f:
+        sessions[user_id] = {}
     # Задание стартовых параметров пользователя
-    user_info_open[user_id]["update_quick_access"] = False
     # Параметры выбранных столбцов сохраняются
-    # user_info_open[user_id].pop("selected_columns", None)
-    user_info_open[user_id]["device_to_choose"] = []
-    upload_json("user_info.json", user_info_open)
+    sessions.update(user_id, update_quick_access=False, device_to_choose=[], complex=None)
     # Создание кнопок действий
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add(types.KeyboardButton("Просмотр данных с приборов"))
     markup.add(types.KeyboardButton("Быстрый доступ"))
-    bot.send_message(user_id, text=f"Начните работу с приборами", reply_markup=markup)
+    markup.add(types.KeyboardButton("Подписки"))
+    outbox.send_message(user_id, text=f"Начните работу с приборами", reply_markup=markup)
+
+
+@exception_decorator
+def send_metrics(message):
+    """
+    Выгрузка метрик бота в формате Prometheus (только для config.admin_ids)
+    """
+    if not metrics.enabled:
+        outbox.send_message(message.chat.id, "Метрики отключены (metrics_enabled=False)")
+        return
+    dump = io.BytesIO(metrics.render().encode())
+    dump.name = "metrics.txt"
+    outbox.send_document(message.chat.id, dump)
 
 
-@bot.message_handler(func=lambda message: message.text == "Быстрый доступ")
+@router.text("Быстрый доступ")
 @exception_decorator
 def quick_access(message):
     """
@@ -221,14 +182,13 @@ def quick_access(message):
     user_id = str(message.from_user.id)
     markup = types.ReplyKeyboardMarkup(row_width=1)
     markup.add("Настроить быстрый доступ")
-    user_info_open = load_json("user_info.json")
     # Если пользователь уже настроил быстрый доступ
-    if "quick_access" in user_info_open[user_id].keys():
+    if "quick_access" in sessions[user_id].keys():
         markup.add("Отрисовка графика")
-    bot.send_message(message.chat.id, "Выберите действие", reply_markup=markup)
+    outbox.send_message(message.chat.id, "Выберите действие", reply_markup=markup)
 
 
-@bot.message_handler(func=lambda message: message.text == "Отрисовка графика")
+@router.text("Отрисовка графика")
 @exception_decorator
 def logic_draw_plot(message):
     """
@@ -239,7 +199,7 @@ def logic_draw_plot(message):
     make_graph(message)
 
 
-@bot.message_handler(func=lambda message: message.text == "Настроить быстрый доступ")
+@router.text("Настроить быстрый доступ")
 @exception_decorator
 def update_quick_access(message):
     """
@@ -248,13 +208,11 @@ def update_quick_access(message):
     update_quick_access("Настроить быстрый доступ") -> choice_devices_or_complexes("Просмотр данных с приборов")
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    user_info_open[user_id]["update_quick_access"] = True
-    upload_json("user_info.json", user_info_open)
+    sessions.update(user_id, update_quick_access=True)
     choice_devices_or_complexes(message)
 
 
-@bot.message_handler(func=lambda message: message.text == "Просмотр данных с приборов")
+@router.text("Просмотр данных с приборов")
 @exception_decorator
 def choice_devices_or_complexes(message):
     """
@@ -266,12 +224,12 @@ def choice_devices_or_complexes(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add(types.KeyboardButton("Просмотр всех приборов"))
     markup.add(types.KeyboardButton("Просмотр приборов по комплексам"))
-    bot.send_message(
+    outbox.send_message(
         message.chat.id, text=f"Каким образом выбрать прибор?", reply_markup=markup
     )
 
 
-@bot.message_handler(func=lambda message: message.text == "Просмотр всех приборов")
+@router.text("Просмотр всех приборов")
 @exception_decorator
 def all_devices(message):
     """
@@ -280,46 +238,42 @@ def all_devices(message):
     all_devices("Просмотр всех приборов") -> choose_device(один из доступных приборов)
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    # Если пользователь выбирал комплекс, то user_info_open[user_id]["device_to_choose"] уже не пустой
-    if not user_info_open[user_id]["device_to_choose"]:
-        user_info_open[user_id]["device_to_choose"] = make_list_short_name_devices()
-        upload_json("user_info.json", user_info_open)
+    user_info = sessions[user_id]
+    # Если пользователь выбирал комплекс, то user_info["device_to_choose"] уже не пустой
+    if not user_info["device_to_choose"]:
+        user_info = sessions.update(user_id, device_to_choose=list(make_list_short_name_devices()), complex=None)
     # Создание кнопок на которых показаны все приборы, доступные пользователю
     markup = types.ReplyKeyboardMarkup(row_width=1)
+    # График всего комплекса не сохраняется в быстрый доступ -> при его настройке кнопки нет
+    if user_info.get("complex") and not user_info["update_quick_access"]:
+        markup.add(types.KeyboardButton("Весь комплекс"))
     markup.add(
         *list(
             map(
                 lambda x: types.KeyboardButton(x),
-                user_info_open[user_id]["device_to_choose"],
+                user_info["device_to_choose"],
             )
         )
     )
-    bot.send_message(message.chat.id, "Выберите прибор", reply_markup=markup)
+    outbox.send_message(message.chat.id, "Выберите прибор", reply_markup=markup)
 
 
-@bot.message_handler(
-    func=lambda message: message.text in make_list_short_name_devices()
-)
+@router.names(lambda: catalog.devices)
 @exception_decorator
 def choose_device(message):
     """
     Если пользователь выбрал один из приборов в all_devices, то он попал сюда.
-    Здесь происходит запись этого прибора в user_info.json
+    Здесь происходит запись этого прибора в параметры пользователя
     choose_device(один из доступных приборов) -> choose_time_delay
     """
     # Здесь есть if, тк. choose_device вызывается так же из make_graph_again_ind, где device уже выбран
-    if message.text in make_list_short_name_devices():
+    if catalog.is_device(message.text):
         user_id = str(message.from_user.id)
-        user_info_open = load_json("user_info.json")
-        user_info_open[user_id]["device"] = short_name_to_full_name_device(message.text)
-        upload_json("user_info.json", user_info_open)
+        sessions.update(user_id, device=short_name_to_full_name_device(message.text), complex_graph=False)
     choose_time_delay(message)
 
 
-@bot.message_handler(
-    func=lambda message: message.text == "Просмотр приборов по комплексам"
-)
+@router.text("Просмотр приборов по комплексам")
 @exception_decorator
 def all_complexes(message):
     """
@@ -329,10 +283,10 @@ def all_complexes(message):
     """
     markup = types.ReplyKeyboardMarkup(row_width=1)
     markup.add(*list(map(lambda x: types.KeyboardButton(x), make_list_complexes())))
-    bot.send_message(message.chat.id, "Выберите комплекс", reply_markup=markup)
+    outbox.send_message(message.chat.id, "Выберите комплекс", reply_markup=markup)
 
 
-@bot.message_handler(func=lambda message: message.text in make_list_complexes())
+@router.names(lambda: catalog.complexes)
 @exception_decorator
 def choose_one_complex(message):
     """
@@ -341,12 +295,27 @@ def choose_one_complex(message):
     choose_one_complex(один из доступных комплексов) -> all_devices(Один из доступных приборов)
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    user_info_open[user_id]["device_to_choose"] = get_devices_from_complex(message.text)
-    upload_json("user_info.json", user_info_open)
+    sessions.update(user_id, device_to_choose=get_devices_from_complex(message.text), complex=message.text)
     all_devices(message)
 
 
+@router.text("Весь комплекс")
+@exception_decorator
+def choose_whole_complex(message):
+    """
+    Если пользователь нажал "Весь комплекс" в all_devices после выбора комплекса, то попал сюда.
+    Дальше строится один график со всеми приборами комплекса
+    choose_whole_complex("Весь комплекс") -> choose_time_delay
+    """
+    user_id = str(message.from_user.id)
+    sessions.update(user_id, complex_graph=True)
+    choose_time_delay(message)
+
+
+# Стандартные промежутки: текст кнопки -> число дней
+standard_delays = {"2 дня": 2, "7 дней": 7, "14 дней": 14, "31 день": 31}
+
+
 def choose_time_delay(message):
     """
     После выбора прибора пользователь попадает сюда.
@@ -356,33 +325,30 @@ def choose_time_delay(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add(types.KeyboardButton("2 дня"), types.KeyboardButton("7 дней"))
     markup.add(types.KeyboardButton("14 дней"), types.KeyboardButton("31 день"))
-    markup.add(types.KeyboardButton("Свой временной промежуток"))
-    bot.send_message(
+    # Свой промежуток проверяется по границам данных одного прибора -> для комплекса только стандартные
+    if not sessions[str(message.from_user.id)].get("complex_graph"):
+        markup.add(types.KeyboardButton("Свой временной промежуток"))
+    outbox.send_message(
         message.chat.id, "Выберите временной промежуток", reply_markup=markup
     )
 
 
-@bot.message_handler(
-    func=lambda message: message.text in ["2 дня", "7 дней", "14 дней", "31 день"]
-)
+@router.text(*standard_delays)
 @exception_decorator
 def get_delay(message):
     """
     Если пользователь выбрал стандартные промежутки ("2 дня", "7 дней", "14 дней", "31 день"), то попал сюда.
     Здесь пользователь выбирает какой стандартный промежуток он хочет
-    get_delay(2, 7, 14, 31 день) -> choose_columns
+    get_delay(2, 7, 14, 31 день) -> choose_columns / make_complex_graph (если выбран весь комплекс)
     """
     user_id = str(message.from_user.id)
-    delay = (
-        2
-        if message.text == "2 дня"
-        else 7 if message.text == "7 дней" else 14 if message.text == "14 дней" else 31
-    )
-    user_info_open = load_json("user_info.json")
+    delay = standard_delays[message.text]
     # НЕ тривиально: delay может быть int(стандартный диапазон), а может быть tuple(НЕ стандартный)
-    user_info_open[user_id]["delay"] = delay
-    upload_json("user_info.json", user_info_open)
-    choose_columns(message)
+    user_info = sessions.update(user_id, delay=delay)
+    if user_info.get("complex_graph"):
+        make_complex_graph(message)
+    else:
+        choose_columns(message)
 
 
 def make_range(device):
@@ -390,22 +356,56 @@ def make_range(device):
     Нужна для поиска временных границ прибора
     :param device: прибор
     :return: Начало и конец временного отрезка
+    :raise NoDataError: если у прибора нет данных
     """
-    list_files = os.listdir(f"{path_to_site}/msu_aerosol/proc_data/{device}")
-    last_record_date = pd.to_datetime(
-        pd.read_csv(f"{path_to_site}/msu_aerosol/proc_data/{device}/{max(list_files)}")[
-            "timestamp"
-        ].iloc[-1]
-    )
-    first_record_date = pd.to_datetime(
-        pd.read_csv(f"{path_to_site}/msu_aerosol/proc_data/{device}/{min(list_files)}")[
-            "timestamp"
-        ].iloc[0]
-    )
-    return first_record_date, last_record_date
+    record_range = time_ranges.device_range(device)
+    if record_range is None:
+        raise NoDataError(device)
+    return record_range
 
 
-@bot.message_handler(func=lambda message: message.text == "Свой временной промежуток")
+def no_device_data(message):
+    """
+    Сообщение о приборе без данных и возврат к выбору прибора
+    """
+    outbox.send_message(message.chat.id, "Нет данных по прибору")
+    all_devices(message)
+
+
+def set_begin_record_date(user_id, text):
+    """
+    Проверка и сохранение даты начала НЕ стандартного промежутка
+    :param user_id: id пользователя
+    :param text: введенная дата в формате 'день.месяц.год'
+    :raise ValueError: если дата некорректна или вне границ данных прибора
+    :raise NoDataError: если у прибора нет данных
+    """
+    user_info = sessions[user_id]
+    first_record_date, last_record_date = make_range(user_info["device"])
+    begin_record_date = datetime.strptime(text, "%d.%m.%Y").date()
+    if not last_record_date.date() >= begin_record_date >= first_record_date.date():
+        raise ValueError
+    sessions.update(user_id, delay=[str(begin_record_date)])
+
+
+def set_end_record_date(user_id, text):
+    """
+    Проверка и сохранение даты конца НЕ стандартного промежутка
+    :param user_id: id пользователя
+    :param text: введенная дата в формате 'день.месяц.год'
+    :raise ValueError: если дата некорректна, раньше начала или позже конца данных прибора
+    :raise NoDataError: если у прибора нет данных
+    """
+    user_info = sessions[user_id]
+    first_record_date, last_record_date = make_range(user_info["device"])
+    end_record_date = datetime.strptime(text, "%d.%m.%Y").date()
+    start_date = pd.to_datetime(user_info["delay"][0]).date()
+    if not (last_record_date.date() >= end_record_date >= start_date):
+        raise ValueError
+    sessions.update(user_id, delay=[str(start_date), str(end_record_date)])
+
+
+@router.text("Свой временной промежуток")
 @exception_decorator
 def choose_not_default_start_date(message):
     """
@@ -414,21 +414,23 @@ def choose_not_default_start_date(message):
     choose_not_default_start_date("Свой временной промежуток") -> begin_record_date_choose
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    user_info_open = user_info_open[user_id]
-    device = user_info_open["device"]
-    first_record_date, last_record_date = make_range(device)
+    device = sessions[user_id]["device"]
+    try:
+        first_record_date, last_record_date = make_range(device)
+    except NoDataError:
+        no_device_data(message)
+        return
     first_record_date = first_record_date.strftime("%d.%m.%Y")
     last_record_date = last_record_date.strftime("%d.%m.%Y")
-    bot.send_message(
+    outbox.send_message(
         message.chat.id, f"Данные доступны с {first_record_date} по {last_record_date}"
     )
-    msg = bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "Дата начала отрезка данных (в формате 'день.месяц.год')",
         reply_markup=types.ReplyKeyboardRemove(),
     )
-    bot.register_next_step_handler(msg, begin_record_date_choose)
+    bot.register_next_step_handler_by_chat_id(message.chat.id, begin_record_date_choose)
 
 
 def begin_record_date_choose(message):
@@ -438,18 +440,13 @@ def begin_record_date_choose(message):
     begin_record_date_choose -> choose_not_default_finish_date
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    device = user_info_open[user_id]["device"]
-    first_record_date, last_record_date = make_range(device)
     try:  # Проверяем правильность ввода
-        begin_record_date = datetime.strptime(message.text, "%d.%m.%Y").date()
-        if not last_record_date.date() >= begin_record_date >= first_record_date.date():
-            raise ValueError
-        user_info_open[user_id]["delay"] = [str(begin_record_date)]
-        upload_json("user_info.json", user_info_open)
+        set_begin_record_date(user_id, message.text)
         choose_not_default_finish_date(message)
+    except NoDataError:  # Данные прибора пропали, пока пользователь вводил дату
+        no_device_data(message)
     except ValueError:  # При ошибке пользователь вводит дату заново
-        bot.send_message(message.chat.id, "Введена некорректная дата")
+        outbox.send_message(message.chat.id, "Введена некорректная дата")
         choose_not_default_start_date(message)
 
 
@@ -459,11 +456,11 @@ def choose_not_default_finish_date(message):
     Здесь выводится информация о дате конца отрезка.
     choose_not_default_finish_date -> end_record_date_choose
     """
-    msg = bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "Дата конца отрезка данных (в формате 'день.месяц.год')",
     )
-    bot.register_next_step_handler(msg, end_record_date_choose)
+    bot.register_next_step_handler_by_chat_id(message.chat.id, end_record_date_choose)
 
 
 def end_record_date_choose(message):
@@ -472,44 +469,96 @@ def end_record_date_choose(message):
     Функция для ввода и проверки конечной даты отрезка.
     """
     user_id = str(message.from_user.id)
-    user_info_open = load_json("user_info.json")
-    device = user_info_open[user_id]["device"]
-    first_record_date, last_record_date = make_range(device)
     try:
-        end_record_date = datetime.strptime(message.text, "%d.%m.%Y").date()
-
-        start_date = pd.to_datetime(user_info_open[user_id]["delay"][0]).date()
-        if not (last_record_date.date() >= end_record_date >= start_date):
-            raise ValueError
-        user_info_open[user_id]["delay"] = [str(start_date), str(end_record_date)]
-        upload_json("user_info.json", user_info_open)
+        set_end_record_date(user_id, message.text)
         choose_columns(message)
+    except NoDataError:
+        no_device_data(message)
     except ValueError:
-        bot.send_message(message.chat.id, "Введена некорректная дата")
+        outbox.send_message(message.chat.id, "Введена некорректная дата")
         choose_not_default_finish_date(message)
 
 
-def draw_inline_keyboard(selected_device_columns, ava_col):
+def draw_inline_keyboard(selected_device_columns, device_meta):
     """
     Функция вызывается из choose_columns, когда надо вывести кнопки с ✔️/❌ в зависимости от выбора пользователя
     :param selected_device_columns: выбранные столбцы
-    :param ava_col: доступные столбцы
+    :param device_meta: метаданные прибора (DeviceMeta) с доступными столбцами
     :return: "приукрашенные" кнопки
     """
+    selected_device_columns = set(selected_device_columns)
     markup = types.InlineKeyboardMarkup(row_width=1)
-    for i in ava_col:
+    for index, i in enumerate(device_meta.buttons):
         emoji = " ✔️" if i in selected_device_columns else " ❌"
         markup.add(
             types.InlineKeyboardButton(
                 str(i) + emoji,
-                callback_data=f"feature_{str(i)}",
+                callback_data=column_callback(device_meta, index),
             )
         )
-    markup.add(types.InlineKeyboardButton("Построить график", callback_data="next"))
+    markup.row(
+        types.InlineKeyboardButton("Построить график", callback_data="next"),
+        types.InlineKeyboardButton("Сводка", callback_data="summary"),
+    )
     return markup
 
 
-@bot.callback_query_handler(func=lambda call: True)
+def column_callback(device_meta, index):
+    """
+    callback_data кнопки столбца: "c_<отпечаток списка столбцов>_<номер столбца>".
+    Имя столбца в callback_data не кладется: длинные имена не влезают в 64 байта Telegram
+    :param device_meta: метаданные прибора
+    :param index: номер столбца в device_meta.buttons
+    :return: callback_data
+    """
+    return f"c_{device_meta.digest}_{index}"
+
+
+def parse_column_callback(device_meta, data):
+    """
+    :param device_meta: метаданные прибора
+    :param data: callback_data кнопки столбца (column_callback или старый формат "feature_<столбец>")
+    :return: столбец или None, если кнопка от клавиатуры с другим списком столбцов
+    """
+    if data.startswith("feature_"):
+        column = data[len("feature_"):]
+        return column if column in device_meta.use else None
+    _, digest, index = data.split("_")
+    if digest != device_meta.digest or not index.isdigit() or int(index) >= len(device_meta.buttons):
+        return None
+    return device_meta.buttons[int(index)]
+
+
+def init_selected_columns(user_id, device):
+    """
+    :param user_id: id пользователя
+    :param device: прибор
+    :return: выбранные пользователем столбцы прибора (пустой список, если прибор выбран впервые)
+    """
+    with sessions.edit(user_id) as user_info:
+        selected_columns = user_info.setdefault("selected_columns", {}).setdefault(device, [])
+        return list(selected_columns)
+
+
+def toggle_column(user_id, device, feature):
+    """
+    Добавление/удаление столбца из выбранных
+    :param user_id: id пользователя
+    :param device: прибор
+    :param feature: столбец
+    :return: True, если столбец добавлен, False, если убран
+    """
+    # Чтение и изменение списка под блокировкой сессий: одновременные нажатия не теряют друг друга
+    with sessions.edit(user_id) as user_info:
+        selected_features = user_info["selected_columns"][device]
+        added = feature not in selected_features
+        if added:
+            selected_features.append(feature)
+        else:
+            selected_features.remove(feature)
+    return added
+
+
 @exception_decorator
 def choose_columns(call):
     """
@@ -519,62 +568,53 @@ def choose_columns(call):
     - Изменение существующего сообщения после добавления/удаления столбца пользователем
     - Закрепление ответа пользователя и переход дальше
     :param call: сообщение пользователя
-    choose_columns -> make_graph
+    choose_columns -> make_graph / make_summary
     """
     user_id = str(call.from_user.id)
-    user_info_open = load_json("user_info.json")
-    device = str(user_info_open[str(call.from_user.id)]["device"])
-    ava_col = make_list_cols(device)
+    user_info = sessions[user_id]
+    device = str(user_info["device"])
+    device_meta = catalog.device_meta(device)
     # НЕ тривиально: тк здесь существуют ответы типа CallbackQuery и у него другой метод получения текста ->
     # надо делать другой обработчик
     if isinstance(call, CallbackQuery):
         text = call.data
     else:
         text = call.text
-    if text.startswith("feature"):  # Изменение списка выбранных параметров
-        feature = "_".join(call.data.split("feature")[1].split("_")[1::])
-        selected_features = user_info_open[user_id]["selected_columns"][device]
-        if feature in selected_features:
-            selected_features.remove(feature)
-            bot.answer_callback_query(call.id, "Вы убрали столбец " + feature)
+    if text.startswith(("c_", "feature_")):  # Изменение списка выбранных параметров
+        feature = parse_column_callback(device_meta, text)
+        if feature is None:
+            outbox.answer_callback_query(call.id, "Список столбцов изменился")
+        elif toggle_column(user_id, device, feature):
+            outbox.answer_callback_query(call.id, "Вы добавили столбец " + feature)
         else:
-            selected_features.append(feature)
-            bot.answer_callback_query(call.id, "Вы добавили столбец " + feature)
-        user_info_open[user_id]["selected_columns"][device] = selected_features
-        upload_json("user_info.json", user_info_open)
-        bot.answer_callback_query(call.id, "Вы выбрали параметр " + feature)
-        selected_device_columns = user_info_open[str(call.from_user.id)]["selected_columns"][device]
-        bot.edit_message_text(
+            outbox.answer_callback_query(call.id, "Вы убрали столбец " + feature)
+        # Выбор уже сохранен в сессии, а клавиатура перерисовывается с задержкой: быстрые нажатия
+        # склеиваются в очереди, и в Telegram уходит одна правка с последним состоянием
+        selected_device_columns = sessions[user_id]["selected_columns"][device]
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Нажми",
-            reply_markup=draw_inline_keyboard(
-                sorted(selected_device_columns), sorted(ava_col)
-            ),
+            reply_markup=draw_inline_keyboard(selected_device_columns, device_meta),
+            delay=keyboard_debounce,
         )
 
     elif text == "next":  # Сохранение параметром и переход дальше
-        if (
-            len(json.load(open("user_info.json", "r"))[user_id]["selected_columns"][device])
-            != 0
-        ):
+        if len(user_info["selected_columns"][device]) != 0:
             make_graph(call)
         else:
-            bot.answer_callback_query(call.id, "Ни один параметр не выбран!")
+            outbox.answer_callback_query(call.id, "Ни один параметр не выбран!")
+    elif text == "summary":  # Числовая сводка вместо картинки
+        if len(user_info["selected_columns"][device]) != 0:
+            make_summary(call)
+        else:
+            outbox.answer_callback_query(call.id, "Ни один параметр не выбран!")
     else:  # Стартовый вывод столбцов
-        user_info_open = load_json("user_info.json")
-        if "selected_columns" not in user_info_open[user_id].keys():
-            user_info_open[user_id]["selected_columns"] = {}
-        if device not in user_info_open[user_id]["selected_columns"].keys():
-            user_info_open[user_id]["selected_columns"][device] = []
-        upload_json("user_info.json", user_info_open)
-        selected_device_columns = user_info_open[user_id]["selected_columns"][device]
-        bot.send_message(
+        selected_device_columns = init_selected_columns(user_id, device)
+        outbox.send_message(
             call.chat.id,
             "Столбцы для выбора:",
-            reply_markup=draw_inline_keyboard(
-                sorted(selected_device_columns), sorted(ava_col)
-            ),
+            reply_markup=draw_inline_keyboard(selected_device_columns, device_meta),
         )
 
 
@@ -584,29 +624,167 @@ def make_graph(message):
     Функция для построения и вывода итогового графика
     """
     user_id = str(message.from_user.id)
-    bot.send_message(user_id, "Строю график")
+    outbox.send_message(user_id, "Строю график")
     if isinstance(message, CallbackQuery):
         text = message.data
     else:
         text = message.text
-    user_info_open = load_json("user_info.json")
+    user_info, quick_access_saved = apply_quick_access(user_id, text)
+    if quick_access_saved:
+        outbox.send_message(user_id, "Параметры для быстрого доступа выбраны. ")
+    device = user_info["device"]
+    cols_to_draw = user_info["selected_columns"][device]
+    delay = user_info["delay"]
+    # Логирование
+    logging.info(f"User {user_id} requested {device} for {delay} at {datetime.now()}")
+    status = send_graph(user_id, device, cols_to_draw, delay, on_sent=lambda: make_graph_again(user_id))
+    report_graph_status(user_id, status)
+
+
+def make_complex_graph(message):
+    """
+    После выбора промежутка для всего комплекса пользователь оказывается здесь.
+    Построение одной картинки с панелью на каждый прибор комплекса
+    """
+    user_id = str(message.from_user.id)
+    user_info = sessions[user_id]
+    complex_name = user_info["complex"]
+    delay = user_info["delay"]
+    panels = complex_panels(user_id, complex_name)
+    if not panels:
+        outbox.send_message(user_id, "В комплексе нет приборов")
+        start(message)
+        return
+    outbox.send_message(user_id, "Строю график комплекса")
+    logging.info(f"User {user_id} requested complex {complex_name} for {delay} at {datetime.now()}")
+    status = send_complex_graph(
+        user_id, complex_name, panels, delay, on_sent=lambda: make_graph_again(user_id)
+    )
+    report_graph_status(user_id, status)
+
+
+def complex_panels(user_id, complex_name):
+    """
+    :param user_id: id пользователя
+    :param complex_name: имя комплекса
+    :return: список (прибор, столбцы) приборов комплекса: выбранные пользователем столбцы,
+        а если у прибора ничего не выбрано, то все его используемые столбцы
+    """
+    selected_columns = sessions[user_id].get("selected_columns", {})
+    panels = []
+    for short_name in get_devices_from_complex(complex_name):
+        device = short_name_to_full_name_device(short_name)
+        cols_to_draw = selected_columns.get(device) or catalog.device_meta(device).columns
+        panels.append((device, list(cols_to_draw)))
+    return panels
+
+
+def report_graph_status(user_id, status):
+    """
+    Ответ пользователю, если график не был сразу поставлен в очередь или отправлен
+    :param user_id: id пользователя
+    :param status: статус send_graph
+    """
+    metrics.inc("bot_graph_requests_total", status=status)
+    if status == "busy":
+        outbox.send_message(user_id, "Сейчас строится много графиков, попробуйте через минуту")
+        make_graph_again(user_id)
+    elif status == "duplicate":
+        outbox.send_message(user_id, "Этот график уже строится")
+
+
+def make_summary(call):
+    """
+    Если пользователь нажал "Сводка" при выборе столбцов, то попал сюда.
+    Ответ текстом: последние значения, минимум, максимум, среднее, процентили и пропуски выбранных столбцов.
+    Картинка не рисуется и не загружается. Стандартный промежуток из горячего окна считается сразу,
+    остальные - в пуле graph_jobs: поток обработчика не читает данные с диска
+    """
+    user_id = str(call.from_user.id)
+    user_info = sessions[user_id]
+    device = user_info["device"]
+    summary_start = time.perf_counter()
+    outbox.answer_callback_query(call.id)
+    key, text, args = prepare_summary(device, user_info["selected_columns"][device], user_info["delay"])
+    if text is not None:
+        metrics.observe("bot_summary_seconds", time.perf_counter() - summary_start)
+        outbox.send_message(user_id, text)
+        return
+
+    def on_result(text):
+        metrics.observe("bot_summary_seconds", time.perf_counter() - summary_start)
+        outbox.send_message(user_id, text)
+
+    def on_error(error):
+        logging.warning(f"Непредвиденная ошибка: {error.__class__.__name__} в summary_job")
+        outbox.send_message(user_id, "Непредвиденная ошибка в make_summary")
+
+    # Свой владелец задачи: сводка не отменяет уже строящийся график пользователя
+    status = graph_jobs.submit(f"{user_id} summary", key, args, on_result, on_error, summary_job)
+    if status == "busy":
+        outbox.send_message(user_id, "Сейчас строится много графиков, попробуйте через минуту")
+    elif status == "duplicate":
+        outbox.send_message(user_id, "Эта сводка уже считается")
+
+
+def prepare_summary(device, cols_to_draw, delay):
+    """
+    Подготовка сводки по тем же данным, по которым строился бы график
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param delay: стандартный или НЕ стандартный промежуток
+    :return: (ключ задачи, текст сводки или None, аргументы summary_job).
+        Текст есть, если отрезок целиком лежит в горячем окне, иначе сводку нужно посчитать в пуле
+    """
+    begin_record_date, end_record_date, _ = graph_range(delay)
+    key = (
+        "summary", device, tuple(sorted(cols_to_draw)),
+        graph_range_key(delay, begin_record_date, end_record_date),
+    )
+    if isinstance(delay, int):
+        data = hot_window.load_range(device, begin_record_date, end_record_date + timedelta(days=1), cols_to_draw)
+        if data is not None:
+            timestamps, values, _ = data
+            text = format_summary(
+                device, begin_record_date, end_record_date, summarize(timestamps, values, cols_to_draw)
+            )
+            return key, text, None
+    return key, None, (device, cols_to_draw, begin_record_date, end_record_date)
+
+
+# Параметры графика, которые запоминает быстрый доступ. Остальная сессия (подписки, флаги диалога)
+# снимком не сохраняется и при "Отрисовка графика" не заменяется
+quick_access_keys = ("device", "selected_columns", "delay", "complex", "complex_graph")
+
+
+def apply_quick_access(user_id, text):
+    """
+    Работа с быстрым доступом перед построением графика
+    :param user_id: id пользователя
+    :param text: текст нажатой кнопки
+    :return: параметры пользователя для графика и флаг, что быстрый доступ был только что настроен
+    """
+    user_info = sessions[user_id]
+    quick_access_saved = False
     # Если перешли через "Настроить быстрый доступ"
-    if user_info_open[user_id]["update_quick_access"]:
-        user_info_open[user_id]["quick_access"] = user_info_open[user_id].copy()
-        user_info_open[user_id]["update_quick_access"] = False
-        upload_json("user_info.json", user_info_open)
-        bot.send_message(user_id, "Параметры для быстрого доступа выбраны. ")
+    if user_info["update_quick_access"]:
+        # sessions отдает копию сессии, поэтому дальнейший выбор столбцов не меняет быстрый доступ
+        quick_access = {key: user_info[key] for key in quick_access_keys if key in user_info}
+        user_info = sessions.update(user_id, update_quick_access=False, quick_access=quick_access)
+        quick_access_saved = True
     # Если перешли через "Быстрый доступ" (без настройки) -> Замена выбранных параметров, на параметры быстрого доступа
     if text == "Отрисовка графика":
-        user_info_open = load_json("user_info.json")
-        x = user_info_open[user_id]["quick_access"].copy()
-        user_info_open[user_id] = x.copy()
-        user_info_open[user_id]["quick_access"] = x.copy()
-        upload_json("user_info.json", user_info_open)
-    user_info_open = load_json("user_info.json")
-    id_open = user_info_open[user_id]
-    device = id_open["device"]
-    delay = id_open["delay"]
+        # Старые снимки содержат всю сессию -> берутся только параметры графика
+        snapshot = user_info["quick_access"]
+        user_info = sessions.update(user_id, **{key: snapshot[key] for key in quick_access_keys if key in snapshot})
+    return user_info, quick_access_saved
+
+
+def graph_range(delay):
+    """
+    :param delay: стандартный промежуток (int, дни) или НЕ стандартный ([начало, конец])
+    :return: начало и конец отрезка данных, границы оси времени
+    """
     # Если delay int -> стандартный промежуток иначе нет
     if isinstance(delay, int):
         end_record_date = pd.to_datetime(datetime.now().strftime("%Y-%m-%d"))
@@ -616,91 +794,321 @@ def make_graph(message):
         end_record_date = pd.to_datetime(delay[1])
         begin_record_date = pd.to_datetime(delay[0])
         axis_range = [begin_record_date, end_record_date]
-    current_date, combined_data = begin_record_date, pd.DataFrame()
-    # Соединяю файлы за разные месяца, которые могли попасть в промежуток
-    while current_date <= end_record_date + timedelta(days=100):
-        try:
-            data = pd.read_csv(
-                f"{path_to_site}/msu_aerosol/proc_data/{device}/{current_date.strftime('%Y_%m')}.csv"
-            )
-            combined_data = pd.concat([combined_data, data], ignore_index=True)
-            current_date += timedelta(days=29)
-        except FileNotFoundError:
-            current_date += timedelta(days=29)
-    # Если итоговый файл оказался пустым (например, прибор не работает)
-    if combined_data.empty:
-        fig = px.line(combined_data)
-    else:
-        # Во время пред обработки всегда создается столбец - timestamp
-        time_col = "timestamp"
-        combined_data[time_col] = pd.to_datetime(
-            combined_data[time_col],
-            format="%Y-%m-%d %H:%M:%S",
-        )
-        # Обрезаем dataframe согласно выбранному ранее временному диапазону
-        combined_data = combined_data[
-            (combined_data[time_col] >= begin_record_date)
-            & (combined_data[time_col] <= end_record_date + timedelta(days=1))
-        ]
-        combined_data.set_index(time_col, inplace=True)
-        combined_data = combined_data.replace(",", ".", regex=True).astype(float)
-        cols_to_draw = id_open["selected_columns"][device]
-        combined_data.reset_index(inplace=True)
-        combined_data = combined_data.sort_values(by=time_col)
-        # Сортируем столбцы таким образом, чтобы более маленькие рисовались позже
-        cols_to_draw = (
-            combined_data[cols_to_draw]
-            .mean()
-            .sort_values(ascending=False)
-            .index.tolist()
-        )
-        fig = px.line(
-            combined_data,
-            x=time_col,
-            y=cols_to_draw,
-            color_discrete_sequence=[
-                get_color(i, device) for i in cols_to_draw
-            ],  # цвета столбцов
-        )
-    fig.update_layout(
-        title=str(device),
-        xaxis=dict(title="Time"),
-        plot_bgcolor="white",
-        paper_bgcolor="white",
-        showlegend=True,
-    )
-    fig.update_traces(line={"width": 2})
-    fig.update_xaxes(
-        range=axis_range,
-        zerolinecolor="grey",
-        zerolinewidth=1,
-        gridcolor="grey",
-        showline=True,
-        linewidth=1,
-        linecolor="black",
-        mirror=True,
-        tickformat="%H:%M\n%d.%m.%Y",
-        minor_griddash="dot",
-    )
-    fig.update_yaxes(
-        zerolinecolor="grey",
-        zerolinewidth=1,
-        gridcolor="grey",
-        showline=True,
-        linewidth=1,
-        linecolor="black",
-        mirror=True,
+    return begin_record_date, end_record_date, axis_range
+
+
+def send_graph(chat_id, device, cols_to_draw, delay, on_sent=None):
+    """
+    Отправка графика с использованием кеша.
+    При попадании в кеш не читаются данные, не рисуется картинка, а если картинка уже загружалась
+    в Telegram, то повторно отправляется ее file_id без загрузки.
+    Иначе график строится в пуле graph_jobs и отправляется, когда будет готов
+    :param chat_id: кому отправить график
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param delay: стандартный или НЕ стандартный промежуток
+    :param on_sent: что сделать после отправки картинки
+    :return: "sent", "queued", "duplicate" или "busy"
+    """
+    return send_prepared(chat_id, device, prepare_graph(device, cols_to_draw, delay), on_sent)
+
+
+def send_complex_graph(chat_id, complex_name, panels, delay, on_sent=None):
+    """
+    Отправка графика всего комплекса, кеш и очередь те же, что у графика прибора
+    :param chat_id: кому отправить график
+    :param complex_name: имя комплекса
+    :param panels: список (прибор, столбцы)
+    :param delay: стандартный промежуток
+    :param on_sent: что сделать после отправки картинки
+    :return: "sent", "queued", "duplicate" или "busy"
+    """
+    prepared = prepare_complex_graph(complex_name, panels, delay)
+    return send_prepared(chat_id, complex_name, prepared, on_sent, render_complex_job)
+
+
+def send_prepared(chat_id, name, prepared, on_sent=None, job=render_job):
+    """
+    Отправка подготовленного графика: file_id или картинка из кеша, иначе построение в пуле graph_jobs
+    :param chat_id: кому отправить график
+    :param name: имя прибора или комплекса для логов
+    :param prepared: (ключ, версия данных, запись кеша или None, аргументы job) из prepare_graph
+    :param on_sent: что сделать после отправки картинки
+    :param job: функция построения в пуле
+    :return: "sent", "queued", "duplicate" или "busy"
+    """
+    key, version, cached, args = prepared
+    if cached is not None and cached.file_id is not None:
+
+        def file_id_sent(future):
+            if isinstance(future.exception(), telebot.apihelper.ApiTelegramException):
+                # file_id больше не принимается -> загружаем картинку заново
+                upload_graph(chat_id, key, version, cached.png, on_sent)
+            elif future.exception() is not None:
+                logging.warning(f"Ошибка при отправке графика {key}: {future.exception().__class__.__name__}")
+                outbox.send_message(chat_id, outbox.fail_notice, notify=False)
+            elif on_sent is not None:
+                on_sent()
+
+        # Ошибку file_id обрабатывает file_id_sent: уведомление outbox не нужно
+        outbox.send_photo(chat_id, cached.file_id, notify=False).add_done_callback(file_id_sent)
+        return "sent"
+    if cached is not None:
+        upload_graph(chat_id, key, version, cached.png, on_sent)
+        return "sent"
+
+    def on_result(png, stats):
+        log_graph_stats(name, stats)
+        upload_graph(chat_id, key, version, png, on_sent)
+
+    def on_error(error):
+        logging.warning(f"Непредвиденная ошибка: {error.__class__.__name__} в {job.__name__}")
+        outbox.send_message(chat_id, "Непредвиденная ошибка в make_graph")
+        start(chat_id, error_f=True)
+
+    return graph_jobs.submit(str(chat_id), key, args, on_result, on_error, job)
+
+
+def prepare_graph(device, cols_to_draw, delay, touch=True):
+    """
+    Общая для всех режимов бота подготовка графика: ключ и версия для кеша, аргументы render_job
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param delay: стандартный или НЕ стандартный промежуток
+    :param touch: учитывать ли обращение к кешу графиков (False для фоновой отрисовки)
+    :return: (ключ, версия данных, запись кеша или None, аргументы render_job)
+    """
+    begin_record_date, end_record_date, axis_range = graph_range(delay)
+    key = (device, tuple(sorted(cols_to_draw)), graph_range_key(delay, begin_record_date, end_record_date))
+    end_record_date += timedelta(days=1)
+    version, in_window = graph_version(device, delay, begin_record_date, end_record_date)
+    cached = graph_cache.get(key, version, touch)
+    device_meta = catalog.device_meta(device)
+    colors = {col: device_meta.color(col) for col in cols_to_draw}
+    data = None
+    if cached is None and isinstance(delay, int):
+        if in_window:
+            data, version = hot_data(device, cols_to_draw, begin_record_date, end_record_date)
+        metrics.inc("bot_hot_window_total", result="miss" if data is None else "hit")
+    args = (
+        device, cols_to_draw, colors, begin_record_date, end_record_date, axis_range, graph_point_budget, data
     )
-    # Логирование
+    return key, version, cached, args
+
+
+def prepare_complex_graph(complex_name, panels, delay, touch=True):
+    """
+    Подготовка графика всего комплекса, аналог prepare_graph
+    :param complex_name: имя комплекса
+    :param panels: список (прибор, столбцы)
+    :param delay: стандартный промежуток
+    :param touch: учитывать ли обращение к кешу графиков
+    :return: (ключ, версия данных, запись кеша или None, аргументы render_complex_job)
+    """
+    begin_record_date, end_record_date, axis_range = graph_range(delay)
+    range_key = graph_range_key(delay, begin_record_date, end_record_date)
+    key = ("complex", complex_name, tuple((device, tuple(sorted(cols))) for device, cols in panels), range_key)
+    end_record_date += timedelta(days=1)
+    # Картинка устаревает, если обновились данные любого прибора
+    versions = [graph_version(device, delay, begin_record_date, end_record_date) for device, _ in panels]
+    cached = graph_cache.get(key, tuple(version for version, _ in versions), touch)
+    jobs = []
+    if cached is None:
+        for index, ((device, cols_to_draw), (_, in_window)) in enumerate(zip(panels, versions)):
+            device_meta = catalog.device_meta(device)
+            colors = {col: device_meta.color(col) for col in cols_to_draw}
+            data = None
+            if isinstance(delay, int):
+                if in_window:
+                    data, version = hot_data(device, cols_to_draw, begin_record_date, end_record_date)
+                    versions[index] = (version, data is not None)
+                metrics.inc("bot_hot_window_total", result="miss" if data is None else "hit")
+            jobs.append((device, cols_to_draw, colors, data))
+    version = tuple(version for version, _ in versions)
+    args = (complex_name, jobs, begin_record_date, end_record_date, axis_range, graph_point_budget)
+    return key, version, cached, args
+
+
+def graph_version(device, delay, begin_record_date, end_record_date):
+    """
+    Версия данных графика. Стандартный промежуток, целиком лежащий в горячем окне, версионируется окном:
+    окно дочитывает только фоновый поток, обработчик файлы не читает. Остальные - месячными файлами прибора
+    :param device: прибор
+    :param delay: стандартный или НЕ стандартный промежуток
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных
+    :return: (версия, берутся ли данные из горячего окна)
+    """
+    if isinstance(delay, int):
+        version = hot_window.version(device, begin_record_date)
+        if version is not None:
+            return version, True
+    return proc_data.data_version(device, begin_record_date, end_record_date), False
+
+
+def hot_data(device, cols_to_draw, begin_record_date, end_record_date):
+    """
+    Данные горячего окна для render_job, прореженные в процессе бота: исполнителю передается
+    набор точек размером с картинку, а не все строки отрезка
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных
+    :return: (данные для render_job или None, версия, под которой кешировать картинку).
+        Версия снимается вместе со срезом: окно могло дочитаться после graph_version
+    """
+    loaded = hot_window.load_range(device, begin_record_date, end_record_date, cols_to_draw)
+    if loaded is None:
+        # Окно успело сдвинуться -> исполнитель строит график по файлам
+        return None, proc_data.data_version(device, begin_record_date, end_record_date)
+    timestamps, values, version = loaded
+    return memory_data(timestamps, values, cols_to_draw, graph_point_budget), version
+
+
+def graph_range_key(delay, begin_record_date, end_record_date):
+    """
+    :param delay: стандартный или НЕ стандартный промежуток
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных
+    :return: часть ключа кеша графиков, описывающая промежуток
+    """
+    # Стандартный промежуток сдвигается раз в сутки, а внутри суток картинку обновляет версия данных:
+    # пока файлы прибора не менялись, тот же график отдается из кеша
+    if isinstance(delay, int):
+        return ("delay", delay, str(end_record_date.date()))
+    return ("range", str(begin_record_date), str(end_record_date))
+
+
+def log_graph_stats(device, stats):
+    """
+    Логирование времени построения графика по этапам
+    :param device: прибор или комплекс
+    :param stats: статистика из render_job
+    """
+    for phase in ("load", "process", "render"):
+        metrics.observe("bot_graph_phase_seconds", stats[phase], phase=phase)
+    metrics.inc("bot_graphs_total", resolution=stats["resolution"])
     logging.info(
-        f"User {user_id} requested {device} for {begin_record_date} - {end_record_date} at {datetime.now()}"
+        f"Graph {device}: {stats['rows']} rows ({stats['resolution']}) -> {stats['points']} points, "
+        f"load {stats['load']:.3f} s, "
+        f"process {stats['process']:.3f} s, {stats['renderer']} render {stats['render']:.3f} s"
     )
-    # Сохранение картинки
-    fig.write_image(f"graphs_photo/{user_id}.png")
-    # Отправка картинки
-    bot.send_photo(user_id, photo=open(f"graphs_photo/{user_id}.png", "rb"))
-    plt.close()
-    make_graph_again(user_id)
+
+
+def upload_graph(chat_id, key, version, png, on_sent=None):
+    """
+    Загрузка картинки в Telegram и сохранение ее file_id в кеш
+    :param chat_id: кому отправить график
+    :param key: ключ графика в кеше
+    :param version: версия данных графика
+    :param png: байты картинки
+    :param on_sent: что сделать после отправки картинки
+    """
+    image = io.BytesIO(png)
+    image.name = "graph.png"
+    upload_start = time.perf_counter()
+
+    def uploaded(future):
+        metrics.observe("bot_graph_phase_seconds", time.perf_counter() - upload_start, phase="send")
+        if future.exception() is not None:
+            logging.warning(f"Ошибка при отправке графика {key}: {future.exception().__class__.__name__}")
+            return
+        graph_cache.put(key, version, png, future.result().photo[-1].file_id)
+        if on_sent is not None:
+            on_sent()
+
+    outbox.send_photo(chat_id, image).add_done_callback(uploaded)
+
+
+def send_subscription(device, cols_to_draw, delay, chat_ids):
+    """
+    Рассылка графика группе подписчиков с одинаковыми параметрами.
+    График строится (или берется из кеша) один раз, дальше всем отправляется его file_id
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param delay: стандартный промежуток
+    :param chat_ids: кому отправить график
+    :return: "sent", "queued", "duplicate" или "busy"
+    """
+    key, version, cached, args = prepare_graph(device, cols_to_draw, delay)
+    caption = f"{device}: {', '.join(cols_to_draw)} за {delay} дн."
+    if cached is not None:
+        subscription_scheduler.sender.submit(
+            fan_out_graph, chat_ids, key, version, cached.png, cached.file_id, caption
+        )
+        return "sent"
+
+    def on_result(png, stats):
+        log_graph_stats(device, stats)
+        subscription_scheduler.sender.submit(fan_out_graph, chat_ids, key, version, png, None, caption)
+
+    def on_error(error):
+        logging.warning(f"Непредвиденная ошибка: {error.__class__.__name__} в render_job (подписка {device})")
+
+    # Владелец задачи - сам график: одинаковые группы не отменяют друг друга
+    return graph_jobs.submit(f"subscription {key}", key, args, on_result, on_error)
+
+
+def fan_out_graph(chat_ids, key, version, png, file_id, caption):
+    """
+    Отправка одной картинки нескольким чатам, частоту ограничивает outbox.
+    Картинка загружается только один раз (с ожиданием ее file_id), остальным чатам уходит file_id
+    :param chat_ids: кому отправить график
+    :param key: ключ графика в кеше
+    :param version: версия данных графика
+    :param png: байты картинки
+    :param file_id: file_id уже загруженной картинки или None
+    :param caption: подпись к картинке
+    """
+    futures = {}
+    for chat_id in chat_ids:
+        try:
+            if file_id is not None:
+                futures[chat_id] = outbox.send_photo(chat_id, file_id, notify=False, caption=caption)
+                continue
+            image = io.BytesIO(png)
+            image.name = "graph.png"
+            # Ответ нужен сразу: его file_id получат все следующие чаты
+            sent = outbox.send_photo(chat_id, image, caption=caption).result()
+            file_id = sent.photo[-1].file_id
+            graph_cache.put(key, version, png, file_id)
+            metrics.inc("bot_subscription_sends_total", upload="png")
+        except Exception as e:
+            logging.warning(f"Не удалось отправить подписку {chat_id}: {e.__class__.__name__}")
+    for chat_id, future in futures.items():
+        try:
+            future.result()
+            metrics.inc("bot_subscription_sends_total", upload="file_id")
+        except telebot.apihelper.ApiTelegramException:
+            # file_id больше не принимается -> загружаем картинку этому чату заново
+            fan_out_graph([chat_id], key, version, png, None, caption)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить подписку {chat_id}: {e.__class__.__name__}")
+
+
+def prerender_graph(device, cols_to_draw, delay):
+    """
+    Фоновая отрисовка графика быстрого доступа в кеш графиков (без отправки)
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param delay: стандартный или НЕ стандартный промежуток
+    :return: "cached", "queued", "duplicate" или "busy"
+    """
+    # Половина очереди всегда остается для графиков, которые пользователи ждут прямо сейчас
+    if graph_jobs.pending >= max(1, graph_jobs.queue_limit // 2):
+        return "busy"
+    key, version, cached, args = prepare_graph(device, cols_to_draw, delay, touch=False)
+    if cached is not None:
+        return "cached"
+
+    def on_result(png, stats):
+        log_graph_stats(device, stats)
+        graph_cache.put(key, version, png)
+
+    def on_error(error):
+        logging.warning(f"Непредвиденная ошибка: {error.__class__.__name__} в render_job (быстрый доступ {device})")
+
+    return graph_jobs.submit(f"prerender {key}", key, args, on_result, on_error)
 
 
 def make_graph_again(user_id):
@@ -712,14 +1120,14 @@ def make_graph_again(user_id):
     btn1 = types.KeyboardButton("Да")
     btn2 = types.KeyboardButton("Нет")
     markup.add(btn1, btn2)
-    bot.send_message(
+    outbox.send_message(
         user_id,
         "Построить график с другим временным диапазоном еще раз?",
         reply_markup=markup,
     )
 
 
-@bot.message_handler(func=lambda message: message.text in ["Да", "Нет"])
+@router.text("Да", "Нет")
 @exception_decorator
 def make_graph_again_ind(message):
     """
@@ -732,11 +1140,276 @@ def make_graph_again_ind(message):
         start(message)
 
 
-while True:
+def describe_subscription(subscription):
+    """
+    :param subscription: подписка из user_info["subscriptions"]
+    :return: описание подписки для пользователя
+    """
+    return (
+        f"{subscription['time']} - {subscription['device']} "
+        f"({', '.join(subscription['columns'])}) за {subscription['delay']} дн."
+    )
+
+
+def subscription_draft(user_id):
+    """
+    :param user_id: id пользователя
+    :return: параметры последнего графика пользователя для новой подписки или None,
+    если график еще не строился или построен за НЕ стандартный промежуток
+    """
+    user_info = sessions[user_id]
+    device = user_info.get("device")
+    delay = user_info.get("delay")
+    columns = user_info.get("selected_columns", {}).get(device, [])
+    if device is None or not isinstance(delay, int) or not columns:
+        return None
+    return {"device": device, "columns": list(columns), "delay": delay}
+
+
+def set_subscription(user_id, text):
+    """
+    Проверка времени и сохранение новой подписки
+    :param user_id: id пользователя
+    :param text: введенное время в формате 'часы:минуты'
+    :return: сохраненная подписка
+    :raise ValueError: если время некорректно или параметров графика нет
+    """
+    subscription = subscription_draft(user_id)
+    if subscription is None:
+        raise ValueError
+    subscription["time"] = datetime.strptime(text.strip(), "%H:%M").strftime("%H:%M")
+    with sessions.edit(user_id) as user_info:
+        user_subscriptions = user_info.setdefault("subscriptions", [])
+        if subscription not in user_subscriptions:
+            user_subscriptions.append(subscription)
+    return subscription
+
+
+@router.text("Подписки")
+@exception_decorator
+def subscriptions_menu(message):
+    """
+    Если пользователь со страницы start выбрал "Подписки", то он попал сюда.
+    Здесь выводятся подписки пользователя: график каждый день приходит в выбранное время
+    subscriptions_menu("Подписки") -> new_subscription("Новая подписка") / delete_subscriptions("Удалить подписки")
+    """
+    user_id = str(message.from_user.id)
+    user_subscriptions = sessions[user_id].get("subscriptions", [])
+    markup = types.ReplyKeyboardMarkup(row_width=1)
+    markup.add("Новая подписка")
+    if user_subscriptions:
+        markup.add("Удалить подписки")
+        text = "Ваши подписки:\n" + "\n".join(map(describe_subscription, user_subscriptions))
+    else:
+        text = "Подписок нет. Подписка каждый день присылает последний построенный вами график"
+    markup.add("Просмотр данных с приборов")
+    outbox.send_message(message.chat.id, text, reply_markup=markup)
+
+
+@router.text("Новая подписка")
+@exception_decorator
+def new_subscription(message):
+    """
+    Если пользователь выбрал "Новая подписка", то попадает сюда.
+    Подписка повторяет параметры последнего построенного графика, пользователь вводит время отправки
+    new_subscription("Новая подписка") -> subscription_time_choose
+    """
+    user_id = str(message.from_user.id)
+    subscription = subscription_draft(user_id)
+    if subscription is None:
+        outbox.send_message(
+            message.chat.id,
+            "Сначала постройте график за стандартный промежуток (2, 7, 14 или 31 день): "
+            "подписка повторяет его параметры",
+        )
+        return
+    outbox.send_message(
+        message.chat.id,
+        f"Подписка на {subscription['device']} ({', '.join(subscription['columns'])}) "
+        f"за {subscription['delay']} дн. Время отправки (в формате 'часы:минуты')",
+        reply_markup=types.ReplyKeyboardRemove(),
+    )
+    bot.register_next_step_handler_by_chat_id(message.chat.id, subscription_time_choose)
+
+
+def subscription_time_choose(message):
+    """
+    После new_subscription пользователь попадает сюда.
+    Функция для ввода и проверки времени отправки подписки
+    """
+    user_id = str(message.from_user.id)
+    try:
+        subscription = set_subscription(user_id, message.text)
+    except ValueError:
+        outbox.send_message(message.chat.id, "Введено некорректное время")
+        new_subscription(message)
+        return
+    outbox.send_message(message.chat.id, "Подписка сохранена: " + describe_subscription(subscription))
+    subscriptions_menu(message)
+
+
+@router.text("Удалить подписки")
+@exception_decorator
+def delete_subscriptions(message):
+    """
+    Если пользователь выбрал "Удалить подписки", то попадает сюда.
+    delete_subscriptions("Удалить подписки") -> start
+    """
+    user_id = str(message.from_user.id)
+    sessions.update(user_id, subscriptions=[])
+    outbox.send_message(message.chat.id, "Подписки удалены")
+    start(message)
+
+
+@exception_decorator
+def route(message):
+    """
+    Единая точка входа для нажатий кнопок: обработчик находится по тексту сообщения одним
+    обращением к таблице router, сколько бы ни было приборов и комплексов
+    """
+    handler = router.resolve(message.text)
+    if handler is not None:
+        handler(message)
+
+
+def make_bot():
+    """
+    :return: бот с зарегистрированными обработчиками
+    """
+    telegram_bot = telebot.TeleBot(config.token)
+    telegram_bot.register_message_handler(start, commands=["start"])
+    telegram_bot.register_message_handler(
+        send_metrics, commands=["metrics"], func=lambda message: message.from_user.id in admin_ids
+    )
+    telegram_bot.register_callback_query_handler(choose_columns, func=lambda call: True)
+    # Регистрируется последним: команды /start и /metrics проверяются раньше
+    telegram_bot.register_message_handler(route, content_types=["text"])
+    return telegram_bot
+
+
+def setup(make_outbox=None):
+    """
+    Создание бота, очереди отправки, сессий, пула построения графиков, горячего окна и фоновых планировщиков.
+    Вызывается один раз из main() (или из async_main.run()), повторный вызов ничего не делает
+    :param make_outbox: функция (chat_rate, chat_burst, global_rate) -> очередь отправки;
+        по умолчанию Outbox, который отправляет запросы через bot
+    """
+    global bot, outbox, sessions, graph_jobs, hot_window, rollups, subscription_scheduler, quick_access_prerenderer
+    if bot is not None:
+        return
+    logging.basicConfig(filename="info.log", level=logging.INFO)
+    bot = make_bot()
+    # Все ответы пользователям идут через очередь с ограничением частоты и повтором при 429:
+    # обработчики не ждут сети
+    outbox = (make_outbox or partial(Outbox, bot))(
+        chat_rate=getattr(config, "outbox_chat_rate", 1.0),
+        chat_burst=getattr(config, "outbox_chat_burst", 3),
+        global_rate=getattr(config, "outbox_global_rate", 25.0),
+    )
+    sessions = SessionStore("user_info.db", legacy_json="user_info.json")
+    # Пул построения графиков: число процессов и максимальное число задач в работе
+    graph_jobs = GraphJobs(
+        getattr(config, "render_workers", 2),
+        getattr(config, "render_queue_limit", 8),
+        (proc_data.path_proc_data, proc_data.path_cache, graph_renderer, data_dtype),
+    )
+    # Последние дни всех приборов в памяти: графики за стандартные промежутки строятся без чтения файлов
+    hot_window = HotWindow(
+        proc_data.path_proc_data,
+        window_days=getattr(config, "hot_window_days", 32),
+        max_bytes=getattr(config, "hot_window_max_mb", 256) * 1024 * 1024,
+        dtype=data_dtype,
+    )
+    # Часовые и суточные агрегаты для длинных промежутков досчитываются в фоне по мере дописывания файлов,
+    # исполнители их только читают. Папка та же, что у процессов пула
+    rollups = RollupStore(
+        proc_data, f"{proc_data.path_cache}/_rollups", poll_interval=getattr(config, "rollup_interval", 300)
+    )
+    # Подписки на графики: проверка раз в subscription_interval секунд, рассылка через outbox
+    subscription_scheduler = SubscriptionScheduler(
+        sessions, send_subscription, getattr(config, "subscription_interval", 20)
+    )
+    # Графики быстрого доступа перерисовываются в фоне после обновления данных
+    quick_access_prerenderer = QuickAccessPrerenderer(
+        sessions, prerender_graph, getattr(config, "prerender_interval", 60)
+    )
+    metrics.register("bot_graph_cache_hits_total", lambda: graph_cache.hits, "counter")
+    metrics.register("bot_graph_cache_misses_total", lambda: graph_cache.misses, "counter")
+    metrics.register("bot_graph_cache_entries", lambda: len(graph_cache))
+    metrics.register("bot_graph_queue_depth", lambda: graph_jobs.pending)
+    metrics.register("bot_hot_window_bytes", hot_window.memory_usage)
+    metrics.register("bot_outbox_depth", lambda: outbox.depth)
+    startup.mark("setup")
+
+
+def warm_up_renderer():
+    """
+    Прогрев пула построения графиков в фоне: прием сообщений начинается сразу,
+    а процессы и kaleido успевают запуститься до первого запроса графика
+    (задачи, пришедшие раньше, просто ждут в очереди пула)
+    """
+    warm_up_start = time.perf_counter()
+    graph_jobs.warm_up()
+    startup.record("renderer warm-up", time.perf_counter() - warm_up_start)
+    logging.info(f"Startup: {startup.summary()}")
+    if config.id_alarm_ch != 0:
+        outbox.send_message(config.id_alarm_ch, f"Renderer ready: {startup.summary()}", notify=False)
+
+
+def start_background():
+    """
+    Запуск фоновых частей бота: чтение каталога, прогрев отрисовки, горячее окно, агрегаты, подписки,
+    быстрый доступ
+    """
+    catalog.refresh()
+    startup.mark("catalog")
+    threading.Thread(target=warm_up_renderer, name="warm-up", daemon=True).start()
+    hot_window.start(catalog.list_devices)
+    rollups.start(catalog.list_devices)
+    subscription_scheduler.start()
+    quick_access_prerenderer.start()
+
+
+def shutdown():
+    """
+    Остановка бота: фоновые части, пул построения (вместе с процессами kaleido), отправка оставшихся
+    сообщений и запись сессий на диск
+    """
+    hot_window.stop()
+    rollups.stop()
+    subscription_scheduler.stop()
+    quick_access_prerenderer.stop()
+    graph_jobs.shutdown(wait=True)
+    outbox.close()
+    sessions.close()
+
+
+def main():
+    """
+    Запуск бота
+    """
+    setup()
+    start_background()
+    # SIGTERM (остановка службы) обрабатывается как Ctrl+C: прием сообщений прекращается, дальше shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        if config.id_alarm_ch != 0:
-            bot.send_message(config.id_alarm_ch, "Bot started")  # Обращение к каналу о запуске бота
-        bot.infinity_polling(timeout=10, long_polling_timeout=5)
-    except Exception as error:  # Обращение к каналу о поломке бота
-        if config.id_alarm_ch != 0:
-            bot.send_message(config.id_alarm_ch, "Bot program crashed with the error: " + str(error))
\ No newline at end of file
+        while True:
+            try:
+                if config.id_alarm_ch != 0:
+                    # Обращение к каналу о запуске бота со временем этапов запуска
+                    bot.send_message(config.id_alarm_ch, f"Bot started: {startup.summary()}")
+                bot.infinity_polling(timeout=10, long_polling_timeout=5)
+                # infinity_polling возвращается только после остановки (Ctrl+C внутри telebot)
+                break
+            except KeyboardInterrupt:
+                break
+            except Exception as error:  # Обращение к каналу о поломке бота
+                if config.id_alarm_ch != 0:
+                    bot.send_message(config.id_alarm_ch, "Bot program crashed with the error: " + str(error))
+    finally:
+        # Пул построения с процессами kaleido, фоновые потоки, очередь отправки и сессии закрываются штатно
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
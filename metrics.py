@@ -0,0 +1,213 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Гистограмма одной серии: число наблюдений по корзинам, сумма и количество
+    """
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Timer:
+    """
+    Замер времени блока with по монотонным часам с записью в гистограмму
+    """
+
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class NullTimer:
+    """
+    Пустой замер для отключенных метрик
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    Метрики процесса бота: гистограммы задержек, счетчики и значения, снимаемые в момент выгрузки.
+    Все хранится в памяти процесса и выгружается в текстовом формате Prometheus.
+    Если метрики отключены, замеры и счетчики сводятся к одной проверке флага
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        """
+        :param enabled: собирать ли метрики
+        :param buckets: границы корзин гистограмм в секундах
+        """
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # имя -> {метки -> Histogram / число}
+        self._histograms = {}
+        self._counters = {}
+        # имя -> (тип, функция без аргументов, возвращающая значение)
+        self._callbacks = {}
+
+    def observe(self, name, seconds, **labels):
+        """
+        Наблюдение в гистограмму
+
+        :param name: имя гистограммы
+        :param seconds: длительность в секундах
+        :param labels: метки серии
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def timer(self, name, **labels):
+        """
+        :param name: имя гистограммы
+        :param labels: метки серии
+        :return: контекстный менеджер, замеряющий время блока
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Увеличение счетчика
+
+        :param name: имя счетчика
+        :param value: на сколько увеличить
+        :param labels: метки серии
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def register(self, name, callback, kind="gauge"):
+        """
+        Значение, которое снимается при выгрузке (глубина очереди, размер кеша и т.п.)
+
+        :param name: имя метрики
+        :param callback: функция без аргументов, возвращающая число
+        :param kind: тип метрики Prometheus: "gauge" или "counter"
+        """
+        self._callbacks[name] = (kind, callback)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        """
+        :return: все метрики в текстовом формате Prometheus
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    total = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), histogram.counts):
+                        total += count
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {total}")
+                    lines.append(f"{name}_sum{self._labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{self._labels(key)} {histogram.count}")
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{self._labels(key)} {value}")
+        for name, (kind, callback) in sorted(self._callbacks.items()):
+            try:
+                value = callback()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class StartupPhases:
+    """
+    Замер этапов запуска бота (импорты, чтение каталога, прогрев отрисовки) для сообщения о запуске
+    """
+
+    def __init__(self, start=None):
+        """
+        :param start: момент начала запуска по time.perf_counter (по умолчанию - сейчас)
+        """
+        self.last = time.perf_counter() if start is None else start
+        # имя этапа -> длительность в секундах в порядке завершения
+        self.phases = {}
+
+    def mark(self, name):
+        """
+        Завершение этапа, начавшегося с предыдущей отметки
+
+        :param name: имя этапа
+        """
+        now = time.perf_counter()
+        self.phases[name] = now - self.last
+        self.last = now
+
+    def record(self, name, seconds):
+        """
+        Этап, замеренный отдельно (например, в фоновом потоке)
+
+        :param name: имя этапа
+        :param seconds: длительность в секундах
+        """
+        self.phases[name] = seconds
+
+    def summary(self):
+        """
+        :return: строка "этап 0.12 s, ..."
+        """
+        return ", ".join(f"{name} {seconds:.2f} s" for name, seconds in self.phases.items())
+
+
+# Общие метрики процесса: включаются в main.py по config.metrics_enabled
+registry = Metrics(enabled=False)
@@ -0,0 +1,364 @@
+import asyncio
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from requests.exceptions import ConnectionError as NetworkError, Timeout
+from telebot.apihelper import ApiTelegramException
+
+from metrics import registry
+
+
+class TokenBucket:
+    """
+    Ведро токенов: в среднем rate запросов в секунду, подряд - не больше burst
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: токенов в секунду
+        :param burst: емкость ведра
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        """
+        :return: момент, когда в ведре будет хотя бы один токен
+        """
+        self._fill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._fill(now)
+        self.tokens -= 1
+
+
+class Request:
+    """
+    Отложенный вызов метода бота
+    """
+
+    __slots__ = ("method", "args", "kwargs", "key", "futures", "attempts", "not_before", "notify")
+
+    def __init__(self, method, args, kwargs, key, not_before=0.0, notify=False):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.futures = [Future()]
+        self.attempts = 0
+        # Момент (time.monotonic), раньше которого запрос не отправляется
+        self.not_before = not_before
+        # Сообщить ли в чат, если запрос так и не удалось отправить
+        self.notify = notify
+
+
+class Outbox:
+    """
+    Очередь исходящих запросов к Telegram.
+    Обработчики только ставят запрос в очередь и сразу возвращаются, а фоновые потоки отправляют запросы:
+    - в каждый чат строго по порядку и с ограничением частоты по ведру токенов чата,
+      а всего боту - с ограничением по общему ведру (ограничения Telegram на чат и на бота)
+    - повторное редактирование того же сообщения и повторный ответ на тот же callback, пока предыдущий
+      еще в очереди, заменяют его, а не добавляют новый запрос; с delay запрос еще и ждет в очереди,
+      поэтому частые правки одного сообщения уходят в Telegram не чаще раза за delay секунд
+    - на 429 запрос повторяется через retry_after из ответа Telegram, на сетевые ошибки - с растущей паузой
+    Каждый метод возвращает Future с ответом Telegram, ждать его нужно только там, где нужен результат.
+    Запрос, который так и не удалось отправить, логируется; если сообщение или файл пользователю потерялись,
+    в чат уходит fail_notice (сами уведомления об ошибке при неудаче не повторяются)
+    """
+
+    fail_notice = "Не удалось отправить ответ, попробуйте еще раз"
+    # Ошибка ответа Telegram и сетевые ошибки клиента, которым отправляются запросы
+    api_error = ApiTelegramException
+    network_errors = (NetworkError, Timeout)
+
+    def __init__(self, bot, chat_rate=1.0, chat_burst=3, global_rate=25.0, threads=4, max_attempts=5):
+        """
+        :param bot: telebot.TeleBot (методы вызываются в _call)
+        :param chat_rate: сообщений в секунду в один чат
+        :param chat_burst: сколько сообщений подряд можно отправить в чат без паузы
+        :param global_rate: запросов в секунду на всего бота
+        :param threads: число потоков отправки (запросы в разные чаты идут параллельно)
+        :param max_attempts: сколько раз пробовать отправить запрос при 429 и сетевых ошибках
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._global = TokenBucket(global_rate, global_rate)
+        self._cond = threading.Condition()
+        # чат -> очередь запросов; порядок словаря - очередность обслуживания чатов
+        self._queues = OrderedDict()
+        self._buckets = {}
+        # чат -> момент, до которого Telegram попросил не отправлять (429)
+        self._blocked = {}
+        # ключ склейки -> запрос в очереди
+        self._pending = {}
+        # чаты, запрос в которые сейчас отправляется
+        self._busy = set()
+        self._global_blocked = 0.0
+        self._closing = False
+        self._threads = [
+            threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True) for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """
+        :return: число запросов в очереди
+        """
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    # notify=False - вызывающий код сам обрабатывает ошибку (например, повторяет отправку по-другому)
+    def send_message(self, chat_id, text, notify=True, **kwargs):
+        return self.submit(chat_id, "send_message", (chat_id, text), kwargs, notify=notify)
+
+    def send_photo(self, chat_id, photo, notify=True, **kwargs):
+        return self.submit(chat_id, "send_photo", (chat_id, photo), kwargs, notify=notify)
+
+    def send_document(self, chat_id, document, notify=True, **kwargs):
+        return self.submit(chat_id, "send_document", (chat_id, document), kwargs, notify=notify)
+
+    def edit_message_text(self, text, chat_id, message_id, delay=0.0, **kwargs):
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self.submit(
+            chat_id, "edit_message_text", (text,), kwargs, key=("edit", str(chat_id), message_id), delay=delay
+        )
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        # Ответ на callback не считается сообщением в чат: у него своя очередь без ограничения чата
+        return self.submit(
+            None, "answer_callback_query", (callback_query_id, text), kwargs, key=("answer", callback_query_id)
+        )
+
+    def submit(self, chat_id, method, args, kwargs, key=None, delay=0.0, notify=False):
+        """
+        Постановка вызова метода бота в очередь
+
+        :param chat_id: чат, в котором важен порядок и действует ограничение частоты (None - без ограничения чата)
+        :param method: имя метода telebot.TeleBot
+        :param args: позиционные аргументы метода
+        :param kwargs: именованные аргументы метода
+        :param key: ключ склейки: запрос с тем же ключом, еще ждущий в очереди, заменяется новым
+        :param delay: сколько секунд запрос ждет в очереди, собирая более новые запросы с тем же ключом.
+            Ожидание отсчитывается от первого запроса и новыми запросами не продлевается
+        :param notify: отправить ли в чат fail_notice, если запрос так и не удалось выполнить
+        :return: Future с ответом Telegram
+        """
+        # Один и тот же чат приходит и как int (message.chat.id), и как str (id пользователя из сессий)
+        chat_id = None if chat_id is None else str(chat_id)
+        with self._cond:
+            request = self._pending.get(key) if key is not None else None
+            if request is not None:
+                # Отправится только последнее состояние, а ответ получат все, кто его ждет
+                request.args, request.kwargs = args, kwargs
+                request.futures.append(Future())
+                registry.inc("bot_outbox_coalesced_total", method=method)
+                return request.futures[-1]
+            request = Request(method, args, kwargs, key, time.monotonic() + delay if delay else 0.0, notify)
+            if key is not None:
+                self._pending[key] = request
+            self._queues.setdefault(chat_id, deque()).append(request)
+            self._cond.notify()
+            return request.futures[0]
+
+    def close(self, timeout=10.0):
+        """
+        Остановка потоков отправки после того, как очередь опустеет
+
+        :param timeout: сколько секунд ждать отправки оставшихся запросов
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        """
+        Выбор следующего запроса (под self._cond)
+
+        :return: (чат, запрос, None) или (None, None, пауза в секундах до ближайшего возможного запроса)
+        """
+        now = time.monotonic()
+        wait = None
+        global_at = max(self._global.ready_at(now), self._global_blocked)
+        for chat_id, queue in self._queues.items():
+            # Пока в чат отправляется запрос, следующий ждет: порядок сообщений в чате сохраняется
+            if chat_id is not None and chat_id in self._busy:
+                continue
+            at = max(global_at, self._blocked.get(chat_id, 0.0), queue[0].not_before)
+            if chat_id is not None:
+                at = max(at, self._bucket(chat_id).ready_at(now))
+            if at <= now:
+                request = queue.popleft()
+                if not queue:
+                    del self._queues[chat_id]
+                else:
+                    # Чат уходит в конец очереди обслуживания, чтобы один чат не занимал все потоки
+                    self._queues.move_to_end(chat_id)
+                if request.key is not None:
+                    self._pending.pop(request.key, None)
+                self._global.take(now)
+                if chat_id is not None:
+                    self._bucket(chat_id).take(now)
+                    self._busy.add(chat_id)
+                return chat_id, request, None
+            wait = at - now if wait is None else min(wait, at - now)
+        return None, None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    chat_id, request, wait = self._next()
+                    if request is not None:
+                        break
+                    if self._closing and not self._queues and not self._busy:
+                        return
+                    self._cond.wait(timeout=wait)
+            try:
+                self._send(chat_id, request)
+            finally:
+                with self._cond:
+                    self._busy.discard(chat_id)
+                    # Старые ведра чатов не нужны: их ограничение уже прошло
+                    if len(self._buckets) > 10000:
+                        self._buckets = {chat: self._buckets[chat] for chat in self._queues if chat in self._buckets}
+                        self._blocked = {chat: at for chat, at in self._blocked.items() if chat in self._queues}
+                    self._cond.notify_all()
+
+    def _send(self, chat_id, request):
+        request.attempts += 1
+        for value in list(request.args) + list(request.kwargs.values()):
+            # Файл при повторной отправке читается заново
+            if isinstance(value, io.IOBase):
+                value.seek(0)
+        try:
+            with registry.timer("bot_outbox_seconds", method=request.method):
+                result = self._call(request)
+        except self.api_error as e:
+            if e.error_code == 400 and "message is not modified" in e.description:
+                # Склеенные правки вернули сообщение в то же состояние: Telegram уже показывает нужное
+                result = None
+            elif e.error_code == 429 and request.attempts < self.max_attempts:
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                registry.inc("bot_outbox_retries_total", reason="429")
+                logging.warning(f"Telegram 429 в {request.method}: повтор через {retry_after} s")
+                self._retry(chat_id, request, retry_after, everyone=chat_id is None)
+                return
+            else:
+                self._fail(chat_id, request, e)
+                return
+        except self.network_errors as e:
+            if request.attempts < self.max_attempts:
+                registry.inc("bot_outbox_retries_total", reason="network")
+                self._retry(chat_id, request, 0.5 * 2 ** (request.attempts - 1))
+                return
+            self._fail(chat_id, request, e)
+            return
+        except Exception as e:
+            self._fail(chat_id, request, e)
+            return
+        for future in request.futures:
+            future.set_result(result)
+
+    def _call(self, request):
+        """
+        Выполнение запроса в потоке отправки
+
+        :return: ответ Telegram
+        """
+        return getattr(self.bot, request.method)(*request.args, **request.kwargs)
+
+    def _retry(self, chat_id, request, delay, everyone=False):
+        """
+        Возврат запроса в начало очереди его чата с паузой
+        """
+        with self._cond:
+            until = time.monotonic() + delay
+            if everyone:
+                self._global_blocked = max(self._global_blocked, until)
+            else:
+                self._blocked[chat_id] = max(self._blocked.get(chat_id, 0.0), until)
+            if request.key is not None:
+                newer = self._pending.get(request.key)
+                if newer is not None:
+                    # Пока запрос ждал повтора, пришло более новое состояние -> отправится только оно
+                    newer.futures.extend(request.futures)
+                    return
+                self._pending[request.key] = request
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+            queue.appendleft(request)
+
+    def _fail(self, chat_id, request, error):
+        """
+        Запрос не удалось выполнить: ошибка логируется и передается во все его Future
+        """
+        registry.inc("bot_outbox_errors_total", method=request.method)
+        description = getattr(error, "description", None) or str(error)
+        logging.warning(
+            f"Не удалось выполнить {request.method} в чат {chat_id} (попыток: {request.attempts}): "
+            f"{error.__class__.__name__} {description}"
+        )
+        # 403 - бот заблокирован или удален из чата, сообщать некому.
+        # Уведомление ставится без notify, поэтому его собственная неудача только логируется
+        blocked = isinstance(error, self.api_error) and error.error_code == 403
+        if request.notify and chat_id is not None and not blocked:
+            self.submit(chat_id, "send_message", (chat_id, self.fail_notice), {}, key=("fail_notice", chat_id))
+        for future in request.futures:
+            future.set_exception(error)
+
+
+class AsyncOutbox(Outbox):
+    """
+    Очередь отправки асинхронного режима (async_main.py): те же ограничения частоты, склейка и повторы,
+    но запрос выполняет AsyncTeleBot в цикле событий, а поток очереди только ждет ответа
+    """
+
+    def __init__(self, bot, loop, **kwargs):
+        """
+        :param bot: telebot.async_telebot.AsyncTeleBot
+        :param loop: цикл событий, в котором работает bot
+        :param kwargs: ограничения частоты и повторов, см. Outbox
+        """
+        # aiohttp нужен только асинхронному режиму
+        import aiohttp
+        from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException, RequestTimeout
+
+        self.api_error = AsyncApiTelegramException
+        # Сетевые ошибки AsyncTeleBot сам повторяет и после этого выбрасывает RequestTimeout
+        self.network_errors = (RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+        self.loop = loop
+        super().__init__(bot, **kwargs)
+
+    def _call(self, request):
+        coroutine = getattr(self.bot, request.method)(*request.args, **request.kwargs)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
@@ -0,0 +1,81 @@
+import logging
+import threading
+
+
+class QuickAccessPrerenderer:
+    """
+    Фоновая отрисовка графиков быстрого доступа.
+    Раз в interval секунд собираются различные настройки быстрого доступа всех пользователей
+    (прибор, столбцы, промежуток) и для каждой, у которой в кеше графиков нет актуальной картинки
+    (данные в proc_data обновились или стандартный промежуток сдвинулся), график строится заранее.
+    Тогда нажатие "Отрисовка графика" стоит одной отправки картинки.
+    Пока данные прибора не менялись, render находит картинку в кеше и ничего не строит
+    """
+
+    def __init__(self, sessions, render, interval=60.0):
+        """
+        :param sessions: SessionStore
+        :param render: функция (прибор, столбцы, промежуток) -> "cached", "queued", "duplicate" или "busy"
+        :param interval: период проверки в секундах
+        """
+        self.sessions = sessions
+        self.render = render
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configs(self):
+        """
+        :return: различные настройки быстрого доступа всех пользователей
+        """
+        configs = {}
+        for _, user_info in self.sessions.items():
+            quick_access = user_info.get("quick_access")
+            if not quick_access:
+                continue
+            device = quick_access.get("device")
+            delay = quick_access.get("delay")
+            columns = quick_access.get("selected_columns", {}).get(device)
+            if device is None or delay is None or not columns:
+                continue
+            key = (device, tuple(sorted(columns)), tuple(delay) if isinstance(delay, list) else delay)
+            configs.setdefault(key, (device, list(columns), delay))
+        return list(configs.values())
+
+    def run_once(self):
+        """
+        Одна проверка всех настроек быстрого доступа
+        :return: число поставленных в очередь графиков
+        """
+        queued = 0
+        for device, columns, delay in self.configs():
+            try:
+                status = self.render(device, columns, delay)
+            except Exception as e:
+                logging.warning(f"Ошибка фоновой отрисовки {device}: {e.__class__.__name__}: {e}")
+                continue
+            if status == "busy":
+                # Пул занят графиками пользователей -> остальное на следующей проверке
+                break
+            queued += status == "queued"
+        return queued
+
+    def start(self):
+        """
+        Запуск фонового потока
+        """
+        if self._thread is not None or not self.interval:
+            return
+        self._thread = threading.Thread(target=self._run, name="quick-access-prerender", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            queued = self.run_once()
+            if queued:
+                logging.info(f"Quick access prerender: {queued} graphs queued")
+            if self._stop.wait(self.interval):
+                return
@@ -0,0 +1,448 @@
+import io
+import threading
+
+import numpy as np
+import pandas as pd
+
+# plotly и matplotlib импортируются внутри методов отрисовки: модуль нужен и процессу бота
+# (прореживание, проверка имени бэкенда), которому тяжелые библиотеки при запуске не нужны.
+# В процессах-исполнителях они загружаются один раз при прогреве
+
+
+def downsample_minmax(timestamps, values, point_budget):
+    """
+    Прореживание рядов перед отрисовкой с сохранением выбросов.
+    Отрезок времени делится на равные корзины (примерно по пикселю ширины картинки),
+    в каждой корзине для каждого столбца остаются точки с минимумом и максимумом.
+    Для корзин, где у столбца нет значений, остается первая точка корзины, чтобы не потерять разрывы линии.
+    Все столбцы берутся по общему набору индексов, поэтому у них остается общая ось времени
+
+    :param timestamps: отсортированные метки времени (int64)
+    :param values: словарь столбец -> массив значений
+    :param point_budget: примерное число точек на столбец после прореживания (0 - без прореживания)
+    :return: (прореженные метки времени, словарь столбец -> прореженные значения)
+    """
+    n = len(timestamps)
+    if not point_budget or n <= point_budget:
+        return timestamps, values
+    n_buckets = max(1, point_budget // 2)
+    timestamps = np.asarray(timestamps)
+    t0, t1 = timestamps[0], timestamps[-1]
+    # Через float, чтобы не переполнить int64 на многолетних отрезках в наносекундах
+    buckets = ((timestamps - t0) / (t1 - t0 + 1) * n_buckets).astype(np.int64)
+    bucket_starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    keep = []
+    for col, series in values.items():
+        series = np.asarray(series, dtype=np.float64)
+        valid = ~np.isnan(series)
+        valid_idx = np.flatnonzero(valid)
+        if len(valid_idx):
+            # Внутри корзины точки сортируются по значению: первая - минимум, последняя - максимум
+            order = valid_idx[np.lexsort((series[valid_idx], buckets[valid_idx]))]
+            ordered_buckets = buckets[order]
+            starts = np.flatnonzero(np.r_[True, ordered_buckets[1:] != ordered_buckets[:-1]])
+            ends = np.r_[starts[1:], len(order)] - 1
+            keep.append(order[starts])
+            keep.append(order[ends])
+        # Корзины без единого значения столбца -> первая точка корзины (NaN разорвет линию)
+        has_valid = np.add.reduceat(valid.astype(np.int64), bucket_starts) > 0
+        keep.append(bucket_starts[~has_valid])
+    index = np.unique(np.concatenate(keep)) if keep else np.arange(n)
+    return timestamps[index], {col: np.asarray(series)[index] for col, series in values.items()}
+
+
+class StreamingEnvelope:
+    """
+    Потоковое прореживание: куски данных сворачиваются в огибающую фиксированного размера по мере чтения.
+    Отрезок [begin, end] заранее делится на point_budget // 2 равных корзин (примерно по пикселю ширины),
+    для каждой корзины и столбца хранятся только минимум и максимум, для столбца - сумма и число значений.
+    Пока строк не больше point_budget, куски хранятся как есть и график рисуется по исходным точкам.
+    Память не зависит от длины отрезка: огибающая плюс один читаемый кусок
+    """
+
+    def __init__(self, begin, end, columns, point_budget):
+        """
+        :param begin: начало отрезка
+        :param end: конец отрезка
+        :param columns: столбцы
+        :param point_budget: примерное число точек на столбец после прореживания
+        """
+        self.begin_ns = pd.Timestamp(begin).value
+        self.span = max(pd.Timestamp(end).value - self.begin_ns, 1)
+        self.columns = list(columns)
+        self.n_buckets = max(1, point_budget // 2)
+        self.raw_limit = point_budget
+        self.rows = 0
+        self._raw = []
+        self._present = None
+        self._low, self._high = {}, {}
+        self._sum = dict.fromkeys(self.columns, 0.0)
+        self._count = dict.fromkeys(self.columns, 0)
+
+    def add(self, timestamps, values):
+        """
+        Учет очередного куска (метки времени отсортированы и идут после предыдущего куска)
+
+        :param timestamps: метки времени (int64)
+        :param values: словарь столбец -> значения
+        """
+        if not len(timestamps):
+            return
+        self.rows += len(timestamps)
+        for col in self.columns:
+            series = np.asarray(values[col], dtype=np.float64)
+            valid = ~np.isnan(series)
+            self._sum[col] += float(series[valid].sum())
+            self._count[col] += int(valid.sum())
+        if self._present is None:
+            if self.rows <= self.raw_limit:
+                # Копия: куски могут быть срезами mmap, которые закроются после чтения месяца
+                self._raw.append((np.array(timestamps), {col: np.array(values[col]) for col in self.columns}))
+                return
+            self._present = np.zeros(self.n_buckets, dtype=bool)
+            for col in self.columns:
+                self._low[col] = np.full(self.n_buckets, np.nan)
+                self._high[col] = np.full(self.n_buckets, np.nan)
+            raw, self._raw = self._raw, []
+            for chunk in raw:
+                self._fold(*chunk)
+        self._fold(timestamps, values)
+
+    def _fold(self, timestamps, values):
+        buckets = ((np.asarray(timestamps) - self.begin_ns) / self.span * self.n_buckets).astype(np.int64)
+        np.clip(buckets, 0, self.n_buckets - 1, out=buckets)
+        # Метки отсортированы -> строки одной корзины идут подряд, и минимум/максимум считаются через reduceat
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        index = buckets[starts]
+        self._present[index] = True
+        for col in self.columns:
+            series = np.asarray(values[col], dtype=np.float64)
+            # fmin/fmax пропускают NaN: корзина без значений столбца останется NaN и разорвет линию
+            self._low[col][index] = np.fmin(self._low[col][index], np.fmin.reduceat(series, starts))
+            self._high[col][index] = np.fmax(self._high[col][index], np.fmax.reduceat(series, starts))
+
+    def result(self):
+        """
+        :return: (метки времени, словарь столбец -> значения, средние столбцов или None, если данных нет,
+            число исходных строк)
+        """
+        means = None
+        if self.rows:
+            means = pd.Series(
+                {col: self._sum[col] / self._count[col] if self._count[col] else np.nan for col in self.columns},
+                dtype="float64",
+            )
+        if self._present is None:
+            if not self._raw:
+                return np.empty(0, dtype="int64"), {col: np.empty(0) for col in self.columns}, means, self.rows
+            timestamps = np.concatenate([chunk[0] for chunk in self._raw])
+            values = {col: np.concatenate([chunk[1][col] for chunk in self._raw]) for col in self.columns}
+            return timestamps, values, means, self.rows
+        # Как у агрегатов: в каждой корзине минимум в ее начале и максимум в ее середине
+        index = np.flatnonzero(self._present)
+        starts = self.begin_ns + (index * (self.span / self.n_buckets)).astype(np.int64)
+        timestamps = np.empty(2 * len(index), dtype="int64")
+        timestamps[0::2] = starts
+        timestamps[1::2] = starts + int(self.span / self.n_buckets / 2)
+        values = {}
+        for col in self.columns:
+            series = np.empty(2 * len(index))
+            series[0::2] = self._low[col][index]
+            series[1::2] = self._high[col][index]
+            values[col] = series
+        return timestamps, values, means, self.rows
+
+
+class GraphSpec:
+    """
+    Независимое от библиотеки отрисовки описание графика
+    """
+
+    __slots__ = ("title", "timestamps", "series", "axis_range")
+
+    def __init__(self, title, timestamps, series, axis_range):
+        """
+        :param title: заголовок графика (имя прибора)
+        :param timestamps: метки времени (int64, наносекунды epoch)
+        :param series: список (имя столбца, значения, цвет) в порядке отрисовки
+        :param axis_range: границы оси времени
+        """
+        self.title = title
+        self.timestamps = timestamps
+        self.series = series
+        self.axis_range = axis_range
+
+
+class PlotlyRenderer:
+    """
+    Отрисовка через plotly + kaleido. Процесс kaleido живет все время работы бота:
+    он поднимается при прогреве, а картинка возвращается в памяти без временных файлов
+    """
+
+    name = "plotly"
+    # Размеры картинки комплекса: ширина как у обычного графика, высота растет с числом панелей
+    width, panel_height = 700, 300
+
+    def __init__(self):
+        # Обмен с процессом kaleido идет через один канал -> картинки рисуются по очереди
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Запуск процесса kaleido до первого запроса пользователя
+        """
+        self.render(GraphSpec("warm-up", np.array([0, 1], dtype="int64"), [], [0, 1]))
+
+    @staticmethod
+    def make_figure(spec):
+        """
+        :param spec: GraphSpec
+        :return: plotly фигура в стиле бота
+        """
+        import plotly.express as px
+
+        if spec.series:
+            data = pd.DataFrame({name: values for name, values, _ in spec.series})
+            data.insert(0, "timestamp", pd.to_datetime(spec.timestamps))
+            fig = px.line(
+                data,
+                x="timestamp",
+                y=[name for name, _, _ in spec.series],
+                color_discrete_sequence=[color for _, _, color in spec.series],  # цвета столбцов
+            )
+        else:
+            fig = px.line(pd.DataFrame())
+        fig.update_layout(xaxis=dict(title="Time"))
+        return PlotlyRenderer.apply_style(fig, spec.title, spec.axis_range)
+
+    @staticmethod
+    def make_panels_figure(title, specs):
+        """
+        :param title: заголовок картинки
+        :param specs: список GraphSpec, по панели на каждый
+        :return: plotly фигура с панелями друг под другом и общей осью времени
+        """
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
+        fig = make_subplots(
+            rows=len(specs),
+            cols=1,
+            shared_xaxes=True,
+            vertical_spacing=0.3 / len(specs),
+            subplot_titles=[str(spec.title) for spec in specs],
+        )
+        for row, spec in enumerate(specs, start=1):
+            x = pd.to_datetime(spec.timestamps)
+            for name, values, color in spec.series:
+                # Легенда общая на всю картинку -> столбцы сгруппированы по приборам
+                fig.add_trace(
+                    go.Scatter(
+                        x=x,
+                        y=values,
+                        name=name,
+                        mode="lines",
+                        line={"color": color},
+                        legendgroup=str(spec.title),
+                        legendgrouptitle_text=str(spec.title),
+                    ),
+                    row=row,
+                    col=1,
+                )
+        fig.update_layout(height=PlotlyRenderer.panel_height * len(specs) + 150, width=PlotlyRenderer.width)
+        fig.update_xaxes(title="Time", row=len(specs), col=1)
+        return PlotlyRenderer.apply_style(fig, title, specs[0].axis_range)
+
+    @staticmethod
+    def apply_style(fig, title, axis_range):
+        """
+        Оформление фигуры в стиле бота (для всех ее осей)
+
+        :param fig: plotly фигура
+        :param title: заголовок
+        :param axis_range: границы оси времени
+        :return: та же фигура
+        """
+        fig.update_layout(
+            title=str(title),
+            plot_bgcolor="white",
+            paper_bgcolor="white",
+            showlegend=True,
+        )
+        fig.update_traces(line={"width": 2})
+        fig.update_xaxes(
+            range=axis_range,
+            zerolinecolor="grey",
+            zerolinewidth=1,
+            gridcolor="grey",
+            showline=True,
+            linewidth=1,
+            linecolor="black",
+            mirror=True,
+            tickformat="%H:%M\n%d.%m.%Y",
+            minor_griddash="dot",
+        )
+        fig.update_yaxes(
+            zerolinecolor="grey",
+            zerolinewidth=1,
+            gridcolor="grey",
+            showline=True,
+            linewidth=1,
+            linecolor="black",
+            mirror=True,
+        )
+        return fig
+
+    def close(self):
+        """
+        Остановка процесса kaleido. Сам kaleido останавливает его только в __del__, который
+        не вызывается при выходе процесса-исполнителя пула (он завершается через os._exit)
+        """
+        from plotly.io import _kaleido
+
+        if _kaleido.scope is not None:
+            _kaleido.scope._shutdown_kaleido()
+
+    def render(self, spec):
+        """
+        :param spec: GraphSpec
+        :return: BytesIO с png картинкой
+        """
+        return self.to_png(self.make_figure(spec))
+
+    def render_panels(self, title, specs):
+        """
+        :param title: заголовок картинки
+        :param specs: список GraphSpec, по панели на каждый
+        :return: BytesIO с png картинкой
+        """
+        return self.to_png(self.make_panels_figure(title, specs))
+
+    def to_png(self, fig):
+        with self._lock:
+            png = fig.to_image(format="png")
+        image = io.BytesIO(png)
+        image.name = "graph.png"
+        return image
+
+
+class MatplotlibRenderer:
+    """
+    Быстрая отрисовка через matplotlib (Agg) в стиле plotly графиков бота.
+    Работает внутри процесса, без pyplot, поэтому картинки можно рисовать из разных потоков
+    """
+
+    name = "matplotlib"
+    width, height, dpi = 700, 500, 100
+    # Высота одной панели графика комплекса
+    panel_height = 300
+
+    def warm_up(self):
+        """
+        Загрузка шрифтов и модулей matplotlib до первого запроса пользователя
+        """
+        self.render(GraphSpec("warm-up", np.array([0, 1], dtype="int64"), [], [0, 1]))
+
+    def close(self):
+        """
+        Внешних процессов нет -> останавливать нечего
+        """
+
+    def render(self, spec):
+        """
+        :param spec: GraphSpec
+        :return: BytesIO с png картинкой
+        """
+        fig = self.new_figure(self.height)
+        # Положение области графика как у plotly по умолчанию
+        ax = fig.add_axes((0.114, 0.16, 0.75, 0.72), facecolor="white")
+        self.draw_axes(ax, spec)
+        ax.set_xlabel("Time", color="#2a3f5f")
+        fig.text(0.05, 0.94, str(spec.title), fontsize=13, color="#2a3f5f")
+        return self.to_png(fig)
+
+    def render_panels(self, title, specs):
+        """
+        :param title: заголовок картинки
+        :param specs: список GraphSpec, по панели на каждый
+        :return: BytesIO с png картинкой
+        """
+        height = self.panel_height * len(specs) + 150
+        fig = self.new_figure(height)
+        # Поля в пикселях как у одиночного графика, панели делят оставшуюся высоту
+        fig.subplots_adjust(
+            left=0.114, right=0.864, top=1 - 70 / height, bottom=80 / height, hspace=0.35
+        )
+        axes = fig.subplots(len(specs), 1, sharex=True, squeeze=False)[:, 0]
+        for ax, spec in zip(axes, specs):
+            self.draw_axes(ax, spec)
+            ax.set_title(str(spec.title), loc="left", fontsize=11, color="#2a3f5f")
+        axes[-1].set_xlabel("Time", color="#2a3f5f")
+        fig.text(0.05, 1 - 30 / height, str(title), fontsize=13, color="#2a3f5f")
+        return self.to_png(fig)
+
+    def new_figure(self, height):
+        """
+        :param height: высота картинки в пикселях
+        :return: пустая фигура matplotlib с холстом Agg
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=(self.width / self.dpi, height / self.dpi), dpi=self.dpi, facecolor="white")
+        FigureCanvasAgg(fig)
+        return fig
+
+    @staticmethod
+    def draw_axes(ax, spec):
+        """
+        Отрисовка рядов одного GraphSpec на оси в стиле plotly графиков бота
+
+        :param ax: ось matplotlib
+        :param spec: GraphSpec
+        """
+        from matplotlib import dates as mdates
+        from matplotlib.ticker import AutoMinorLocator
+
+        ax.set_facecolor("white")
+        x = np.asarray(spec.timestamps).astype("datetime64[ns]")
+        for name, values, color in spec.series:
+            ax.plot(x, values, color=color, linewidth=1.5, label=name)
+        ax.set_xlim(*pd.to_datetime(spec.axis_range))
+        ymin, ymax = ax.get_ylim()
+        if ymin < 0 < ymax:
+            ax.axhline(0, color="grey", linewidth=1, zorder=0)
+        ax.grid(True, which="major", color="grey", linewidth=0.8)
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=3, maxticks=6))
+        ax.xaxis.set_minor_locator(AutoMinorLocator(4))
+        ax.grid(True, which="minor", axis="x", color="lightgrey", linestyle=":", linewidth=0.8)
+        ax.set_axisbelow(True)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M\n%d.%m.%Y"))
+        for spine in ax.spines.values():
+            spine.set_color("black")
+            spine.set_linewidth(1)
+        ax.tick_params(colors="#2a3f5f", labelsize=9, which="both", length=0)
+        ax.set_ylabel("value", color="#2a3f5f")
+        if spec.series:
+            ax.legend(
+                title="variable", loc="upper left", bbox_to_anchor=(1.01, 1), frameon=False, fontsize=9
+            )
+
+    @staticmethod
+    def to_png(fig):
+        image = io.BytesIO()
+        fig.savefig(image, format="png")
+        image.seek(0)
+        image.name = "graph.png"
+        return image
+
+
+def make_renderer(name):
+    """
+    :param name: имя бэкенда отрисовки (plotly или matplotlib)
+    :return: объект отрисовки
+    """
+    renderers = {renderer.name: renderer for renderer in (PlotlyRenderer, MatplotlibRenderer)}
+    if name not in renderers:
+        raise ValueError(f"Неизвестный бэкенд отрисовки: {name}")
+    return renderers[name]()
@@ -0,0 +1,303 @@
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from data_cache import ProcDataCache
+
+# Разрешения агрегатов: имя -> длина корзины в наносекундах
+RESOLUTIONS = {
+    "hour": 3600 * 10**9,
+    "day": 86400 * 10**9,
+}
+
+
+def compute_rollup(timestamps, values, bucket_ns):
+    """
+    Агрегаты mean/min/max/count по корзинам фиксированной длины (векторно, за один проход по столбцу)
+
+    :param timestamps: отсортированные метки времени (int64, наносекунды epoch)
+    :param values: словарь столбец -> массив значений
+    :param bucket_ns: длина корзины в наносекундах
+    :return: (начала непустых корзин, словарь столбец -> (mean, min, max, count))
+    """
+    timestamps = np.asarray(timestamps)
+    if len(timestamps) == 0:
+        return np.empty(0, dtype="int64"), {
+            col: tuple(np.empty(0) for _ in range(3)) + (np.empty(0, dtype="int64"),) for col in values
+        }
+    buckets = timestamps // bucket_ns
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    stats = {}
+    for col, series in values.items():
+        series = np.asarray(series, dtype="float64")
+        valid = ~np.isnan(series)
+        count = np.add.reduceat(valid.astype("int64"), starts)
+        total = np.add.reduceat(np.where(valid, series, 0.0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, np.nan)
+        # fmin/fmax пропускают NaN, корзина без значений остается NaN
+        stats[col] = (
+            mean,
+            np.fmin.reduceat(series, starts),
+            np.fmax.reduceat(series, starts),
+            count,
+        )
+    return buckets[starts] * bucket_ns, stats
+
+
+def merge_rollups(bucket, stats, tail_bucket, tail_stats):
+    """
+    Добавление агрегатов новых строк к уже посчитанным. Первая корзина хвоста может совпадать
+    с последней сохраненной (она была неполной): тогда они объединяются без повторного чтения строк
+
+    :param bucket: начала сохраненных корзин
+    :param stats: словарь столбец -> (mean, min, max, count) сохраненных корзин
+    :param tail_bucket: начала корзин новых строк
+    :param tail_stats: агрегаты новых строк
+    :return: (начала корзин, словарь столбец -> (mean, min, max, count))
+    """
+    if not len(tail_bucket):
+        return bucket, stats
+    if not len(bucket) or bucket[-1] != tail_bucket[0]:
+        return np.concatenate([bucket, tail_bucket]), {
+            col: tuple(np.concatenate([old, new]) for old, new in zip(stats[col], tail_stats[col])) for col in stats
+        }
+    merged = {}
+    for col in stats:
+        mean, low, high, count = stats[col]
+        tail_mean, tail_low, tail_high, tail_count = tail_stats[col]
+        total = count[-1] + tail_count[0]
+        # Среднее по обеим частям корзины взвешивается числом значений; NaN - часть без значений
+        joined_mean = (
+            (np.nan_to_num(mean[-1]) * count[-1] + np.nan_to_num(tail_mean[0]) * tail_count[0]) / total
+            if total else np.nan
+        )
+        joined = (joined_mean, np.fmin(low[-1], tail_low[0]), np.fmax(high[-1], tail_high[0]), total)
+        merged[col] = tuple(
+            np.concatenate([old[:-1], np.array([value], dtype=old.dtype), new[1:]])
+            for old, value, new in zip(stats[col], joined, tail_stats[col])
+        )
+    return np.concatenate([bucket, tail_bucket[1:]]), merged
+
+
+def choose_resolution(begin, end, n_buckets):
+    """
+    Самое грубое разрешение агрегатов, которое еще дает не меньше n_buckets корзин на отрезке
+
+    :param begin: начало отрезка
+    :param end: конец отрезка
+    :param n_buckets: сколько корзин нужно для картинки
+    :return: имя разрешения или None, если нужны сырые данные
+    """
+    length = pd.Timestamp(end).value - pd.Timestamp(begin).value
+    for name, bucket_ns in sorted(RESOLUTIONS.items(), key=lambda item: -item[1]):
+        if length // bucket_ns >= n_buckets:
+            return name
+    return None
+
+
+class RollupStore:
+    """
+    Предрассчитанные часовые и суточные агрегаты (mean/min/max/count) по всем столбцам приборов.
+    Агрегаты считаются по месячным csv и хранятся в .npz рядом с кешем данных вместе со смещением в байтах,
+    до которого файл прочитан. Если файл дописали, разбираются только новые строки (как в горячем окне),
+    а их агрегаты объединяются с последними корзинами. Фоновый поток бота (start) держит агрегаты
+    всех приборов готовыми, процессы-исполнители досчитывают только то, что появилось после его прохода
+    """
+
+    def __init__(self, proc_data, path_rollups, poll_interval=300.0):
+        """
+        :param proc_data: ProcDataCache
+        :param path_rollups: путь до папки с агрегатами
+        :param poll_interval: период фонового пересчета в секундах
+        """
+        self.proc_data = proc_data
+        self.path_rollups = path_rollups
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # (прибор, месяц) -> (mtime_ns, размер) исходного csv, по которому фоновый поток уже посчитал агрегаты
+        self._seen = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, list_devices):
+        """
+        Запуск фонового потока пересчета
+
+        :param list_devices: функция без аргументов, возвращающая текущий список приборов
+        """
+        if self._thread is not None or not self.poll_interval:
+            return
+        self._thread = threading.Thread(target=self._run, args=(list_devices,), name="rollups", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, list_devices):
+        while True:
+            self.poll(list_devices())
+            if self._stop.wait(self.poll_interval):
+                return
+
+    def poll(self, devices):
+        """
+        Досчет агрегатов всех месяцев приборов, начиная с новых (их смотрят чаще).
+        Месяцы, файлы которых не менялись с прошлого прохода, пропускаются по os.stat
+
+        :param devices: список приборов
+        """
+        for device in devices:
+            try:
+                names = os.listdir(f"{self.proc_data.path_proc_data}/{device}")
+            except FileNotFoundError:
+                continue
+            months = sorted((name[:-4] for name in names if name.endswith(".csv")), reverse=True)
+            for month in months:
+                if self._stop.is_set():
+                    return
+                try:
+                    stat = os.stat(self.proc_data.source_path(device, month))
+                    if self._seen.get((device, month)) == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    for resolution in RESOLUTIONS:
+                        self.month_rollup(device, month, resolution)
+                    self._seen[(device, month)] = (stat.st_mtime_ns, stat.st_size)
+                except Exception as e:
+                    logging.warning(f"Rollups: ошибка пересчета {device}/{month}: {e.__class__.__name__}: {e}")
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _path(self, device, month, resolution):
+        return f"{self.path_rollups}/{device}/{month}_{resolution}.npz"
+
+    @staticmethod
+    def _read(path):
+        """
+        :return: (метаданные, начала корзин, словарь столбец -> агрегаты) или None
+        """
+        try:
+            with np.load(path) as data:
+                header = [str(col) for col in data["header"]]
+                meta = {key: int(data[key]) for key in ("mtime_ns", "size", "inode", "offset", "rows")}
+                meta["header"] = header
+                meta["decimal"] = dict(zip(header, (str(sep) for sep in data["decimal"])))
+                columns = RollupStore.columns(header)
+                stats = {
+                    col: tuple(data[f"{stat}_{i}"] for stat in ("mean", "min", "max", "count"))
+                    for i, col in enumerate(columns)
+                }
+                return meta, data["bucket"], stats
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            # Файла нет, он поврежден или записан старым форматом без смещения -> агрегаты считаются заново
+            return None
+
+    @staticmethod
+    def columns(header):
+        """
+        :param header: заголовок csv
+        :return: столбцы значений (без метки времени)
+        """
+        return [col for col in header if col != ProcDataCache.time_col]
+
+    @staticmethod
+    def _write(path, meta, bucket, stats):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {key: meta[key] for key in ("mtime_ns", "size", "inode", "offset", "rows")}
+        arrays["header"] = np.array(meta["header"], dtype=str)
+        arrays["decimal"] = np.array([meta["decimal"][col] for col in meta["header"]], dtype=str)
+        arrays["bucket"] = bucket
+        for i, col in enumerate(RollupStore.columns(meta["header"])):
+            for stat, array in zip(("mean", "min", "max", "count"), stats[col]):
+                arrays[f"{stat}_{i}"] = array
+        # Временный файл свой у каждого процесса и потока: агрегаты пишут несколько процессов пула
+        tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp, path)
+
+    def month_rollup(self, device, month, resolution):
+        """
+        Агрегаты месяца (досчитываются по новым строкам, если исходный csv дописали)
+
+        :param device: прибор
+        :param month: месяц в формате YYYY_MM
+        :param resolution: имя разрешения из RESOLUTIONS
+        :return: (начала корзин, словарь столбец -> (mean, min, max, count)) или None, если файла нет
+        """
+        source = self.proc_data.source_path(device, month)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return None
+        path = self._path(device, month, resolution)
+        with self._key_lock((device, month, resolution)):
+            stored = self._read(path)
+            if stored is not None:
+                meta, bucket, stats = stored
+                if (meta["inode"], meta["mtime_ns"], meta["size"]) == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                    return bucket, stats
+                if meta["inode"] != stat.st_ino or stat.st_size < meta["offset"]:
+                    # Файл перезаписан: прочитанные строки могли измениться -> считаем месяц заново
+                    stored = None
+            if stored is None:
+                meta = {"offset": 0, "rows": 0, "header": None, "decimal": None}
+                bucket, stats = None, None
+            tail = ProcDataCache.read_tail(
+                source, meta["offset"], stat.st_size, meta["header"], meta["decimal"], "float64"
+            )
+            if tail is not None:
+                offset, header, decimal, timestamps, values = tail
+                tail_bucket, tail_stats = compute_rollup(timestamps, values, RESOLUTIONS[resolution])
+                if bucket is None:
+                    bucket, stats = tail_bucket, tail_stats
+                else:
+                    bucket, stats = merge_rollups(bucket, stats, tail_bucket, tail_stats)
+                meta.update(offset=offset, header=header, decimal=decimal, rows=meta["rows"] + len(timestamps))
+            elif bucket is None:
+                # В файле еще нет ни одной полной строки
+                return compute_rollup([], {}, RESOLUTIONS[resolution])
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size, inode=stat.st_ino)
+            self._write(path, meta, bucket, stats)
+            return bucket, stats
+
+    def load_range(self, device, begin, end, columns, resolution):
+        """
+        Агрегаты выбранных столбцов прибора за отрезок [begin, end]
+
+        :param device: прибор
+        :param begin: начало отрезка
+        :param end: конец отрезка (включительно)
+        :param columns: нужные столбцы
+        :param resolution: имя разрешения из RESOLUTIONS
+        :return: (начала корзин, словарь столбец -> (mean, min, max, count))
+        """
+        begin_ns, end_ns = pd.Timestamp(begin).value, pd.Timestamp(end).value
+        parts_bucket, parts_stats = [], {col: [] for col in columns}
+        for month in self.proc_data.months_between(begin, end):
+            rollup = self.month_rollup(device, month, resolution)
+            if rollup is None:
+                continue
+            bucket, stats = rollup
+            left = np.searchsorted(bucket, begin_ns, side="left")
+            right = np.searchsorted(bucket, end_ns, side="right")
+            parts_bucket.append(bucket[left:right])
+            for col in columns:
+                if col in stats:
+                    parts_stats[col].append(tuple(array[left:right] for array in stats[col]))
+                else:
+                    empty = np.full(right - left, np.nan)
+                    parts_stats[col].append((empty, empty, empty, np.zeros(right - left, dtype="int64")))
+        if not parts_bucket:
+            return np.empty(0, dtype="int64"), {
+                col: tuple(np.empty(0) for _ in range(3)) + (np.empty(0, dtype="int64"),) for col in columns
+            }
+        return np.concatenate(parts_bucket), {
+            col: tuple(np.concatenate(arrays) for arrays in zip(*parts)) for col, parts in parts_stats.items()
+        }
@@ -0,0 +1,59 @@
+class Router:
+    """
+    Таблица маршрутизации текстовых сообщений: текст кнопки -> обработчик.
+    Вместо проверки фильтров всех обработчиков по очереди сообщение находится одним обращением к словарю.
+    Имена приборов и комплексов берутся из кеша каталога, таблица пересобирается только
+    после того, как каталог перечитал базу (Catalog.generation изменился).
+    При совпадении текстов побеждает маршрут, зарегистрированный раньше, как и при фильтрах telebot
+    """
+
+    def __init__(self, catalog):
+        """
+        :param catalog: Catalog, из которого берутся имена приборов и комплексов
+        """
+        self.catalog = catalog
+        # (функция без аргументов, возвращающая тексты, обработчик) в порядке регистрации
+        self._routes = []
+        self._table = {}
+        self._generation = None
+
+    def text(self, *texts):
+        """
+        Декоратор: обработчик для фиксированных текстов кнопок
+
+        :param texts: тексты кнопок
+        """
+        return self.names(lambda: texts)
+
+    def names(self, source):
+        """
+        Декоратор: обработчик для текстов, которые меняются вместе с каталогом (имена приборов, комплексов)
+
+        :param source: функция без аргументов, возвращающая тексты по текущему состоянию каталога
+        """
+
+        def decorator(handler):
+            self._routes.append((source, handler))
+            self._generation = None
+            return handler
+
+        return decorator
+
+    def _rebuild(self):
+        table = {}
+        for source, handler in reversed(self._routes):
+            for text in source():
+                table[text] = handler
+        self._table = table
+
+    def resolve(self, text):
+        """
+        :param text: текст сообщения
+        :return: обработчик или None, если текст не относится ни к одной кнопке
+        """
+        self.catalog.refresh()
+        generation = self.catalog.generation
+        if self._generation != generation:
+            self._rebuild()
+            self._generation = generation
+        return self._table.get(text)
@@ -0,0 +1,159 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import registry
+
+
+class SessionStore:
+    """
+    Хранилище параметров пользователей.
+    Все сессии живут в памяти (словарь user_id -> параметры), а изменения пачками
+    сбрасываются в SQLite (режим WAL) фоновым потоком. Каждая сессия хранится отдельной строкой,
+    поэтому нажатие кнопки стоит O(1) работы с диском, а запись атомарна (одна транзакция на пачку).
+    Наружу отдаются только копии сессий, а меняются сессии через update и edit под блокировкой хранилища:
+    обработчики, фоновые планировщики и сброс на диск не видят наполовину измененную сессию
+    """
+
+    def __init__(self, path_db, legacy_json=None, flush_interval=1.0):
+        """
+        :param path_db: путь до файла базы с сессиями
+        :param legacy_json: путь до старого user_info.json, из которого сессии переносятся при первом запуске
+        :param flush_interval: период (в секундах) сброса изменений на диск
+        """
+        self.path_db = path_db
+        self.flush_interval = flush_interval
+        # Повторный вход нужен, чтобы внутри edit можно было читать хранилище
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._sessions = {}
+        # user_id -> сериализованная сессия, ожидающая записи
+        self._pending = {}
+        self._conn = sqlite3.connect(path_db, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        for user_id, data in self._conn.execute("SELECT user_id, data FROM sessions"):
+            self._sessions[user_id] = json.loads(data)
+        if not self._sessions and legacy_json and os.path.exists(legacy_json):
+            with open(legacy_json, "r") as file:
+                for user_id, data in json.load(file).items():
+                    self[user_id] = data
+            self.flush()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="sessions-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._sessions
+
+    def __getitem__(self, user_id):
+        """
+        :param user_id: id пользователя
+        :return: копия параметров пользователя (ее изменения в хранилище не попадают, см. update и edit)
+        """
+        with self._lock:
+            return copy.deepcopy(self._sessions[str(user_id)])
+
+    def __setitem__(self, user_id, data):
+        """
+        Замена всей сессии пользователя с последующим сохранением
+
+        :param user_id: id пользователя
+        :param data: новые параметры пользователя
+        """
+        with self.edit(user_id, create=True) as user_info:
+            user_info.clear()
+            user_info.update(copy.deepcopy(data))
+
+    def items(self):
+        """
+        :return: копии пар (user_id, параметры) всех пользователей
+        """
+        with self._lock:
+            return copy.deepcopy(list(self._sessions.items()))
+
+    def update(self, user_id, **fields):
+        """
+        Замена отдельных параметров пользователя с постановкой сессии в очередь на запись
+
+        :param user_id: id пользователя
+        :param fields: новые значения параметров
+        :return: копия параметров пользователя после изменения
+        """
+        with self.edit(user_id) as user_info:
+            user_info.update(copy.deepcopy(fields))
+            return copy.deepcopy(user_info)
+
+    @contextmanager
+    def edit(self, user_id, create=False):
+        """
+        Изменение сессии на месте (вложенные параметры: выбранные столбцы, подписки).
+        Весь блок выполняется под блокировкой хранилища, а после него сессия сериализуется в очередь на запись,
+        поэтому одновременные изменения одного пользователя не теряются и в очередь не попадает более старый снимок.
+        Внутри блока нельзя ждать сеть или пул построения: остальные обращения к сессиям ждут его окончания
+
+        :param user_id: id пользователя
+        :param create: создать пустую сессию, если ее нет
+        :return: сама сессия пользователя (ссылку нельзя сохранять после выхода из блока)
+        """
+        user_id = str(user_id)
+        with self._lock:
+            if create:
+                user_info = self._sessions.setdefault(user_id, {})
+            else:
+                user_info = self._sessions[user_id]
+            try:
+                yield user_info
+            finally:
+                self._pending[user_id] = json.dumps(user_info, ensure_ascii=False)
+
+    def flush(self):
+        """
+        Запись всех накопленных изменений одной транзакцией
+        """
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                with self._conn, registry.timer("bot_sqlite_seconds", db="sessions"):
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO sessions (user_id, data) VALUES (?, ?)",
+                        pending.items(),
+                    )
+            except Exception:
+                # Не теряем изменения: более свежие записи из очереди приоритетнее
+                with self._lock:
+                    self._pending = {**pending, **self._pending}
+                raise
+
+    def _flush_loop(self):
+        """
+        Фоновый сброс изменений на диск
+        """
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f"Не удалось сохранить сессии: {e.__class__.__name__}")
+
+    def close(self):
+        """
+        Остановка фонового потока и финальный сброс изменений
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.flush()
+        self._conn.close()
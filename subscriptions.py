@@ -0,0 +1,99 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+class SubscriptionScheduler:
+    """
+    Планировщик подписок на графики.
+    Подписка - (прибор, столбцы, стандартный промежуток, время ЧЧ:ММ) в сессии пользователя
+    (user_info["subscriptions"]). Раз в interval секунд собираются подписки, время которых наступило,
+    и группируются по одинаковому графику: каждая группа строится один раз, а рассылается всем
+    ее подписчикам по file_id. Поэтому утренний пик стоит O(различных графиков), а не O(подписчиков).
+    Группа, которую не удалось поставить в пул построения (пул занят), повторяется на следующем шаге
+    """
+
+    def __init__(self, sessions, deliver, interval=20.0):
+        """
+        :param sessions: SessionStore
+        :param deliver: функция (прибор, столбцы, промежуток, список chat_id) -> статус GraphJobs.submit
+        :param interval: период проверки подписок в секундах
+        """
+        self.sessions = sessions
+        self.deliver = deliver
+        self.interval = interval
+        # Рассылка готовых картинок идет в отдельном потоке, чтобы не задерживать доставку других графиков
+        self.sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="subscription-send")
+        self._retry = {}
+        self._checked = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Запуск фонового потока планировщика
+        """
+        if self._thread is not None:
+            return
+        self._checked = datetime.now().replace(second=0, microsecond=0)
+        self._thread = threading.Thread(target=self._run, name="subscriptions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick(datetime.now())
+            except Exception as e:
+                logging.warning(f"Ошибка планировщика подписок: {e.__class__.__name__}: {e}")
+
+    def due(self, since, until):
+        """
+        Подписки со временем в промежутке (since, until], сгруппированные по графику
+
+        :param since: момент предыдущей проверки (с точностью до минуты)
+        :param until: текущий момент (с точностью до минуты)
+        :return: словарь (прибор, столбцы, промежуток) -> список chat_id
+        """
+        minutes = set()
+        moment = since + timedelta(minutes=1)
+        while moment <= until:
+            minutes.add(moment.strftime("%H:%M"))
+            moment += timedelta(minutes=1)
+        groups = {}
+        if not minutes:
+            return groups
+        for user_id, user_info in self.sessions.items():
+            for subscription in user_info.get("subscriptions", ()):
+                if subscription["time"] not in minutes:
+                    continue
+                key = (subscription["device"], tuple(sorted(subscription["columns"])), subscription["delay"])
+                chats = groups.setdefault(key, [])
+                if user_id not in chats:
+                    chats.append(user_id)
+        return groups
+
+    def tick(self, now):
+        """
+        Рассылка подписок, время которых наступило с предыдущей проверки
+
+        :param now: текущее время
+        """
+        now = now.replace(second=0, microsecond=0)
+        # После долгой остановки не рассылаем все пропущенные за сутки подписки
+        since = max(self._checked or now, now - timedelta(minutes=10))
+        groups = self.due(since, now)
+        self._checked = now
+        for key, chats in self._retry.items():
+            for chat_id in chats:
+                if chat_id not in groups.setdefault(key, []):
+                    groups[key].append(chat_id)
+        self._retry = {}
+        for (device, columns, delay), chats in groups.items():
+            status = self.deliver(device, list(columns), delay, chats)
+            if status in ("busy", "duplicate"):
+                self._retry[(device, columns, delay)] = chats
+            logging.info(f"Subscription {device} {list(columns)} {delay}: {len(chats)} chats, {status}")
@@ -0,0 +1,180 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Процентили в сводке
+PERCENTILES = (5, 50, 95)
+# Разрыв в данных: интервал между соседними строками больше стольких типичных шагов записи
+GAP_STEPS = 3
+# Сколько строк хранится для процентилей: на более длинных отрезках они считаются по равномерной выборке
+SAMPLE_ROWS = 100_000
+
+
+class StreamingSummary:
+    """
+    Числовая сводка, которая набирается по кускам данных (iter_range) с ограниченной памятью.
+    Последнее значение, минимум, максимум, среднее, пропуски и разрывы считаются точно,
+    процентили - по каждой stride-й строке: когда выборка больше SAMPLE_ROWS строк, шаг удваивается.
+    Пока строк не больше SAMPLE_ROWS, процентили тоже точные.
+    Столбцы куска складываются в одну матрицу, и все статистики считаются по ней за один проход NumPy
+    """
+
+    def __init__(self, columns, sample_rows=SAMPLE_ROWS):
+        """
+        :param columns: столбцы сводки в порядке вывода
+        :param sample_rows: сколько строк хранить для процентилей
+        """
+        self.columns = list(columns)
+        self.sample_rows = sample_rows
+        self.rows = 0
+        self.gaps = 0
+        self.gap_ns = 0
+        self._steps = []
+        self._last_time = None
+        n = len(self.columns)
+        self._min = np.full(n, np.nan)
+        self._max = np.full(n, np.nan)
+        self._sum = np.zeros(n)
+        self._count = np.zeros(n, dtype="int64")
+        self._last = np.full(n, np.nan)
+        self._last_at = [None] * n
+        self._stride = 1
+        self._sample = np.empty((n, 0))
+        self._sample_rows = np.empty(0, dtype="int64")
+
+    def add(self, timestamps, values):
+        """
+        :param timestamps: отсортированные метки времени куска (int64, наносекунды epoch), куски идут по порядку
+        :param values: словарь столбец -> значения куска
+        """
+        timestamps = np.asarray(timestamps, dtype="int64")
+        count = len(timestamps)
+        if count == 0:
+            return
+        # Разрывы по времени общие для всех столбцов: интервалы заметно длиннее типичного шага записи куска.
+        # Интервал между кусками тоже проверяется
+        steps = np.diff(timestamps if self._last_time is None else np.r_[self._last_time, timestamps])
+        if len(steps):
+            step = int(np.median(steps))
+            gaps = steps[steps > GAP_STEPS * step]
+            self.gaps += len(gaps)
+            self.gap_ns += int(gaps.sum() - step * len(gaps))
+            self._steps.append(step)
+        self._last_time = int(timestamps[-1])
+        matrix = np.vstack([np.asarray(values[col], dtype="float64") for col in self.columns])
+        valid = ~np.isnan(matrix)
+        counts = valid.sum(axis=1)
+        # Индекс последнего непустого значения в каждой строке матрицы
+        last_index = count - 1 - np.argmax(valid[:, ::-1], axis=1)
+        with warnings.catch_warnings():
+            # Для столбцов без единого значения nan-функции возвращают NaN, предупреждения не нужны
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            self._min = np.fmin(self._min, np.nanmin(matrix, axis=1))
+            self._max = np.fmax(self._max, np.nanmax(matrix, axis=1))
+        self._sum += np.where(valid, matrix, 0.0).sum(axis=1)
+        self._count += counts
+        for i in np.flatnonzero(counts):
+            self._last[i] = matrix[i, last_index[i]]
+            self._last_at[i] = int(timestamps[last_index[i]])
+        # Выборка для процентилей: строки с номером, кратным stride, считая от начала отрезка
+        rows = np.arange(self.rows, self.rows + count)
+        taken = rows % self._stride == 0
+        self._sample = np.hstack([self._sample, matrix[:, taken]])
+        self._sample_rows = np.r_[self._sample_rows, rows[taken]]
+        while len(self._sample_rows) > self.sample_rows:
+            self._stride *= 2
+            keep = self._sample_rows % self._stride == 0
+            self._sample, self._sample_rows = self._sample[:, keep], self._sample_rows[keep]
+        self.rows += count
+
+    def result(self):
+        """
+        :return: словарь с общими полями (rows, gaps, gap_ns, step_ns) и полем columns: столбец -> статистики
+        """
+        summary = {
+            "rows": self.rows,
+            "gaps": self.gaps,
+            "gap_ns": self.gap_ns,
+            "step_ns": int(np.median(self._steps)) if self._steps else None,
+            "columns": {},
+        }
+        if self.rows == 0:
+            return summary
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            mean = np.where(self._count > 0, self._sum / np.maximum(self._count, 1), np.nan)
+            percentiles = np.nanpercentile(self._sample, PERCENTILES, axis=1)
+        for i, col in enumerate(self.columns):
+            summary["columns"][col] = {
+                "last": self._last[i],
+                "last_time": self._last_at[i],
+                "min": self._min[i],
+                "max": self._max[i],
+                "mean": mean[i],
+                "percentiles": dict(zip(PERCENTILES, percentiles[:, i])),
+                "missing": self.rows - int(self._count[i]),
+            }
+        return summary
+
+
+def summarize(timestamps, values, columns):
+    """
+    Числовая сводка по выбранным столбцам за отрезок без построения картинки (данные уже в памяти)
+
+    :param timestamps: отсортированные метки времени (int64, наносекунды epoch)
+    :param values: словарь столбец -> значения
+    :param columns: столбцы сводки в порядке вывода
+    :return: словарь с общими полями (rows, gaps, gap_ns, step_ns) и полем columns: столбец -> статистики
+    """
+    summary = StreamingSummary(columns, sample_rows=max(len(timestamps), 1))
+    summary.add(timestamps, values)
+    return summary.result()
+
+
+def format_number(value):
+    """
+    :param value: число
+    :return: короткая запись числа для сообщения
+    """
+    if value is None or np.isnan(value):
+        return "—"
+    return f"{value:.4g}"
+
+
+def format_summary(title, begin, end, summary):
+    """
+    :param title: имя прибора
+    :param begin: начало отрезка
+    :param end: конец отрезка
+    :param summary: результат summarize
+    :return: текст сообщения со сводкой
+    """
+    lines = [f"{title}: {pd.Timestamp(begin):%d.%m.%Y} - {pd.Timestamp(end):%d.%m.%Y}"]
+    if summary["rows"] == 0:
+        lines.append("Нет данных за этот промежуток")
+        return "\n".join(lines)
+    lines.append(f"Строк: {summary['rows']}")
+    if summary["gaps"]:
+        gap = pd.Timedelta(summary["gap_ns"])
+        lines.append(f"Разрывов в данных: {summary['gaps']}, всего {gap.total_seconds() / 3600:.1f} ч")
+    else:
+        lines.append("Разрывов в данных нет")
+    for col, stats in summary["columns"].items():
+        lines.append("")
+        if stats["last_time"] is None:
+            lines.append(f"{col}: нет значений")
+            continue
+        lines.append(
+            f"{col}: последнее {format_number(stats['last'])} "
+            f"({pd.Timestamp(stats['last_time']):%H:%M %d.%m.%Y})"
+        )
+        lines.append(
+            f"мин {format_number(stats['min'])}, макс {format_number(stats['max'])}, "
+            f"среднее {format_number(stats['mean'])}"
+        )
+        lines.append(", ".join(f"p{p} {format_number(v)}" for p, v in stats["percentiles"].items()))
+        if stats["missing"]:
+            share = stats["missing"] / summary["rows"] * 100
+            lines.append(f"пропущено значений: {stats['missing']} ({share:.1f}%)")
+    return "\n".join(lines)
@@ -0,0 +1,127 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_cache import ProcDataCache, StaleCacheError
+
+
+def write_month(path_proc_data, device, index, values):
+    """
+    Месячный csv в формате сайта: метки времени и числа с десятичной запятой
+    """
+    data = pd.DataFrame({"timestamp": index.strftime("%Y-%m-%d %H:%M:%S"), **values})
+    os.makedirs(f"{path_proc_data}/{device}", exist_ok=True)
+    path = f"{path_proc_data}/{device}/{index[0].strftime('%Y_%m')}.csv"
+    data.to_csv(path, index=False, decimal=",", float_format="%.3f")
+    return path
+
+
+@pytest.fixture
+def site(tmp_path):
+    """
+    Прибор dev с данными за январь и февраль 2024 года (раз в 10 минут)
+    """
+    path_proc_data = str(tmp_path / "proc_data")
+    index = pd.date_range("2024-01-01", "2024-02-29 23:50", freq="10min")
+    values = {"a": np.arange(len(index)) * 0.5, "b": np.sin(np.arange(len(index)))}
+    for month in ("2024-01", "2024-02"):
+        part = index.strftime("%Y-%m") == month
+        write_month(path_proc_data, "dev", index[part], {col: series[part] for col, series in values.items()})
+    return path_proc_data, index, values
+
+
+def make_cache(site, tmp_path, dtype="float64"):
+    return ProcDataCache(site[0], str(tmp_path / "cache"), dtype)
+
+
+def test_load_range_slices_across_months(site, tmp_path):
+    _, index, values = site
+    cache = make_cache(site, tmp_path)
+    begin, end = pd.Timestamp("2024-01-20 12:00"), pd.Timestamp("2024-02-10 06:00")
+    timestamps, loaded = cache.load_range("dev", begin, end, ["a", "b", "missing"])
+    expected = (index >= begin) & (index <= end)
+    np.testing.assert_array_equal(timestamps, index[expected].values.astype("int64"))
+    np.testing.assert_allclose(loaded["a"], values["a"][expected], atol=1e-3)
+    np.testing.assert_allclose(loaded["b"], values["b"][expected], atol=1e-3)
+    # Столбца нет в файле -> NaN той же длины
+    assert len(loaded["missing"]) == expected.sum() and np.isnan(loaded["missing"]).all()
+
+
+def test_iter_range_chunks_match_load_range(site, tmp_path):
+    cache = make_cache(site, tmp_path)
+    begin, end = pd.Timestamp("2024-01-15"), pd.Timestamp("2024-02-15")
+    timestamps, loaded = cache.load_range("dev", begin, end, ["a"])
+    chunks = list(cache.iter_range("dev", begin, end, ["a"], chunk_rows=1000))
+    assert all(len(chunk_time) <= 1000 for chunk_time, _ in chunks)
+    np.testing.assert_array_equal(np.concatenate([chunk_time for chunk_time, _ in chunks]), timestamps)
+    np.testing.assert_array_equal(np.concatenate([chunk["a"] for _, chunk in chunks]), loaded["a"])
+
+
+def test_empty_range_and_missing_device(site, tmp_path):
+    cache = make_cache(site, tmp_path)
+    timestamps, loaded = cache.load_range("dev", "2023-05-01", "2023-06-01", ["a"])
+    assert len(timestamps) == 0 and len(loaded["a"]) == 0
+    assert cache.load_arrays("other", "2024_01", ["a"]) is None
+
+
+def test_rebuild_after_source_changes(site, tmp_path, monkeypatch):
+    path_proc_data, index, values = site
+    monkeypatch.setattr(ProcDataCache, "stale_seconds", 0)
+    cache = make_cache(site, tmp_path)
+    february = index.strftime("%Y-%m") == "2024-02"
+    before = cache.data_version("dev", "2024-02-01", "2024-02-29")
+    timestamps, _ = cache.load_arrays("dev", "2024_02", ["a"])
+    assert len(timestamps) == february.sum()
+    # Сайт перезаписал файл: в нем только первые 100 строк с другими значениями
+    path = write_month(path_proc_data, "dev", index[february][:100], {"a": np.full(100, 7.0)})
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.data_version("dev", "2024-02-01", "2024-02-29") != before
+    timestamps, loaded = cache.load_arrays("dev", "2024_02", ["a"])
+    assert len(timestamps) == 100
+    np.testing.assert_array_equal(loaded["a"], np.full(100, 7.0))
+    # Старая версия удалена, временных папок не осталось
+    assert len(os.listdir(tmp_path / "cache" / "dev" / "2024_02")) == 1
+
+
+def test_load_arrays_retries_stale_version(site, tmp_path):
+    cache = make_cache(site, tmp_path)
+    build_columns = cache._build_columns
+    calls = []
+
+    def flaky(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise StaleCacheError("dev/2024_01")
+        return build_columns(*args)
+
+    cache._build_columns = flaky
+    timestamps, loaded = cache.load_arrays("dev", "2024_01", ["a"])
+    assert len(calls) == 2 and len(loaded["a"]) == len(timestamps)
+
+
+def test_concurrent_builders_share_one_version(site, tmp_path):
+    # Отдельные экземпляры кеша в потоках ведут себя как разные процессы: у них нет общих блокировок
+    results, errors = [], []
+
+    def worker():
+        try:
+            cache = make_cache(site, tmp_path, dtype="float32")
+            results.append(cache.load_range("dev", "2024-01-01", "2024-02-29", ["a", "b"]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    for timestamps, loaded in results[1:]:
+        np.testing.assert_array_equal(timestamps, results[0][0])
+        np.testing.assert_array_equal(loaded["b"], results[0][1]["b"])
+    for month in ("2024_01", "2024_02"):
+        assert len(os.listdir(tmp_path / "cache" / "dev" / month)) == 1
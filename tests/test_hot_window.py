@@ -0,0 +1,143 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_cache import ProcDataCache
+from hot_window import HotWindow
+
+
+def recent_index(periods, freq="10min"):
+    """
+    Метки последних periods шагов до текущего момента: окно отсчитывается от "сейчас"
+    """
+    return pd.date_range(end=pd.Timestamp.now().floor(freq) - pd.Timedelta(freq), periods=periods, freq=freq)
+
+
+def write_rows(path_proc_data, device, index, values):
+    """
+    Запись строк в месячные csv в формате сайта (десятичная запятая).
+    Строки дописываются в конец существующего файла, заголовок пишется только в новый файл
+    """
+    os.makedirs(f"{path_proc_data}/{device}", exist_ok=True)
+    for month in index.strftime("%Y_%m").unique():
+        part = index.strftime("%Y_%m") == month
+        data = pd.DataFrame(
+            {"timestamp": index[part].strftime("%Y-%m-%d %H:%M:%S"), **{col: v[part] for col, v in values.items()}}
+        )
+        path = f"{path_proc_data}/{device}/{month}.csv"
+        exists = os.path.exists(path)
+        data.to_csv(path, mode="a" if exists else "w", header=not exists, index=False, decimal=",",
+                    float_format="%.3f")
+
+
+def make_values(index, shift=0.0):
+    return {"a": np.arange(len(index)) * 0.5 + shift, "b": np.cos(np.arange(len(index)))}
+
+
+@pytest.fixture
+def proc_data(tmp_path):
+    return str(tmp_path / "proc_data")
+
+
+def make_window(proc_data, **kwargs):
+    return HotWindow(proc_data, window_days=2, poll_interval=0, dtype="float64", **kwargs)
+
+
+def assert_window(window, index, values, begin=None):
+    begin = index[0] if begin is None else begin
+    timestamps, loaded, _ = window.load_range("dev", begin, index[-1], ["a", "b"])
+    expected = index >= begin
+    np.testing.assert_array_equal(timestamps, index[expected].values.astype("int64"))
+    for col in ("a", "b"):
+        np.testing.assert_allclose(loaded[col], values[col][expected], atol=1e-3)
+
+
+def test_ingest_resumes_from_byte_offset(proc_data, tmp_path, monkeypatch):
+    index = recent_index(200)
+    values = make_values(index)
+    write_rows(proc_data, "dev", index[:120], {col: v[:120] for col, v in values.items()})
+    window = make_window(proc_data)
+    window.ingest("dev")
+    version = window.version("dev", index[0])
+    assert_window(window, index[:120], {col: v[:120] for col, v in values.items()})
+
+    parsed = []
+    read_timestamps = ProcDataCache.read_timestamps
+
+    def counting_read_timestamps(source, **kwargs):
+        timestamps = read_timestamps(source, **kwargs)
+        parsed.append(len(timestamps))
+        return timestamps
+
+    monkeypatch.setattr(ProcDataCache, "read_timestamps", staticmethod(counting_read_timestamps))
+    window.ingest("dev")
+    # Файлы не менялись -> ничего не разбирается, версия та же
+    assert parsed == [] and window.version("dev", index[0]) == version
+
+    write_rows(proc_data, "dev", index[120:], {col: v[120:] for col, v in values.items()})
+    window.ingest("dev")
+    # Разбираются только дописанные строки
+    assert sum(parsed) == 80
+    assert window.version("dev", index[0]) != version
+    assert_window(window, index, values)
+    # Срез окна совпадает с обычным кешем данных
+    cache = ProcDataCache(proc_data, str(tmp_path / "cache"), "float64")
+    timestamps, loaded = cache.load_range("dev", index[10], index[-1], ["a", "b"])
+    hot_timestamps, hot_loaded, _ = window.load_range("dev", index[10], index[-1], ["a", "b"])
+    np.testing.assert_array_equal(hot_timestamps, timestamps)
+    for col in ("a", "b"):
+        np.testing.assert_array_equal(hot_loaded[col], loaded[col])
+
+
+def test_partial_last_line_waits_for_newline(proc_data):
+    index = recent_index(50)
+    values = make_values(index)
+    write_rows(proc_data, "dev", index[:49], {col: v[:49] for col, v in values.items()})
+    window = make_window(proc_data)
+    window.ingest("dev")
+    version = window.version("dev", index[0])
+    path = f"{proc_data}/dev/{index[-1].strftime('%Y_%m')}.csv"
+    numbers = [f'"{values[col][-1]:.3f}"'.replace(".", ",") for col in ("a", "b")]
+    line = ",".join([index[-1].strftime("%Y-%m-%d %H:%M:%S"), *numbers])
+    # Сайт еще не дописал строку: ее начало не читается и не сдвигает смещение
+    with open(path, "a") as file:
+        file.write(line[:15])
+    window.ingest("dev")
+    assert window.version("dev", index[0]) == version
+    assert_window(window, index[:49], {col: v[:49] for col, v in values.items()})
+    with open(path, "a") as file:
+        file.write(line[15:] + "\n")
+    window.ingest("dev")
+    assert_window(window, index, values)
+
+
+def test_rewritten_file_resets_window(proc_data):
+    index = recent_index(100)
+    write_rows(proc_data, "dev", index, make_values(index))
+    window = make_window(proc_data)
+    window.ingest("dev")
+    # Файлы перезаписаны короче и с другими значениями -> окно читается заново
+    shutil.rmtree(f"{proc_data}/dev")
+    index = index[:60]
+    values = make_values(index, shift=100.0)
+    write_rows(proc_data, "dev", index, values)
+    window.ingest("dev")
+    assert_window(window, index, values)
+
+
+def test_max_bytes_evicts_oldest_rows(proc_data):
+    index = recent_index(1500, freq="1min")
+    values = make_values(index)
+    write_rows(proc_data, "dev", index, values)
+    # Лимит меньше начальной вместимости окна -> окно не растет дальше 1024 строк
+    window = make_window(proc_data, max_bytes=1024)
+    window.ingest("dev")
+    assert window.memory_usage() <= 1024 * (8 + 2 * 8)
+    # Начало отрезка выселено -> окно его не отдает, график пойдет через кеш данных
+    assert window.load_range("dev", index[0], index[-1], ["a"]) is None
+    assert window.version("dev", index[0]) is None
+    kept = index[-1024:]
+    assert_window(window, kept, {col: v[-1024:] for col, v in values.items()})
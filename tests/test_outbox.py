@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+
+from outbox import AsyncOutbox, Outbox, TokenBucket
+
+
+class Response:
+    status_code = 400
+    reason = "Bad Request"
+
+
+def telegram_error(code, description, retry_after=None, error_class=ApiTelegramException):
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return error_class("send_message", Response(), result_json)
+
+
+class FakeBot:
+    """
+    Заглушка telebot.TeleBot: запоминает вызовы, а ошибки для вызовов берет из очереди errors
+    """
+
+    def __init__(self):
+        self.calls = []
+        # (метод, чат строкой) -> список исключений, которые по очереди выбросят следующие вызовы
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def _call(self, method, chat_id, *args, **kwargs):
+        with self._lock:
+            self.calls.append((time.monotonic(), method, chat_id, args, kwargs))
+            errors = self.errors.get((method, str(chat_id)))
+            if errors:
+                raise errors.pop(0)
+        return (method, chat_id, args)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call("send_message", chat_id, text, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self._call("edit_message_text", chat_id, text, message_id=message_id)
+
+    def texts(self, chat_id=None):
+        return [args[0] for _, method, chat, args, _ in self.calls if chat_id is None or str(chat) == str(chat_id)]
+
+
+class FakeAsyncBot:
+    """
+    Заглушка AsyncTeleBot: корутины поверх FakeBot, запоминают, в каком потоке выполнялись
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.threads = set()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.threads.add(threading.current_thread())
+        await asyncio.sleep(0)
+        return self.bot.send_message(chat_id, text, **kwargs)
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+def make_outbox(bot, **kwargs):
+    options = dict(chat_rate=100.0, chat_burst=100, global_rate=1000.0, threads=2, max_attempts=3)
+    options.update(kwargs)
+    return Outbox(bot, **options)
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=2.0, burst=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.ready_at(now) == now
+        bucket.take(now)
+    assert bucket.ready_at(now) == pytest.approx(now + 0.5)
+    assert bucket.ready_at(now + 1.0) == now + 1.0
+
+
+def test_chat_rate_limit_keeps_order(bot):
+    outbox = make_outbox(bot, chat_rate=20.0, chat_burst=2, threads=4)
+    futures = [outbox.send_message(1, f"m{i}") for i in range(5)]
+    other = outbox.send_message(2, "other")
+    for future in futures + [other]:
+        future.result(timeout=5)
+    outbox.close()
+    assert bot.texts(1) == [f"m{i}" for i in range(5)]
+    times = [at for at, _, chat, _, _ in bot.calls if chat == 1]
+    # Два сообщения подряд без паузы, дальше не чаще 20 в секунду
+    assert times[4] - times[0] >= 3 / 20 * 0.9
+    # Другой чат не ждет ограничения первого
+    assert [at for at, _, chat, _, _ in bot.calls if chat == 2][0] < times[-1]
+
+
+def test_edits_of_one_message_are_coalesced(bot):
+    outbox = make_outbox(bot)
+    futures = [outbox.edit_message_text(f"v{i}", 1, 10, delay=0.2) for i in range(3)]
+    results = [future.result(timeout=5) for future in futures]
+    outbox.close()
+    # Ушла одна правка с последним состоянием, ответ получили все три future
+    assert bot.texts() == ["v2"]
+    assert results[0] == results[1] == results[2]
+
+
+def test_not_modified_counts_as_success(bot):
+    bot.errors[("edit_message_text", "1")] = [telegram_error(400, "Bad Request: message is not modified")]
+    outbox = make_outbox(bot)
+    assert outbox.edit_message_text("same", 1, 10).result(timeout=5) is None
+    outbox.close()
+
+
+def test_429_is_retried_after_retry_after(bot):
+    bot.errors[("send_message", "1")] = [telegram_error(429, "Too Many Requests", retry_after=0.2)]
+    outbox = make_outbox(bot)
+    first = outbox.send_message(1, "first")
+    second = outbox.send_message(1, "second")
+    assert first.result(timeout=5)[2] == ("first",)
+    second.result(timeout=5)
+    outbox.close()
+    # Повтор через retry_after, порядок сообщений в чате сохранен
+    assert bot.texts(1) == ["first", "first", "second"]
+    assert bot.calls[1][0] - bot.calls[0][0] >= 0.2 * 0.9
+
+
+def test_exhausted_retries_fail_and_notify_user(bot):
+    bot.errors[("send_message", "1")] = [telegram_error(429, "Too Many Requests", retry_after=0.01)] * 3
+    outbox = make_outbox(bot)
+    future = outbox.send_message(1, "lost")
+    with pytest.raises(ApiTelegramException):
+        future.result(timeout=5)
+    time.sleep(0.2)
+    outbox.close()
+    assert bot.texts(1) == ["lost"] * 3 + [Outbox.fail_notice]
+
+
+def test_no_notice_without_notify_after_403_or_for_failed_notice(bot):
+    bot.errors[("send_message", "1")] = [telegram_error(400, "Bad Request")]
+    bot.errors[("send_message", "2")] = [telegram_error(403, "Forbidden: bot was blocked by the user")]
+    bot.errors[("send_message", "3")] = [telegram_error(400, "Bad Request")] * 2
+    outbox = make_outbox(bot)
+    quiet = outbox.send_message(1, "quiet", notify=False)
+    blocked = outbox.send_message(2, "blocked")
+    failed = outbox.send_message(3, "failed")
+    for future in (quiet, blocked, failed):
+        with pytest.raises(ApiTelegramException):
+            future.result(timeout=5)
+    time.sleep(0.2)
+    outbox.close()
+    assert bot.texts(1) == ["quiet"]
+    assert bot.texts(2) == ["blocked"]
+    # Уведомление тоже не ушло -> оно только логируется, нового уведомления нет
+    assert bot.texts(3) == ["failed", Outbox.fail_notice]
+
+
+def test_async_outbox_runs_requests_in_event_loop(bot):
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    async_bot = FakeAsyncBot(bot)
+    bot.errors[("send_message", "1")] = [
+        telegram_error(429, "Too Many Requests", retry_after=0.05, error_class=asyncio_helper.ApiTelegramException)
+    ]
+    bot.errors[("send_message", "2")] = [
+        telegram_error(400, "Bad Request", error_class=asyncio_helper.ApiTelegramException)
+    ]
+    outbox = AsyncOutbox(async_bot, loop, chat_rate=100.0, chat_burst=100, global_rate=1000.0, threads=2)
+    first = outbox.send_message(1, "first")
+    failed = outbox.send_message(2, "failed", notify=False)
+    assert first.result(timeout=5)[2] == ("first",)
+    with pytest.raises(asyncio_helper.ApiTelegramException):
+        failed.result(timeout=5)
+    outbox.close()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join(timeout=5)
+    # 429 асинхронного клиента повторяется так же, как у синхронного; запросы выполнялись в цикле событий
+    assert bot.texts(1) == ["first", "first"]
+    assert async_bot.threads == {loop_thread}
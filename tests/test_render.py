@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from render import StreamingEnvelope, downsample_minmax
+
+
+@pytest.fixture
+def series():
+    """
+    Неделя раз в минуту: шум с выбросами и тремя часами без значений столбца b
+    """
+    rng = np.random.default_rng(0)
+    timestamps = pd.date_range("2024-05-01", periods=7 * 24 * 60, freq="1min").values.astype("int64")
+    a = rng.normal(size=len(timestamps))
+    a[[500, 7000]] = [40.0, -35.0]
+    b = rng.normal(size=len(timestamps)).cumsum()
+    b[3000:3180] = np.nan
+    return timestamps, {"a": a, "b": b}
+
+
+def envelope(timestamps, values, point_budget, chunk_rows=None):
+    # Отрезок [первая метка, последняя + 1 нс]: те же корзины, что у downsample_minmax
+    result = StreamingEnvelope(timestamps[0], timestamps[-1] + 1, list(values), point_budget)
+    chunk_rows = chunk_rows or len(timestamps)
+    for start in range(0, len(timestamps), chunk_rows):
+        chunk = slice(start, start + chunk_rows)
+        result.add(timestamps[chunk], {col: series[chunk] for col, series in values.items()})
+    return result.result()
+
+
+def bucket_extremes(timestamps, series, t0, t1, n_buckets):
+    buckets = ((timestamps - t0) / (t1 - t0 + 1) * n_buckets).astype(np.int64)
+    frame = pd.DataFrame({"bucket": buckets, "value": series})
+    return frame.groupby("bucket")["value"].agg(["min", "max"])
+
+
+def test_small_range_keeps_raw_points(series):
+    timestamps, values = series
+    short = timestamps[:1000], {col: v[:1000] for col, v in values.items()}
+    result_time, result_values, means, rows = envelope(*short, point_budget=4000, chunk_rows=300)
+    np.testing.assert_array_equal(result_time, short[0])
+    for col in values:
+        np.testing.assert_array_equal(result_values[col], short[1][col])
+    assert rows == 1000
+    assert means["a"] == pytest.approx(np.nanmean(short[1]["a"]))
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 997, 5000])
+def test_envelope_matches_downsample_per_bucket(series, chunk_rows):
+    timestamps, values = series
+    point_budget = 400
+    result_time, result_values, means, rows = envelope(timestamps, values, point_budget, chunk_rows)
+    sampled_time, sampled_values = downsample_minmax(timestamps, values, point_budget)
+    assert rows == len(timestamps)
+    assert len(result_time) <= point_budget
+    t0, t1 = timestamps[0], timestamps[-1]
+    for col in values:
+        # Обе огибающие хранят минимум и максимум каждой корзины: они совпадают с исходными данными
+        expected = bucket_extremes(timestamps, values[col], t0, t1, point_budget // 2)
+        sampled = bucket_extremes(sampled_time, sampled_values[col], t0, t1, point_budget // 2)
+        pd.testing.assert_frame_equal(sampled, expected)
+        np.testing.assert_allclose(result_values[col][0::2], expected["min"].to_numpy(), equal_nan=True)
+        np.testing.assert_allclose(result_values[col][1::2], expected["max"].to_numpy(), equal_nan=True)
+        # Выбросы не теряются, а средние считаются по всем строкам, а не по огибающей
+        assert np.nanmax(result_values[col]) == np.nanmax(values[col])
+        assert np.nanmin(result_values[col]) == np.nanmin(values[col])
+        assert means[col] == pytest.approx(np.nanmean(values[col]))
+
+
+def test_bucket_without_values_breaks_line(series):
+    timestamps, values = series
+    values = {"b": values["b"]}
+    result_time, result_values, _, _ = envelope(timestamps, values, point_budget=7 * 24 * 2)
+    # Корзины (около часа) целиком внутри пропуска -> NaN в огибающей (разрыв линии на графике),
+    # частично заполненные корзины на краях пропуска сохраняют свои значения
+    missing = np.isnan(result_values["b"])
+    assert missing.sum() >= 2
+    assert (result_time[missing] >= timestamps[2940]).all() and (result_time[missing] < timestamps[3180]).all()
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_cache import ProcDataCache
+from rollups import RESOLUTIONS, RollupStore, compute_rollup
+
+
+def write_rows(path_proc_data, index, values):
+    """
+    Дописывание строк в месячный csv прибора dev в формате сайта (десятичная запятая)
+    """
+    os.makedirs(f"{path_proc_data}/dev", exist_ok=True)
+    path = f"{path_proc_data}/dev/{index[0].strftime('%Y_%m')}.csv"
+    exists = os.path.exists(path)
+    data = pd.DataFrame({"timestamp": index.strftime("%Y-%m-%d %H:%M:%S"), **values})
+    data.to_csv(path, mode="a" if exists else "w", header=not exists, index=False, decimal=",", float_format="%.3f")
+    return path
+
+
+@pytest.fixture
+def month():
+    """
+    Март 2024 раз в 7 минут (строки не совпадают с границами корзин) с пропусками значений столбца b
+    """
+    index = pd.date_range("2024-03-01", "2024-03-31 23:59", freq="7min")
+    b = np.sin(np.arange(len(index)) / 10)
+    b[100:400] = np.nan
+    return index, {"a": np.arange(len(index)) * 0.25, "b": b}
+
+
+def make_store(tmp_path, name="rollups"):
+    proc_data = ProcDataCache(str(tmp_path / "proc_data"), str(tmp_path / "cache"), "float64")
+    return RollupStore(proc_data, str(tmp_path / name), poll_interval=0)
+
+
+def part(values, rows):
+    return {col: series[rows] for col, series in values.items()}
+
+
+def assert_rollups_equal(actual, expected):
+    bucket, stats = actual
+    expected_bucket, expected_stats = expected
+    np.testing.assert_array_equal(bucket, expected_bucket)
+    assert set(stats) == set(expected_stats)
+    for col in expected_stats:
+        for array, expected_array in zip(stats[col], expected_stats[col]):
+            np.testing.assert_allclose(array, expected_array, rtol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize("resolution", sorted(RESOLUTIONS))
+def test_incremental_rollup_matches_full_recompute(tmp_path, month, monkeypatch, resolution):
+    index, values = month
+    store = make_store(tmp_path)
+    # Граница дописывания посреди корзины: последняя сохраненная корзина неполная
+    split = 2000
+    write_rows(store.proc_data.path_proc_data, index[:split], part(values, slice(None, split)))
+    store.month_rollup("dev", "2024_03", resolution)
+
+    parsed = []
+    read_timestamps = ProcDataCache.read_timestamps
+
+    def counting_read_timestamps(source, **kwargs):
+        timestamps = read_timestamps(source, **kwargs)
+        parsed.append(len(timestamps))
+        return timestamps
+
+    monkeypatch.setattr(ProcDataCache, "read_timestamps", staticmethod(counting_read_timestamps))
+    write_rows(store.proc_data.path_proc_data, index[split:], part(values, slice(split, None)))
+    incremental = store.month_rollup("dev", "2024_03", resolution)
+    # Разобраны только дописанные строки
+    assert parsed == [len(index) - split]
+
+    full = make_store(tmp_path, "full").month_rollup("dev", "2024_03", resolution)
+    assert_rollups_equal(incremental, full)
+    timestamps, loaded = store.proc_data.load_range("dev", index[0], index[-1], ["a", "b"])
+    assert_rollups_equal(incremental, compute_rollup(timestamps, loaded, RESOLUTIONS[resolution]))
+    # Сохраненные на диск агрегаты читаются без разбора csv
+    parsed.clear()
+    assert_rollups_equal(make_store(tmp_path).month_rollup("dev", "2024_03", resolution), full)
+    assert parsed == []
+
+
+def test_partial_last_line_is_read_after_newline(tmp_path, month):
+    index, values = month
+    store = make_store(tmp_path)
+    path = write_rows(store.proc_data.path_proc_data, index[:-1], part(values, slice(None, -1)))
+    numbers = [f'"{values[col][-1]:.3f}"'.replace(".", ",") for col in ("a", "b")]
+    line = ",".join([index[-1].strftime("%Y-%m-%d %H:%M:%S"), *numbers])
+    with open(path, "a") as file:
+        file.write(line[:12])
+    bucket, stats = store.month_rollup("dev", "2024_03", "hour")
+    assert stats["a"][3].sum() == len(index) - 1
+    with open(path, "a") as file:
+        file.write(line[12:] + "\n")
+    bucket, stats = store.month_rollup("dev", "2024_03", "hour")
+    assert stats["a"][3].sum() == len(index)
+    assert stats["a"][2][-1] == pytest.approx(values["a"][-1], abs=1e-3)
+
+
+def test_rewritten_file_is_recomputed(tmp_path, month):
+    index, values = month
+    store = make_store(tmp_path)
+    path = write_rows(store.proc_data.path_proc_data, index, values)
+    store.month_rollup("dev", "2024_03", "day")
+    os.remove(path)
+    shorter = index[:500]
+    new_values = {"a": np.full(500, 2.0), "b": np.full(500, -1.0)}
+    write_rows(store.proc_data.path_proc_data, shorter, new_values)
+    bucket, stats = store.month_rollup("dev", "2024_03", "day")
+    expected = compute_rollup(shorter.values.astype("int64"), new_values, RESOLUTIONS["day"])
+    assert_rollups_equal((bucket, stats), expected)
+
+
+def test_poll_skips_unchanged_months(tmp_path, month, monkeypatch):
+    index, values = month
+    store = make_store(tmp_path)
+    write_rows(store.proc_data.path_proc_data, index[:1000], part(values, slice(None, 1000)))
+    calls = []
+    month_rollup = store.month_rollup
+
+    def counting_month_rollup(device, month_name, resolution):
+        calls.append((device, month_name, resolution))
+        return month_rollup(device, month_name, resolution)
+
+    monkeypatch.setattr(store, "month_rollup", counting_month_rollup)
+    store.poll(["dev", "missing"])
+    assert sorted(calls) == [("dev", "2024_03", resolution) for resolution in sorted(RESOLUTIONS)]
+    store.poll(["dev"])
+    assert len(calls) == len(RESOLUTIONS)
+    write_rows(store.proc_data.path_proc_data, index[1000:], part(values, slice(1000, None)))
+    store.poll(["dev"])
+    assert len(calls) == 2 * len(RESOLUTIONS)
+    bucket, stats = store.load_range("dev", index[0], index[-1], ["a", "missing"], "day")
+    assert len(bucket) == 31 and stats["a"][3].sum() == len(index)
+    assert np.isnan(stats["missing"][0]).all()
@@ -0,0 +1,75 @@
+from routing import Router
+
+
+class FakeCatalog:
+    """
+    Каталог с именами приборов в памяти: generation меняется при каждом обновлении списка
+    """
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self.generation = 0
+        self.refreshes = 0
+
+    def refresh(self):
+        self.refreshes += 1
+
+    def update(self, devices):
+        self.devices = list(devices)
+        self.generation += 1
+
+
+def make_router(catalog):
+    router = Router(catalog)
+    calls = {"names": 0}
+
+    @router.text("2 дня", "7 дней")
+    def get_delay(message):
+        return "delay"
+
+    def device_names():
+        calls["names"] += 1
+        return catalog.devices
+
+    @router.names(device_names)
+    def choose_device(message):
+        return "device"
+
+    return router, calls, get_delay, choose_device
+
+
+def test_resolve_fixed_texts_and_catalog_names():
+    catalog = FakeCatalog(["AE33", "LOPC"])
+    router, _, get_delay, choose_device = make_router(catalog)
+    assert router.resolve("7 дней") is get_delay
+    assert router.resolve("LOPC") is choose_device
+    assert router.resolve("неизвестный текст") is None
+    # Каталог проверяется при каждом сообщении: обновления базы видны сразу
+    assert catalog.refreshes == 3
+
+
+def test_table_rebuilt_only_after_catalog_changes():
+    catalog = FakeCatalog(["AE33"])
+    router, calls, _, choose_device = make_router(catalog)
+    for _ in range(5):
+        router.resolve("AE33")
+    assert calls["names"] == 1
+    catalog.update(["AE33", "TCA08"])
+    assert router.resolve("TCA08") is choose_device
+    assert calls["names"] == 2
+    catalog.update(["TCA08"])
+    assert router.resolve("AE33") is None
+
+
+def test_earlier_route_wins_and_late_registration_is_seen():
+    catalog = FakeCatalog(["2 дня"])
+    router, _, get_delay, _ = make_router(catalog)
+    # Прибор с именем кнопки промежутка: как и с фильтрами telebot, срабатывает обработчик, объявленный раньше
+    assert router.resolve("2 дня") is get_delay
+    assert router.resolve("Весь комплекс") is None
+
+    @router.text("Весь комплекс")
+    def choose_whole_complex(message):
+        return "complex"
+
+    assert router.resolve("Весь комплекс") is choose_whole_complex
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from sessions import SessionStore
+
+
+def stored(path_db):
+    """
+    :return: сессии, которые уже записаны в базу
+    """
+    connection = sqlite3.connect(path_db)
+    try:
+        rows = connection.execute("SELECT user_id, data FROM sessions")
+        return {user_id: json.loads(data) for user_id, data in rows}
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "user_info.db"), str(tmp_path / "user_info.json")
+
+
+def test_legacy_json_is_imported_once(paths):
+    path_db, legacy_json = paths
+    with open(legacy_json, "w") as file:
+        json.dump({"1": {"device": "AE33"}, "2": {"delay": 7}}, file)
+    store = SessionStore(path_db, legacy_json=legacy_json, flush_interval=3600)
+    assert store["1"] == {"device": "AE33"} and 2 in store
+    # Перенос сразу записан в базу
+    assert stored(path_db) == {"1": {"device": "AE33"}, "2": {"delay": 7}}
+    store.close()
+    with open(legacy_json, "w") as file:
+        json.dump({"3": {}}, file)
+    store = SessionStore(path_db, legacy_json=legacy_json, flush_interval=3600)
+    # База уже не пустая -> старый файл больше не читается
+    assert "3" not in store and store["2"] == {"delay": 7}
+    store.close()
+
+
+def test_copies_and_update_then_flush_writes(paths):
+    path_db, _ = paths
+    store = SessionStore(path_db, flush_interval=3600)
+    store[5] = {"device": "AE33", "selected_columns": {"AE33": []}}
+    # Изменения копии в хранилище не попадают
+    copy = store["5"]
+    copy["delay"] = 31
+    copy["selected_columns"]["AE33"].append("BC1")
+    assert store["5"] == {"device": "AE33", "selected_columns": {"AE33": []}}
+    assert store.update(5, delay=2)["delay"] == 2
+    store.flush()
+    assert stored(path_db) == {"5": {"device": "AE33", "selected_columns": {"AE33": []}, "delay": 2}}
+    with store.edit("5") as user_info:
+        user_info["selected_columns"]["AE33"].append("BC6")
+    # Изменения после flush ждут следующего сброса
+    assert stored(path_db)["5"]["selected_columns"] == {"AE33": []}
+    store.close()
+    assert stored(path_db)["5"]["selected_columns"] == {"AE33": ["BC6"]}
+
+
+def test_background_flush(paths):
+    path_db, _ = paths
+    store = SessionStore(path_db, flush_interval=0.05)
+    store["1"] = {"x": 1}
+    try:
+        for _ in range(100):
+            if stored(path_db):
+                break
+            threading.Event().wait(0.05)
+        assert stored(path_db) == {"1": {"x": 1}}
+    finally:
+        store.close()
+
+
+def test_concurrent_edits_keep_latest_state(paths):
+    path_db, _ = paths
+    store = SessionStore(path_db, flush_interval=0.001)
+    store["1"] = {"items": [], "counter": 0}
+    snapshots = []
+
+    def worker(start):
+        for i in range(start, start + 200):
+            with store.edit("1") as user_info:
+                user_info["items"].append(i)
+            store.update("1", counter=i)
+
+    def reader():
+        # Снимки (как у планировщика подписок) не видят сессию посреди изменения
+        for _ in range(200):
+            for _, user_info in store.items():
+                snapshots.append(len(user_info["items"]))
+
+    threads = [threading.Thread(target=worker, args=(k * 1000,)) for k in range(4)]
+    threads.append(threading.Thread(target=reader))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+    assert len(stored(path_db)["1"]["items"]) == 800
+    assert len(store["1"]["items"]) == 800
+    assert snapshots == sorted(snapshots)
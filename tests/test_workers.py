@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+import workers
+from workers import GraphJobs
+
+
+def wait_job(gate, value):
+    gate.wait(5)
+    return (value,)
+
+
+def failing_job():
+    raise ValueError("boom")
+
+
+class Results:
+    """
+    Сбор результатов и ошибок задач из потока доставки
+    """
+
+    def __init__(self):
+        self.values = []
+        self.errors = []
+        self._cond = threading.Condition()
+
+    def on_result(self, value):
+        with self._cond:
+            self.values.append(value)
+            self._cond.notify_all()
+
+    def on_error(self, error):
+        with self._cond:
+            self.errors.append(error)
+            self._cond.notify_all()
+
+    def wait(self, count, timeout=5):
+        with self._cond:
+            assert self._cond.wait_for(lambda: len(self.values) + len(self.errors) >= count, timeout)
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    # workers=0: задачи выполняются в одном потоке текущего процесса, без отрисовки и кеша данных
+    monkeypatch.setattr(workers, "init_worker", lambda: None)
+    jobs = GraphJobs(0, queue_limit=2, initargs=())
+    yield jobs
+    jobs.shutdown(wait=True)
+
+
+def test_duplicate_and_busy(jobs):
+    gate, results = threading.Event(), Results()
+    assert jobs.submit("a", "key a", (gate, 1), results.on_result, results.on_error, wait_job) == "queued"
+    assert jobs.submit("a", "key a", (gate, 1), results.on_result, results.on_error, wait_job) == "duplicate"
+    assert jobs.submit("b", "key b", (gate, 2), results.on_result, results.on_error, wait_job) == "queued"
+    assert jobs.submit("c", "key c", (gate, 3), results.on_result, results.on_error, wait_job) == "busy"
+    assert jobs.pending == 2
+    gate.set()
+    results.wait(2)
+    assert sorted(results.values) == [1, 2]
+    assert jobs.pending == 0
+
+
+def test_new_job_replaces_previous_even_when_full(jobs):
+    gate, results = threading.Event(), Results()
+    jobs.submit("a", "old", (gate, "old"), results.on_result, results.on_error, wait_job)
+    jobs.submit("b", "b", (gate, "b"), results.on_result, results.on_error, wait_job)
+    # Очередь полна, но место предыдущей задачи владельца освобождается -> не "busy"
+    assert jobs.submit("a", "new", (gate, "new"), results.on_result, results.on_error, wait_job) == "queued"
+    assert jobs.pending == 2
+    gate.set()
+    results.wait(2)
+    # Результат отмененной (уже выполнявшейся) задачи выброшен
+    assert sorted(results.values) == ["b", "new"]
+    jobs.shutdown(wait=True)
+    assert jobs.pending == 0
+
+
+def test_cancelled_running_job_frees_its_place(jobs):
+    gate, results = threading.Event(), Results()
+    jobs.submit("a", "running", (gate, "running"), results.on_result, results.on_error, wait_job)
+    jobs.cancel("a")
+    assert jobs.pending == 0
+    # Отмененная задача еще выполняется, но места в очереди не занимает
+    assert jobs.submit("b", "b", (gate, "b"), results.on_result, results.on_error, wait_job) == "queued"
+    assert jobs.submit("c", "c", (gate, "c"), results.on_result, results.on_error, wait_job) == "queued"
+    gate.set()
+    results.wait(2)
+    jobs.shutdown(wait=True)
+    assert sorted(results.values) == ["b", "c"]
+    assert jobs.pending == 0
+
+
+def test_error_is_delivered_to_on_error(jobs):
+    results = Results()
+    assert jobs.submit("a", "bad", (), results.on_result, results.on_error, failing_job) == "queued"
+    results.wait(1)
+    assert isinstance(results.errors[0], ValueError) and not results.values
+    assert jobs.pending == 0
@@ -0,0 +1,409 @@
+import logging
+import multiprocessing
+import multiprocessing.util
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from data_cache import ProcDataCache
+from render import GraphSpec, StreamingEnvelope, downsample_minmax, make_renderer
+from rollups import RESOLUTIONS, RollupStore, choose_resolution
+from summary import StreamingSummary, format_summary
+
+# Состояние процесса-исполнителя: кеш данных и отрисовка создаются один раз при его запуске
+_worker = {}
+
+
+def init_worker(path_proc_data, path_cache, renderer_name, dtype="float32", loader_threads=8):
+    """
+    Инициализация процесса-исполнителя: открытие кеша данных и прогрев отрисовки
+
+    :param path_proc_data: путь до папки proc_data сайта
+    :param path_cache: путь до папки с кешем данных
+    :param renderer_name: бэкенд отрисовки
+    :param dtype: тип значений в кеше данных
+    :param loader_threads: число потоков чтения данных для графиков комплексов
+    """
+    _worker["proc_data"] = ProcDataCache(path_proc_data, path_cache, dtype)
+    _worker["rollups"] = RollupStore(_worker["proc_data"], f"{path_cache}/_rollups")
+    _worker["renderer"] = make_renderer(renderer_name)
+    # Потоки для параллельного чтения данных приборов комплекса
+    _worker["loaders"] = ThreadPoolExecutor(max_workers=loader_threads, thread_name_prefix="graph-load")
+    # Финализаторы multiprocessing выполняются и при выходе процесса-исполнителя, в отличие от atexit:
+    # без этого процесс kaleido переживает пул
+    multiprocessing.util.Finalize(None, _worker["renderer"].close, exitpriority=10)
+    _worker["renderer"].warm_up()
+
+
+def ping():
+    """
+    Пустая задача: ее выполнение означает, что процесс-исполнитель запущен и прогрет
+    """
+    return True
+
+
+def render_job(
+    device, cols_to_draw, colors, begin_record_date, end_record_date, axis_range, point_budget, data=None
+):
+    """
+    Загрузка данных прибора и отрисовка графика (выполняется в процессе-исполнителе)
+
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param colors: словарь столбец -> цвет
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных (включительно)
+    :param axis_range: границы оси времени
+    :param point_budget: примерное число точек на столбец после прореживания
+    :param data: данные горячего окна, подготовленные в процессе бота (см. memory_data), или None
+    :return: (байты png картинки, статистика построения)
+    """
+    renderer = _worker["renderer"]
+    load_start = time.perf_counter()
+    timestamps, values, means, rows, resolution = load_data(
+        device, cols_to_draw, begin_record_date, end_record_date, point_budget, data
+    )
+    process_start = time.perf_counter()
+    timestamps, series = make_series(timestamps, values, means, cols_to_draw, colors)
+    render_start = time.perf_counter()
+    png = renderer.render(GraphSpec(device, timestamps, series, axis_range)).getvalue()
+    stats = {
+        "rows": rows,
+        "points": len(timestamps),
+        "resolution": resolution,
+        "renderer": renderer.name,
+        "load": process_start - load_start,
+        "process": render_start - process_start,
+        "render": time.perf_counter() - render_start,
+    }
+    return png, stats
+
+
+def load_data(device, cols_to_draw, begin_record_date, end_record_date, point_budget, data=None):
+    """
+    Загрузка данных прибора за отрезок: из горячего окна, из агрегатов или из кеша сырых данных
+
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных (включительно)
+    :param point_budget: примерное число точек на столбец после прореживания
+    :param data: данные горячего окна, подготовленные в процессе бота (см. memory_data), или None
+    :return: (метки времени, словарь столбец -> значения, средние столбцов или None, число исходных строк,
+        откуда взяты данные)
+    """
+    if data is not None:
+        timestamps, values, means, rows_raw = data
+        return timestamps, values, means, rows_raw, "memory"
+    # Длинным отрезкам хватает часовых/суточных агрегатов, если корзин все равно не меньше, чем точек на картинке
+    resolution = None
+    if point_budget:
+        resolution = choose_resolution(begin_record_date, end_record_date, point_budget // 2)
+    if resolution is not None:
+        bucket, stats = _worker["rollups"].load_range(
+            device, begin_record_date, end_record_date, cols_to_draw, resolution
+        )
+        timestamps, values, means = rollup_envelope(bucket, stats, RESOLUTIONS[resolution])
+        return timestamps, values, means if len(bucket) else None, len(bucket), resolution
+    elif point_budget:
+        # Сырые данные читаются кусками и сразу сворачиваются в огибающую размером с картинку
+        timestamps, values, means, rows_raw = stream_range(
+            _worker["proc_data"], device, begin_record_date, end_record_date, cols_to_draw, point_budget
+        )
+        return timestamps, values, means, rows_raw, "raw"
+    else:
+        # Без прореживания: читаю ровно те месячные файлы, которые пересекаются с промежутком,
+        # и сразу обрезаю их по нему. Из кеша читаются только выбранные столбцы, уже переведенные в числа
+        timestamps, values = _worker["proc_data"].load_range(
+            device, begin_record_date, end_record_date, cols_to_draw
+        )
+        means = pd.DataFrame(values)[cols_to_draw].mean() if len(timestamps) else None
+        return timestamps, values, means, len(timestamps), "raw"
+
+
+def memory_data(timestamps, values, cols_to_draw, point_budget):
+    """
+    Подготовка данных горячего окна в процессе бота: средние считаются по всем строкам,
+    а в процесс-исполнитель передаются уже прореженные ряды размером с картинку, а не все строки отрезка
+
+    :param timestamps: метки времени из горячего окна
+    :param values: словарь столбец -> значения
+    :param cols_to_draw: выбранные столбцы
+    :param point_budget: примерное число точек на столбец после прореживания
+    :return: (метки времени, словарь столбец -> значения, средние столбцов или None, число исходных строк)
+    """
+    means = pd.DataFrame(values)[cols_to_draw].mean() if len(timestamps) else None
+    rows_raw = len(timestamps)
+    timestamps, values = downsample_minmax(timestamps, values, point_budget)
+    return timestamps, values, means, rows_raw
+
+
+def stream_range(proc_data, device, begin_record_date, end_record_date, cols_to_draw, point_budget):
+    """
+    Потоковая загрузка сырых данных с ограниченной памятью (см. StreamingEnvelope)
+
+    :param proc_data: ProcDataCache
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных (включительно)
+    :param point_budget: примерное число точек на столбец после прореживания
+    :return: (метки времени, словарь столбец -> значения, средние столбцов или None, число исходных строк)
+    """
+    envelope = StreamingEnvelope(begin_record_date, end_record_date, cols_to_draw, point_budget)
+    for timestamps, values in proc_data.iter_range(device, begin_record_date, end_record_date, cols_to_draw):
+        envelope.add(timestamps, values)
+    return envelope.result()
+
+
+def make_series(timestamps, values, means, cols_to_draw, colors):
+    """
+    Порядок отрисовки столбцов. Данные уже прорежены при загрузке (агрегаты, огибающая или memory_data)
+
+    :param timestamps: метки времени
+    :param values: словарь столбец -> значения
+    :param means: средние столбцов или None, если данных нет
+    :param cols_to_draw: выбранные столбцы
+    :param colors: словарь столбец -> цвет
+    :return: (метки времени, список (столбец, значения, цвет))
+    """
+    # Если итоговый файл оказался пустым (например, прибор не работает), то рисуются пустые оси
+    if means is None:
+        return timestamps, []
+    # Сортируем столбцы таким образом, чтобы более маленькие рисовались позже (по средним до прореживания)
+    cols_to_draw = means.sort_values(ascending=False).index.tolist()
+    return timestamps, [(col, values[col], colors[col]) for col in cols_to_draw]
+
+
+def render_complex_job(title, panels, begin_record_date, end_record_date, axis_range, point_budget):
+    """
+    График всего комплекса: по панели на каждый прибор на одной картинке (выполняется в процессе-исполнителе).
+    Данные приборов читаются параллельно в потоках процесса (чтение файлов и np.load отпускают GIL),
+    поэтому загрузка занимает примерно столько же, сколько у самого медленного прибора, а не их сумму.
+    Картинка рисуется один раз
+
+    :param title: заголовок картинки (имя комплекса)
+    :param panels: список (прибор, столбцы, словарь столбец -> цвет, данные горячего окна (memory_data) или None)
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: конец отрезка данных (включительно)
+    :param axis_range: границы оси времени
+    :param point_budget: примерное число точек на столбец после прореживания
+    :return: (байты png картинки, статистика построения)
+    """
+    renderer = _worker["renderer"]
+    load_start = time.perf_counter()
+    futures = [
+        _worker["loaders"].submit(
+            load_data, device, cols_to_draw, begin_record_date, end_record_date, point_budget, data
+        )
+        for device, cols_to_draw, _, data in panels
+    ]
+    loaded = [future.result() for future in futures]
+    process_start = time.perf_counter()
+    specs = []
+    for (device, cols_to_draw, colors, _), (timestamps, values, means, _, _) in zip(panels, loaded):
+        timestamps, series = make_series(timestamps, values, means, cols_to_draw, colors)
+        specs.append(GraphSpec(device, timestamps, series, axis_range))
+    render_start = time.perf_counter()
+    png = renderer.render_panels(title, specs).getvalue()
+    stats = {
+        "rows": sum(rows for _, _, _, rows, _ in loaded),
+        "points": sum(len(spec.timestamps) for spec in specs),
+        "resolution": "+".join(sorted({resolution for _, _, _, _, resolution in loaded})),
+        "renderer": renderer.name,
+        "load": process_start - load_start,
+        "process": render_start - process_start,
+        "render": time.perf_counter() - render_start,
+    }
+    return png, stats
+
+
+def summary_job(device, cols_to_draw, begin_record_date, end_record_date):
+    """
+    Числовая сводка за отрезок (выполняется в процессе-исполнителе).
+    Данные читаются кусками iter_range, поэтому память не растет с длиной отрезка
+
+    :param device: прибор
+    :param cols_to_draw: выбранные столбцы
+    :param begin_record_date: начало отрезка данных
+    :param end_record_date: последний день отрезка (данные берутся до его конца)
+    :return: (текст сводки,)
+    """
+    summary = StreamingSummary(cols_to_draw)
+    for timestamps, values in _worker["proc_data"].iter_range(
+        device, begin_record_date, end_record_date + pd.Timedelta(days=1), cols_to_draw
+    ):
+        summary.add(timestamps, values)
+    return (format_summary(device, begin_record_date, end_record_date, summary.result()),)
+
+
+def rollup_envelope(bucket, stats, bucket_ns):
+    """
+    Огибающая по агрегатам: в каждой корзине минимум в ее начале и максимум в ее середине,
+    чтобы выбросы были видны так же, как при прореживании сырых данных
+
+    :param bucket: начала корзин
+    :param stats: словарь столбец -> (mean, min, max, count)
+    :param bucket_ns: длина корзины в наносекундах
+    :return: (метки времени, словарь столбец -> значения, средние столбцов по всем исходным строкам)
+    """
+    timestamps = np.empty(2 * len(bucket), dtype="int64")
+    timestamps[0::2] = bucket
+    timestamps[1::2] = bucket + bucket_ns // 2
+    values, means = {}, {}
+    for col, (mean, low, high, count) in stats.items():
+        series = np.empty(2 * len(bucket))
+        series[0::2] = low
+        series[1::2] = high
+        values[col] = series
+        total = count.sum()
+        means[col] = np.nansum(mean * count) / total if total else np.nan
+    return timestamps, values, pd.Series(means, dtype="float64")
+
+
+class GraphJobs:
+    """
+    Ограниченный пул построения графиков.
+    Тяжелая загрузка и отрисовка идут в отдельных процессах, а не в потоке обработчиков бота.
+    - Число одновременно принятых задач ограничено: сверх лимита submit отвечает "busy"
+    - Повторная задача владельца с тем же ключом не создает новую ("duplicate")
+    - Новая задача владельца отменяет его предыдущую: она снимается с очереди,
+      а если уже выполняется, то ее результат выбрасывается
+    Результаты передаются в callback в отдельном потоке доставки, чтобы отправка в Telegram
+    не задерживала прием результатов пула
+    """
+
+    def __init__(self, workers, queue_limit, initargs):
+        """
+        :param workers: число процессов (0 - строить в одном потоке текущего процесса)
+        :param queue_limit: максимальное число принятых и еще не завершенных задач
+        :param initargs: аргументы init_worker
+        """
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.initargs = initargs
+        self._lock = threading.Lock()
+        # владелец -> (ключ, future, флаг отмены); отмененные задачи в _pending не входят
+        self._jobs = {}
+        self._pending = 0
+        self._delivery = ThreadPoolExecutor(max_workers=2, thread_name_prefix="graph-delivery")
+        self._pool = self._make_pool()
+
+    def _make_pool(self):
+        if self.workers == 0:
+            return ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=self.initargs)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # spawn: процессы не наследуют потоки бота и открытые соединения
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=self.initargs,
+        )
+
+    def warm_up(self):
+        """
+        Запуск и прогрев всех процессов пула до первого запроса пользователя
+        """
+        for future in [self._pool.submit(ping) for _ in range(max(1, self.workers))]:
+            future.result()
+
+    @property
+    def pending(self):
+        """
+        :return: число принятых и еще не завершенных задач
+        """
+        return self._pending
+
+    def submit(self, owner, key, args, on_result, on_error, job=render_job):
+        """
+        Постановка задачи построения в пул
+
+        :param owner: владелец задачи (обычно id пользователя)
+        :param key: ключ графика, по которому склеиваются повторные задачи
+        :param args: аргументы задачи
+        :param on_result: вызывается с (png, stats) после успешного построения
+        :param on_error: вызывается с исключением, если построение упало
+        :param job: функция построения: render_job или render_complex_job
+        :return: "queued", "duplicate" или "busy"
+        """
+        with self._lock:
+            current = self._jobs.get(owner)
+            if current is not None and current[0] == key:
+                return "duplicate"
+            # Место проверяется до отмены предыдущей задачи владельца (ее место освободится):
+            # если пул занят, пользователь не теряет уже принятую задачу
+            if self._pending - (current is not None) >= self.queue_limit:
+                return "busy"
+            if current is not None:
+                self._cancel(current)
+            try:
+                future = self._pool.submit(job, *args)
+            except BrokenProcessPool:
+                # Процесс-исполнитель упал -> пересоздаем пул
+                self._pool = self._make_pool()
+                future = self._pool.submit(job, *args)
+            entry = (key, future, threading.Event())
+            self._jobs[owner] = entry
+            self._pending += 1
+        future.add_done_callback(
+            lambda done: self._delivery.submit(self._finish, owner, entry, on_result, on_error)
+        )
+        return "queued"
+
+    def shutdown(self, wait=True):
+        """
+        Остановка пула: задачи из очереди отменяются, процессы-исполнители завершаются
+
+        :param wait: ждать ли завершения процессов и доставки уже готовых результатов
+        """
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+        self._delivery.shutdown(wait=wait)
+
+    def cancel(self, owner):
+        """
+        Отмена задачи владельца, если она есть
+
+        :param owner: владелец задачи
+        """
+        with self._lock:
+            current = self._jobs.pop(owner, None)
+            if current is not None:
+                self._cancel(current)
+
+    def _cancel(self, entry):
+        """
+        Отмена задачи (под self._lock). Отмененная задача сразу перестает занимать место в очереди,
+        даже если процесс еще досчитывает ее: ее результат все равно будет выброшен
+        """
+        if entry[2].is_set():
+            return
+        entry[2].set()
+        entry[1].cancel()
+        self._pending -= 1
+
+    def _finish(self, owner, entry, on_result, on_error):
+        """
+        Передача результата задачи, если она не была отменена
+        """
+        key, future, cancelled = entry
+        with self._lock:
+            if self._jobs.get(owner) is entry:
+                del self._jobs[owner]
+            if cancelled.is_set():
+                return
+            self._pending -= 1
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            on_error(e)
+            return
+        try:
+            on_result(*result)
+        except Exception as e:
+            logging.warning(f"Ошибка при отправке графика {key}: {e.__class__.__name__}")